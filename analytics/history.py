@@ -0,0 +1,237 @@
+import time
+import uuid
+import numpy as np
+
+# optional, only needed for to_arrow / from_arrow
+try:
+	import pyarrow as pa
+except ImportError:
+	pa = None
+
+
+# Sentiment history as columns instead of rows, for the read side (resampling, spikes, correlations) to work on whole
+# arrays at once. One row per rss_news_sentiment with a cmc match, impact_importance joined from its rss_news_items.
+# Runs through a server side (named) cursor, so rows are streamed in batches rather than all fetched at once; named
+# cursors can't EXECUTE a prepared statement, so this is a plain query instead of a registered one.
+HISTORY_SQL = """
+	SELECT EXTRACT(EPOCH FROM s.sentiment_timestamp AT TIME ZONE 'UTC')::float8, s.best_match_cmc_id,
+		s.sentiment_score, s.movement_score, s.indicator_certainty, i.impact_importance, s.newsitem_id
+	FROM rss_news_sentiment s
+	JOIN rss_news_items i ON i.id = s.newsitem_id
+	WHERE s.best_match_cmc_id IS NOT NULL AND s.sentiment_timestamp IS NOT NULL
+		AND s.sentiment_timestamp >= to_timestamp(%(since)s) AT TIME ZONE 'UTC'
+		AND s.sentiment_timestamp < to_timestamp(%(until)s) AT TIME ZONE 'UTC'
+		AND (%(coins)s::text[] IS NULL OR s.best_match_cmc_id = ANY(%(coins)s::text[]))
+"""
+
+
+# coin holds an index into coin_ids (the cmc ids), timestamps are utc epoch seconds,
+# a missing impact_importance is nan
+class SentimentHistory:
+	COLUMNS = ('timestamp', 'coin', 'sentiment', 'movement', 'certainty', 'impact_importance', 'newsitem_id')
+
+	def __init__(self, timestamp, coin, coin_ids, sentiment, movement, certainty, impact_importance, newsitem_id):
+		self.timestamp = timestamp
+		self.coin = coin
+		self.coin_ids = coin_ids
+		self.sentiment = sentiment
+		self.movement = movement
+		self.certainty = certainty
+		self.impact_importance = impact_importance
+		self.newsitem_id = newsitem_id
+
+	def __len__(self):
+		return len(self.timestamp)
+
+	@classmethod
+	def empty(cls):
+		return cls(np.empty(0, np.float64), np.empty(0, np.int32), np.empty(0, object), *(np.empty(0, np.float32) for i in range(4)), np.empty(0, np.int64))
+
+	def select(self, mask):
+		return SentimentHistory(self.timestamp[mask], self.coin[mask], self.coin_ids, *(getattr(self, name)[mask] for name in self.COLUMNS[2:]))
+
+	def for_coins(self, coin_ids):
+		codes = [self.coin_code(coin_id) for coin_id in coin_ids]
+		return self.select(np.isin(self.coin, [code for code in codes if code is not None]))
+
+	def coin_code(self, coin_id):
+		matches = np.flatnonzero(self.coin_ids == str(coin_id))
+		return int(matches[0]) if len(matches) else None
+
+	def memory_bytes(self):
+		return sum(getattr(self, name).nbytes for name in self.COLUMNS)
+
+	def to_arrow(self):
+		if pa is None:
+			raise RuntimeError('pyarrow is not installed')
+		columns = {name: getattr(self, name) for name in self.COLUMNS if name != 'coin'}
+		columns['coin'] = pa.DictionaryArray.from_arrays(self.coin, pa.array(self.coin_ids.astype(str)))
+		return pa.table(columns)
+
+	@classmethod
+	def from_arrow(cls, table):
+		coin = table.column('coin').combine_chunks()
+		return cls(
+			table.column('timestamp').to_numpy(), coin.indices.to_numpy().astype(np.int32), np.array(coin.dictionary.to_pylist(), dtype=object),
+			*(table.column(name).to_numpy() for name in cls.COLUMNS[2:])
+		)
+
+
+def concatenate(chunks, coin_ids):
+	if not chunks:
+		history = SentimentHistory.empty()
+		history.coin_ids = np.array(coin_ids, dtype=object)
+		return history
+	return SentimentHistory(
+		np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks]), np.array(coin_ids, dtype=object),
+		*(np.concatenate([c[i] for c in chunks]) for i in range(2, 7))
+	)
+
+
+# streams the history between since and until (epoch seconds, default: everything) into a SentimentHistory,
+# batch_size rows at a time; conn is a db.db.Database (e.g. from the pool)
+def load_sentiment_history(conn, since=None, until=None, coins=None, batch_size=100000):
+	params = {
+		'since': since if since is not None else 0,
+		'until': until if until is not None else time.time() + 86400,
+		'coins': [str(c) for c in coins] if coins is not None else None
+	}
+	codes = {}
+	chunks = []
+	cursor = conn.connection.cursor(name=f'sentiment_history_{uuid.uuid4().hex[:8]}')
+	cursor.itersize = batch_size
+	try:
+		cursor.execute(HISTORY_SQL, params)
+		while True:
+			rows = cursor.fetchmany(batch_size)
+			if not rows:
+				break
+			timestamp, coin, sentiment, movement, certainty, impact_importance, newsitem_id = zip(*rows)
+			chunks.append((
+				np.array(timestamp, np.float64),
+				np.fromiter((codes.setdefault(c, len(codes)) for c in coin), np.int32, len(rows)),
+				# None -> nan
+				np.array(sentiment, np.float32),
+				np.array(movement, np.float32),
+				np.array(certainty, np.float32),
+				np.array(impact_importance, np.float32),
+				np.array(newsitem_id, np.int64)
+			))
+	finally:
+		cursor.close()
+		# ends the read transaction the named cursor needed
+		conn.connection.rollback()
+	return concatenate(chunks, list(codes))
+
+
+def ratio(numerator, denominator):
+	return np.divide(numerator, denominator, out=np.full(len(numerator), np.nan), where=denominator > 0)
+
+
+# sum(values * weights) / sum(weights) per group (0..num_groups-1), nan where a group has no weight;
+# weights=None is a plain mean, rows with a nan value or weight are left out
+def weighted_average(values, weights, groups, num_groups):
+	missing = np.isnan(values) if weights is None else np.isnan(values) | np.isnan(weights)
+	if missing.any():
+		values, groups = values[~missing], groups[~missing]
+		weights = weights[~missing] if weights is not None else None
+	if weights is None:
+		return ratio(np.bincount(groups, weights=values, minlength=num_groups), np.bincount(groups, minlength=num_groups))
+	weights = weights.astype(np.float64)
+	return ratio(np.bincount(groups, weights=values * weights, minlength=num_groups), np.bincount(groups, weights=weights, minlength=num_groups))
+
+
+# Per coin, per time bucket values, as (number of coins, number of buckets) arrays (rows follow history.coin_ids).
+# Buckets without any sentiment have a count of 0 and nan everywhere else.
+class Resampled:
+	def __init__(self, bucket_start, coin_ids, count, mean_sentiment, mean_movement, weighted_sentiment, weighted_movement, mean_impact):
+		self.bucket_start = bucket_start
+		self.coin_ids = coin_ids
+		self.count = count
+		self.mean_sentiment = mean_sentiment
+		self.mean_movement = mean_movement
+		self.weighted_sentiment = weighted_sentiment
+		self.weighted_movement = weighted_movement
+		self.mean_impact = mean_impact
+
+
+# weight is 'certainty' (indicator_certainty) or 'certainty_impact' (indicator_certainty * the article's impact_importance)
+def resample(history, bucket_seconds, start=None, end=None, weight='certainty'):
+	if weight not in ('certainty', 'certainty_impact'):
+		raise ValueError(f'unknown weight {weight!r}')
+	if start is None:
+		start = history.timestamp.min() if len(history) else 0
+	if end is None:
+		end = history.timestamp.max() + 1 if len(history) else start
+	start = int(start // bucket_seconds) * bucket_seconds
+	num_buckets = max(0, int(-(-(end - start) // bucket_seconds)))
+	num_coins = len(history.coin_ids)
+	size = num_coins * num_buckets
+
+	in_range = (history.timestamp >= start) & (history.timestamp < start + num_buckets * bucket_seconds)
+	# true division then truncation: exact on bucket boundaries, and a lot faster than float floor division
+	bucket = ((history.timestamp[in_range] - start) / bucket_seconds).astype(np.int64)
+	groups = history.coin[in_range].astype(np.int64) * num_buckets + bucket
+	sentiment = history.sentiment[in_range]
+	movement = history.movement[in_range]
+	weights = history.certainty[in_range]
+	if weight == 'certainty_impact':
+		weights = weights * history.impact_importance[in_range]
+
+	# one pass per sum, shared between the means (sentiment and movement are never null, the weights can be)
+	count = np.bincount(groups, minlength=size)
+	weighted = ~np.isnan(weights)
+	weight_totals = np.bincount(groups[weighted], weights=weights[weighted], minlength=size)
+	shape = (num_coins, num_buckets)
+	return Resampled(
+		start + np.arange(num_buckets, dtype=np.int64) * bucket_seconds,
+		history.coin_ids,
+		count.reshape(shape),
+		ratio(np.bincount(groups, weights=sentiment, minlength=size), count).reshape(shape),
+		ratio(np.bincount(groups, weights=movement, minlength=size), count).reshape(shape),
+		ratio(np.bincount(groups[weighted], weights=(sentiment * weights)[weighted], minlength=size), weight_totals).reshape(shape),
+		ratio(np.bincount(groups[weighted], weights=(movement * weights)[weighted], minlength=size), weight_totals).reshape(shape),
+		weighted_average(history.impact_importance[in_range], None, groups, size).reshape(shape)
+	)
+
+
+# Spikes in a (coins, buckets) series: buckets whose value is more than threshold standard deviations away from the
+# mean of the previous `window` buckets of the same coin (nan buckets are ignored, at least min_periods of them
+# must have a value). Returns (coin rows, bucket columns, z scores) of the spikes.
+def zscore_spikes(series, window=24, threshold=3.0, min_periods=6):
+	present = ~np.isnan(series)
+	values = np.where(present, series, 0.0)
+	padding = np.zeros((series.shape[0], window + 1))
+
+	# sum of the `window` buckets before each bucket, as slices of a cumulative sum with window + 1 leading zeros
+	def trailing_sums(x):
+		cs = np.concatenate([padding, np.cumsum(x, axis=1)], axis=1)
+		return cs[:, window:-1] - cs[:, :-window - 1]
+
+	n = trailing_sums(present)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean = trailing_sums(values) / n
+		variance = trailing_sums(values * values) / n - mean * mean
+		z = (values - mean) / np.sqrt(np.maximum(variance, 0))
+	spikes = present & (n >= min_periods) & np.isfinite(z) & (np.abs(z) > threshold)
+	rows, columns = np.nonzero(spikes)
+	return rows, columns, z[rows, columns]
+
+
+# Pearson correlation between the coins' series (rows), each pair over the buckets where both have a value.
+# nan where two coins share fewer than min_overlap buckets or one of them doesn't vary.
+def correlation(series, min_overlap=10):
+	present = (~np.isnan(series)).astype(np.float64)
+	x = np.where(present > 0, series, 0.0)
+	n = present @ present.T
+	# sums of each row's values over the buckets where the other row has a value
+	sx = x @ present.T
+	sxx = (x * x) @ present.T
+	sxy = x @ x.T
+	with np.errstate(invalid='ignore', divide='ignore'):
+		covariance = sxy - sx * sx.T / n
+		variance_x = sxx - sx * sx / n
+		variance_y = variance_x.T
+		result = covariance / np.sqrt(variance_x * variance_y)
+	result[(n < min_overlap) | ~np.isfinite(result)] = np.nan
+	return np.clip(result, -1, 1)
@@ -0,0 +1,264 @@
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+from dateutil.parser import parse
+from db.statements import register_statement
+from utils.helper_functions import loginfo
+
+
+# (name, window length, bucket width) in seconds; a coin's rolling value is the sum of the buckets inside the window
+WINDOWS = (
+	('1h', 3600, 60),
+	('24h', 86400, 900),
+	('7d', 604800, 3600)
+)
+# summed per bucket, the weighted ones are multiplied by indicator_certainty
+FIELDS = ('count', 'sentiment', 'movement', 'certainty', 'weighted_sentiment', 'weighted_movement')
+NUM_FIELDS = len(FIELDS)
+
+
+# rss_news_sentiment_rollup (schema.sql) holds the same buckets, bucket_start is utc
+UPSERT_SENTIMENT_ROLLUP = register_statement('upsert_sentiment_rollup', """
+	INSERT INTO rss_news_sentiment_rollup AS r
+	(cmc_id, bucket_seconds, bucket_start, count, sum_sentiment, sum_movement, sum_certainty, sum_weighted_sentiment, sum_weighted_movement)
+	VALUES
+	(:cmc_id, :bucket_seconds, to_timestamp(:bucket_start) AT TIME ZONE 'UTC', :count, :sentiment, :movement, :certainty, :weighted_sentiment, :weighted_movement)
+	ON CONFLICT (cmc_id, bucket_seconds, bucket_start) DO UPDATE SET
+		count = r.count + EXCLUDED.count,
+		sum_sentiment = r.sum_sentiment + EXCLUDED.sum_sentiment,
+		sum_movement = r.sum_movement + EXCLUDED.sum_movement,
+		sum_certainty = r.sum_certainty + EXCLUDED.sum_certainty,
+		sum_weighted_sentiment = r.sum_weighted_sentiment + EXCLUDED.sum_weighted_sentiment,
+		sum_weighted_movement = r.sum_weighted_movement + EXCLUDED.sum_weighted_movement;
+""")
+
+SELECT_SENTIMENT_ROLLUP = register_statement('select_sentiment_rollup', """
+	SELECT cmc_id, bucket_seconds, EXTRACT(EPOCH FROM bucket_start AT TIME ZONE 'UTC')::bigint, count,
+		sum_sentiment, sum_movement, sum_certainty, sum_weighted_sentiment, sum_weighted_movement
+	FROM rss_news_sentiment_rollup
+	WHERE bucket_seconds = :bucket_seconds AND bucket_start > to_timestamp(:cutoff) AT TIME ZONE 'UTC';
+""")
+
+QUERY_ROLLING_SENTIMENT = register_statement('query_rolling_sentiment', """
+	SELECT cmc_id, sum(count), sum(sum_sentiment), sum(sum_movement), sum(sum_certainty), sum(sum_weighted_sentiment), sum(sum_weighted_movement)
+	FROM rss_news_sentiment_rollup
+	WHERE bucket_seconds = :bucket_seconds AND bucket_start > to_timestamp(:cutoff) AT TIME ZONE 'UTC'
+		AND (:coins::text[] IS NULL OR cmc_id = ANY(:coins::text[]))
+	GROUP BY cmc_id;
+""")
+
+# the minute and quarter hour buckets are only needed for their windows, hourly ones are kept as history
+PRUNE_SENTIMENT_ROLLUP = register_statement('prune_sentiment_rollup', """
+	DELETE FROM rss_news_sentiment_rollup
+	WHERE bucket_seconds = :bucket_seconds AND bucket_start <= to_timestamp(:cutoff) AT TIME ZONE 'UTC';
+""", commit=True)
+
+COUNT_SENTIMENT_ROLLUP = register_statement('count_sentiment_rollup', "SELECT count(*) FROM rss_news_sentiment_rollup;")
+
+# one off, for a database that has sentiments but no rollups yet (the same buckets as WINDOWS, without the ones
+# that are already out of their window)
+REBUILD_SENTIMENT_ROLLUP = register_statement('rebuild_sentiment_rollup', """
+	INSERT INTO rss_news_sentiment_rollup
+	(cmc_id, bucket_seconds, bucket_start, count, sum_sentiment, sum_movement, sum_certainty, sum_weighted_sentiment, sum_weighted_movement)
+	SELECT best_match_cmc_id, :bucket_seconds::int,
+		to_timestamp(floor(EXTRACT(EPOCH FROM sentiment_timestamp AT TIME ZONE 'UTC') / :bucket_seconds::int) * :bucket_seconds::int) AT TIME ZONE 'UTC' AS bucket,
+		count(*), sum(sentiment_score), sum(movement_score), sum(indicator_certainty),
+		sum(indicator_certainty * sentiment_score), sum(indicator_certainty * movement_score)
+	FROM rss_news_sentiment
+	WHERE best_match_cmc_id IS NOT NULL AND sentiment_timestamp > to_timestamp(:cutoff) AT TIME ZONE 'UTC'
+	GROUP BY best_match_cmc_id, bucket
+	ON CONFLICT DO NOTHING;
+""")
+
+
+def to_epoch(value):
+	# sentiment_timestamp is the article's published date: a datetime (naive ones are utc, like the database column),
+	# a string from the cryptopanic api, or missing
+	if isinstance(value, str):
+		try:
+			value = parse(value)
+		except (ValueError, OverflowError):
+			value = None
+	if isinstance(value, datetime):
+		if value.tzinfo is None:
+			value = value.replace(tzinfo=timezone.utc)
+		return value.timestamp()
+	return time.time()
+
+
+def summarize(sums):
+	count, sentiment, movement, certainty, weighted_sentiment, weighted_movement = sums
+	return {
+		'count': int(count),
+		'mean_sentiment': sentiment / count if count else None,
+		'mean_movement': movement / count if count else None,
+		'mean_certainty': certainty / count if count else None,
+		'weighted_sentiment': weighted_sentiment / certainty if certainty else None,
+		'weighted_movement': weighted_movement / certainty if certainty else None
+	}
+
+
+# One coin's buckets for one window. Bucket n (n = timestamp // bucket_seconds) lives in slot n % size; a slot still
+# holding an older bucket is out of the window, it is zeroed when reused and skipped when summing.
+class BucketRing:
+	def __init__(self, window_seconds, bucket_seconds):
+		self.bucket_seconds = bucket_seconds
+		self.size = window_seconds // bucket_seconds
+		self.buckets = array('q', [-1]) * self.size
+		self.sums = array('d', [0.0]) * (self.size * NUM_FIELDS)
+
+	def in_window(self, bucket, now_bucket):
+		return now_bucket - self.size < bucket <= now_bucket
+
+	def add(self, bucket, values, replace=False):
+		slot = bucket % self.size
+		offset = slot * NUM_FIELDS
+		if self.buckets[slot] != bucket:
+			if self.buckets[slot] > bucket:
+				return
+			self.buckets[slot] = bucket
+			replace = True
+		for i in range(NUM_FIELDS):
+			self.sums[offset + i] = values[i] if replace else self.sums[offset + i] + values[i]
+
+	def totals(self, now_bucket):
+		totals = [0.0] * NUM_FIELDS
+		for slot in range(self.size):
+			if self.in_window(self.buckets[slot], now_bucket):
+				offset = slot * NUM_FIELDS
+				for i in range(NUM_FIELDS):
+					totals[i] += self.sums[offset + i]
+		return totals
+
+
+# The rolling sentiment per coin (best_match_cmc_id) over each of WINDOWS, updated as sentiments are stored instead of
+# re-scanning rss_news_sentiment. The buckets are also upserted into rss_news_sentiment_rollup in the same
+# transaction as the sentiments (rollup_rows), and loaded back from there on startup.
+class RollingAggregates:
+	def __init__(self, windows=WINDOWS):
+		self.windows = windows
+		# coin -> [BucketRing per window]
+		self.coins = {}
+		self.last_updated = {}
+		self.lock = threading.Lock()
+
+	def ring(self, coin, index):
+		rings = self.coins.get(coin)
+		if rings is None:
+			rings = self.coins[coin] = [BucketRing(window, bucket) for name, window, bucket in self.windows]
+		return rings[index]
+
+	# the (coin, timestamp, values) of the sentiments that count towards the aggregates
+	def contributions(self, sentiments, now=None):
+		now = now or time.time()
+		result = []
+		for s in sentiments:
+			if s.best_match_cmc_id is None or s.sentiment_score is None or s.movement_score is None or s.indicator_certainty is None:
+				continue
+			timestamp = min(to_epoch(s.sentiment_timestamp), now)
+			certainty = s.indicator_certainty
+			values = (1, s.sentiment_score, s.movement_score, certainty, certainty * s.sentiment_score, certainty * s.movement_score)
+			result.append((str(s.best_match_cmc_id), timestamp, values))
+		return result
+
+	# rows for UPSERT_SENTIMENT_ROLLUP, sorted so concurrent transactions lock the rows in the same order
+	def rollup_rows(self, contributions, now=None):
+		now = now or time.time()
+		merged = {}
+		for coin, timestamp, values in contributions:
+			for name, window, bucket_seconds in self.windows:
+				bucket = int(timestamp // bucket_seconds)
+				if bucket <= int(now // bucket_seconds) - window // bucket_seconds:
+					continue
+				sums = merged.setdefault((coin, bucket_seconds, bucket * bucket_seconds), [0.0] * NUM_FIELDS)
+				for i in range(NUM_FIELDS):
+					sums[i] += values[i]
+		return [
+			{'cmc_id': coin, 'bucket_seconds': bucket_seconds, 'bucket_start': bucket_start, **dict(zip(FIELDS, sums))}
+			for (coin, bucket_seconds, bucket_start), sums in sorted(merged.items())
+		]
+
+	# once the rows have been committed; returns the coins that changed
+	def add(self, contributions, now=None):
+		now = now or time.time()
+		changed = set()
+		with self.lock:
+			for coin, timestamp, values in contributions:
+				for index, (name, window, bucket_seconds) in enumerate(self.windows):
+					ring = self.ring(coin, index)
+					bucket = int(timestamp // bucket_seconds)
+					if ring.in_window(bucket, int(now // bucket_seconds)):
+						ring.add(bucket, values)
+						changed.add(coin)
+				self.last_updated[coin] = max(self.last_updated.get(coin, 0), timestamp)
+		return changed
+
+	# {coin: {window name: summarize(...)}}, every coin when coins is None
+	def snapshot(self, coins=None, now=None):
+		now = now or time.time()
+		with self.lock:
+			self.evict(now)
+			result = {}
+			for coin in (self.coins if coins is None else [str(c) for c in coins if str(c) in self.coins]):
+				result[coin] = {
+					name: summarize(ring.totals(int(now // bucket_seconds)))
+					for ring, (name, window, bucket_seconds) in zip(self.coins[coin], self.windows)
+				}
+			return result
+
+	# coins with nothing left in any window are dropped
+	def evict(self, now):
+		longest = max(window for name, window, bucket_seconds in self.windows)
+		for coin in [coin for coin, updated in self.last_updated.items() if updated <= now - longest]:
+			del self.coins[coin]
+			del self.last_updated[coin]
+
+	# fills the buckets from rss_news_sentiment_rollup, which is rebuilt from rss_news_sentiment first if it is empty
+	def load(self, conn, now=None):
+		now = now or time.time()
+		if not conn.execute_statement(COUNT_SENTIMENT_ROLLUP)[0][0]:
+			def rebuild(tx):
+				for name, window, bucket_seconds in self.windows:
+					tx.execute_statement(REBUILD_SENTIMENT_ROLLUP, {'bucket_seconds': bucket_seconds, 'cutoff': window_cutoff(window, bucket_seconds, now)})
+			conn.execute_transaction(rebuild)
+			loginfo('Rebuilt rss_news_sentiment_rollup from rss_news_sentiment')
+		rows = 0
+		with self.lock:
+			for index, (name, window, bucket_seconds) in enumerate(self.windows):
+				for cmc_id, row_bucket_seconds, bucket_start, *values in conn.execute_statement(SELECT_SENTIMENT_ROLLUP, {'bucket_seconds': bucket_seconds, 'cutoff': window_cutoff(window, bucket_seconds, now)}):
+					self.ring(cmc_id, index).add(bucket_start // bucket_seconds, values, replace=True)
+					self.last_updated[cmc_id] = max(self.last_updated.get(cmc_id, 0), bucket_start)
+					rows += 1
+		loginfo(f'Rolling aggregates loaded {rows} buckets for {len(self.coins)} coins')
+
+	def prune(self, conn, now=None):
+		now = now or time.time()
+		for name, window, bucket_seconds in self.windows[:-1]:
+			conn.execute_statement(PRUNE_SENTIMENT_ROLLUP, {'bucket_seconds': bucket_seconds, 'cutoff': window_cutoff(window, bucket_seconds, now)})
+
+	def stats(self):
+		with self.lock:
+			return {'coins': len(self.coins)}
+
+
+# start of the oldest bucket that is no longer in the window (buckets after it are in)
+def window_cutoff(window_seconds, bucket_seconds, now):
+	return (int(now // bucket_seconds) - window_seconds // bucket_seconds) * bucket_seconds
+
+
+# the same rolling values straight from rss_news_sentiment_rollup, for code that doesn't run in the pipeline
+# process: {coin: summarize(...)} for one of the WINDOWS names
+def query_rolling_sentiment(conn, window='24h', coins=None, now=None):
+	now = now or time.time()
+	for name, window_seconds, bucket_seconds in WINDOWS:
+		if name == window:
+			break
+	else:
+		raise ValueError(f'unknown window {window!r}')
+	rows = conn.execute_statement(QUERY_ROLLING_SENTIMENT, {
+		'bucket_seconds': bucket_seconds,
+		'cutoff': window_cutoff(window_seconds, bucket_seconds, now),
+		'coins': [str(c) for c in coins] if coins is not None else None
+	})
+	return {row[0]: summarize(row[1:]) for row in rows}
@@ -0,0 +1,93 @@
+# Benchmark of analytics/history.py on a synthetic sentiment history (default 10M rows, ~2000 coins over a year,
+# a few coins getting most of the news): hourly resampling, per coin weighted averages, z-score spikes and the
+# correlation between the busiest coins, against the row by row python loop the same resample used to be.
+#
+# --from-db also times streaming the real history out of postgres (POSTGRESQL_* from the env file).
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_analytics [--rows 10000000] [--coins 2000] [--days 365] [--baseline-rows 1000000]
+import argparse
+import os
+import time
+from collections import defaultdict
+import numpy as np
+from analytics.history import SentimentHistory, load_sentiment_history, resample, weighted_average, zscore_spikes, correlation
+
+
+def synthetic_history(rows, coins, days, seed=0):
+	rng = np.random.default_rng(seed)
+	now = time.time()
+	popularity = rng.zipf(1.5, coins).astype(np.float64)
+	popularity /= popularity.sum()
+	return SentimentHistory(
+		np.sort(rng.uniform(now - days * 86400, now, rows)),
+		rng.choice(coins, rows, p=popularity).astype(np.int32),
+		np.array([str(i + 1) for i in range(coins)], dtype=object),
+		rng.integers(-10, 11, rows).astype(np.float32),
+		rng.integers(-10, 11, rows).astype(np.float32),
+		rng.integers(0, 11, rows).astype(np.float32),
+		rng.integers(0, 11, rows).astype(np.float32),
+		np.arange(rows, dtype=np.int64) // 3
+	)
+
+
+# what callers did before: iterate the rows and accumulate per (coin, bucket) in dicts
+def row_by_row_resample(rows, bucket_seconds):
+	sums = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+	for timestamp, coin, sentiment, certainty in rows:
+		s = sums[(coin, int(timestamp // bucket_seconds))]
+		s[0] += 1
+		s[1] += sentiment
+		s[2] += certainty * sentiment
+		s[3] += certainty
+	return {key: (s[1] / s[0], s[2] / s[3] if s[3] else None) for key, s in sums.items()}
+
+
+def timed(label, fn, rows=None):
+	start = time.perf_counter()
+	result = fn()
+	elapsed = time.perf_counter() - start
+	rate = f', {rows / elapsed / 1e6:.1f}M rows/s' if rows else ''
+	print(f'{label:>36}: {elapsed * 1000:9.1f} ms{rate}')
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--rows', type=int, default=10000000)
+	parser.add_argument('--coins', type=int, default=2000)
+	parser.add_argument('--days', type=int, default=365)
+	parser.add_argument('--baseline-rows', type=int, default=1000000, help='rows for the (slow) row by row baseline')
+	parser.add_argument('--top', type=int, default=200, help='busiest coins to correlate')
+	parser.add_argument('--from-db', action='store_true')
+	args = parser.parse_args()
+
+	history = timed(f'generate {args.rows} rows', lambda: synthetic_history(args.rows, args.coins, args.days))
+	print(f'{"":>36}  {history.memory_bytes() / 1e6:.0f} MB of columns')
+
+	baseline = history.select(slice(0, args.baseline_rows))
+	rows = list(zip(baseline.timestamp.tolist(), baseline.coin.tolist(), baseline.sentiment.tolist(), baseline.certainty.tolist()))
+	timed(f'row by row hourly resample ({len(rows)})', lambda: row_by_row_resample(rows, 3600), len(rows))
+	timed(f'vectorized hourly resample ({len(rows)})', lambda: resample(baseline, 3600), len(rows))
+
+	hourly = timed(f'hourly resample ({len(history)})', lambda: resample(history, 3600), len(history))
+	daily = timed('daily resample, impact weighted', lambda: resample(history, 86400, weight='certainty_impact'), len(history))
+	timed('weighted sentiment per coin', lambda: weighted_average(history.sentiment, history.certainty, history.coin, len(history.coin_ids)), len(history))
+	spikes = timed('z-score spikes (hourly volume, 24h)', lambda: zscore_spikes(np.where(hourly.count > 0, hourly.count, np.nan).astype(np.float64), 24, 4.0))
+	print(f'{"":>36}  {len(spikes[0])} spikes over {hourly.count.shape[0]} coins x {hourly.count.shape[1]} buckets')
+	busiest = np.argsort(-hourly.count.sum(axis=1))[:args.top]
+	matrix = timed(f'correlation of the {len(busiest)} busiest (daily)', lambda: correlation(daily.weighted_sentiment[busiest]))
+	print(f'{"":>36}  {np.count_nonzero(~np.isnan(matrix))} correlated pairs')
+
+	if args.from_db:
+		from dotenv import load_dotenv
+		from db.db import Database
+		load_dotenv()
+		conn = Database(os.getenv("POSTGRESQL_HOST"), int(os.getenv("POSTGRESQL_PORT")), os.getenv("POSTGRESQL_DB"), os.getenv("POSTGRESQL_USER"), os.getenv("POSTGRESQL_PW"))
+		loaded = timed('stream history from postgres', lambda: load_sentiment_history(conn))
+		print(f'{"":>36}  {len(loaded)} rows, {len(loaded.coin_ids)} coins')
+		conn.close_connection()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,105 @@
+# Benchmark: serial feed download (the old check_feeds loop) vs FeedFetcher
+# Serves a small rss document from several local stub hosts with injected latency.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_feed_fetch [--feeds 60] [--hosts 12] [--latency 0.5] [--slow 3] [--slow-latency 8]
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from feeds.fetcher import FeedFetcher
+
+RSS_ITEM = """<item><title>Bitcoin news item {i}</title><link>https://example.com/{i}</link>
+<pubDate>Fri, 07 Jul 2023 10:00:00 GMT</pubDate><description><![CDATA[<p>Some <b>description</b> {i}</p>]]></description></item>"""
+RSS_DOC = ('<?xml version="1.0"?><rss version="2.0"><channel><title>stub</title>' + ''.join(RSS_ITEM.format(i=i) for i in range(20)) + '</channel></rss>').encode()
+
+
+class StubFeedHandler(BaseHTTPRequestHandler):
+	# per path latency, filled in by the benchmark
+	latencies = {}
+
+	def do_GET(self):
+		time.sleep(self.latencies.get(self.path, 0))
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/rss+xml')
+		self.send_header('Content-Length', str(len(RSS_DOC)))
+		self.end_headers()
+		try:
+			self.wfile.write(RSS_DOC)
+		except (BrokenPipeError, ConnectionResetError):
+			# the client gave up (e.g. the fetcher's deadline passed)
+			pass
+
+	def log_message(self, *args):
+		pass
+
+
+def start_stub_hosts(n_hosts):
+	servers = []
+	for _ in range(n_hosts):
+		server = ThreadingHTTPServer(('127.0.0.1', 0), StubFeedHandler)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		servers.append(server)
+	return servers
+
+
+def fetch_serial(urls, timeout):
+	start = time.time()
+	ok = 0
+	for url in dict.fromkeys(urls):
+		try:
+			requests.get(url, timeout=timeout).content
+			ok += 1
+		except Exception:
+			pass
+	return ok, time.time() - start
+
+
+def fetch_concurrent(urls, fetcher):
+	start = time.time()
+	results = fetcher.fetch_all(urls)
+	ok = sum(1 for r in results.values() if not r['error'])
+	return ok, time.time() - start
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--feeds', type=int, default=60)
+	parser.add_argument('--hosts', type=int, default=12)
+	parser.add_argument('--latency', type=float, default=0.5, help='mean latency (s) of a normal feed')
+	parser.add_argument('--slow', type=int, default=3, help='number of feeds that are very slow')
+	parser.add_argument('--slow-latency', type=float, default=8)
+	parser.add_argument('--timeout', type=float, default=30)
+	parser.add_argument('--deadline', type=float, default=20)
+	parser.add_argument('--workers', type=int, default=16)
+	parser.add_argument('--per-host', type=int, default=2)
+	args = parser.parse_args()
+
+	random.seed(1)
+	servers = start_stub_hosts(args.hosts)
+	urls = []
+	for i in range(args.feeds):
+		server = servers[i % len(servers)]
+		path = f'/feed/{i}'
+		if i < args.slow:
+			StubFeedHandler.latencies[path] = args.slow_latency
+		else:
+			StubFeedHandler.latencies[path] = random.uniform(0, 2 * args.latency)
+		urls.append(f'http://127.0.0.1:{server.server_address[1]}{path}')
+
+	ok, elapsed = fetch_serial(urls, args.timeout)
+	print(f'serial:     {ok}/{len(urls)} feeds in {elapsed:.2f}s')
+
+	fetcher = FeedFetcher(max_workers=args.workers, per_host_limit=args.per_host, timeout=args.timeout, deadline=args.deadline)
+	ok, concurrent_elapsed = fetch_concurrent(urls, fetcher)
+	print(f'concurrent: {ok}/{len(urls)} feeds in {concurrent_elapsed:.2f}s (workers={args.workers}, per_host={args.per_host}, deadline={args.deadline}s)')
+	print(f'speedup:    {elapsed / concurrent_elapsed:.1f}x')
+
+	for server in servers:
+		server.shutdown()
+
+
+if __name__ == '__main__':
+	main()
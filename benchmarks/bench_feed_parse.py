@@ -0,0 +1,53 @@
+# Benchmark of the feed parse stage: feedparser.parse of every feed of a sweep one after the other in the polling
+# thread (before) against FeedProcessPool.parse_all, which parses them in worker processes and only sends back compact
+# entry records. Also shows how much smaller the records are than the FeedParserDicts (pickled).
+#
+# Uses the generated long-form feeds of bench_text_extract, or saved feed files (--fixtures DIR).
+# Parsing scales with the number of cores, so compare --workers 1 with --workers <cores>.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_feed_parse [--fixtures DIR] [--feeds 60] [--entries 20] [--paragraphs 20] [--workers 4]
+import argparse
+import os
+import pickle
+import random
+import time
+import feedparser
+from benchmarks.bench_text_extract import generated_feed
+from feeds.parser import FeedProcessPool
+
+
+def timed(label, fn):
+	start = time.perf_counter()
+	result = fn()
+	print(f'{label:>26}: {time.perf_counter() - start:6.2f}s')
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--fixtures', help='directory of saved feed files')
+	parser.add_argument('--feeds', type=int, default=60)
+	parser.add_argument('--entries', type=int, default=20, help='entries per generated feed')
+	parser.add_argument('--paragraphs', type=int, default=20, help='paragraphs per generated article')
+	parser.add_argument('--workers', type=int, default=os.cpu_count())
+	args = parser.parse_args()
+
+	if args.fixtures:
+		contents = {name: open(os.path.join(args.fixtures, name), 'rb').read() for name in sorted(os.listdir(args.fixtures))}
+	else:
+		rng = random.Random(0)
+		contents = {f'feed{i}': generated_feed(rng, args.entries, args.paragraphs) for i in range(args.feeds)}
+	print(f'{len(contents)} feeds, {sum(len(c) for c in contents.values()) / 1e6:.1f} MB of feed xml, {os.cpu_count()} cores')
+
+	parsed = timed('feedparser in thread', lambda: {key: feedparser.parse(content).entries for key, content in contents.items()})
+	for workers in sorted({1, args.workers}):
+		pool = FeedProcessPool(workers)
+		pool.start()
+		records = timed(f'parse_all, {workers} processes', lambda: dict(pool.parse_all(contents)))
+		pool.shutdown()
+	print(f'{"":>26}  pickled entries: FeedParserDict {len(pickle.dumps(parsed)) / 1e6:.1f} MB, records {len(pickle.dumps(records)) / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+	main()
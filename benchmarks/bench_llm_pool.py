@@ -0,0 +1,69 @@
+# Benchmark: articles per second through the completion api, one worker (the old inline behaviour) vs several
+# enrichment worker threads taking articles from a shared queue (like the ones leasing from pending_articles),
+# against the local fake completion server. Each article makes two calls like process_article does.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_llm_pool [--articles 40] [--workers 8] [--latency 1.0] [--server-rpm 200] [--rpm 150]
+import argparse
+import os
+import queue
+import threading
+import time
+from benchmarks.fake_completion_server import start_fake_completion_server, FakeCompletionHandler
+
+
+def run(articles, workers, do_chat_completion):
+	pending = queue.Queue()
+	for i in range(articles):
+		pending.put(f'Bitcoin news article {i} ' * 50)
+
+	def worker():
+		while True:
+			try:
+				article = pending.get_nowait()
+			except queue.Empty:
+				return
+			do_chat_completion('You are chatgpt, an expert crypto article summariser.\n<NEWS_ITEM>', article, '<NEWS_ITEM>', 800, 5)
+			do_chat_completion('You are chatgpt, an expert in semantic analysis.\n<NEWS_ITEM>', article, '<NEWS_ITEM>', 800, 5)
+
+	threads = [threading.Thread(target=worker) for i in range(workers)]
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return time.time() - start
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--articles', type=int, default=40)
+	parser.add_argument('--workers', type=int, default=8)
+	parser.add_argument('--latency', type=float, default=1.0)
+	parser.add_argument('--server-rpm', type=int, default=200, help='rpm at which the fake server starts answering 429')
+	parser.add_argument('--rpm', type=int, default=150, help='OPENAI_REQUESTS_PER_MINUTE for the client side limiter')
+	parser.add_argument('--tpm', type=int, default=200000)
+	args = parser.parse_args()
+
+	server = start_fake_completion_server(0, args.latency, args.server_rpm)
+	os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{server.server_address[1]}/v1'
+	os.environ['OPENAI_API_KEY'] = 'fake'
+	os.environ['OPENAI_REQUESTS_PER_MINUTE'] = str(args.rpm)
+	os.environ['OPENAI_TOKENS_PER_MINUTE'] = str(args.tpm)
+	# every pass sends the same articles, with the response cache on they would all be cache hits after the first
+	os.environ['LLM_CACHE_PATH'] = ''
+	import openai
+	openai.api_base = os.environ['OPENAI_API_BASE']
+	from openai_functions.openai import do_chat_completion, rate_limiter
+
+	for workers in (1, args.workers):
+		FakeCompletionHandler.recent.clear()
+		elapsed = run(args.articles, workers, do_chat_completion)
+		print(f'workers={workers}: {args.articles} articles in {elapsed:.1f}s ({args.articles / elapsed:.2f} articles/s)')
+	print('server:', FakeCompletionHandler.counters)
+	print('limiter:', rate_limiter.stats())
+	server.shutdown()
+
+
+if __name__ == '__main__':
+	main()
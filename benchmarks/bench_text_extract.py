@@ -0,0 +1,109 @@
+# Benchmark of the entry text extraction in check_feeds: the previous version (two BeautifulSoup trees per entry, one of
+# them over json.dumps(entry.content)) against feeds/text_extract.py, in process and in worker processes.
+#
+# Runs on saved feed files (--fixtures DIR, every file in it is parsed with feedparser), or on generated long-form
+# feeds (Forbes / Medium / substack sized articles: tens of paragraphs, figures, embedded scripts) by default.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_text_extract [--fixtures DIR] [--feeds 20] [--entries 20] [--paragraphs 80] [--workers 2]
+import argparse
+import json
+import os
+import random
+import string
+import time
+import tracemalloc
+import feedparser
+from bs4 import BeautifulSoup
+from feeds.parser import FeedProcessPool, entry_record
+from feeds.text_extract import extract_batch, raw_entry
+
+WORDS = 'bitcoin ethereum price rally market token exchange defi liquidity whale the of and to in regulators ETF approval'.split()
+
+
+def paragraph(rng):
+	words = [rng.choice(WORDS) for i in range(rng.randint(40, 120))]
+	words[rng.randrange(len(words))] = f'<a href="https://example.com/{rng.randrange(10 ** 6)}">{rng.choice(WORDS)}</a>'
+	words[rng.randrange(len(words))] = f'<strong>{rng.choice(WORDS)}</strong>'
+	return '<p>' + ' '.join(words) + '</p>'
+
+
+def long_form_html(rng, paragraphs):
+	parts = ['<div class="article-body">']
+	for i in range(paragraphs):
+		parts.append(paragraph(rng))
+		if i % 10 == 5:
+			parts.append(f'<figure><img src="https://example.com/{i}.jpg" alt="chart"/><figcaption>{rng.choice(WORDS)} chart</figcaption></figure>')
+		if i % 25 == 10:
+			parts.append('<script type="text/javascript">window.ads = window.ads || []; ads.push({slot: "' + ''.join(rng.choices(string.ascii_letters, k=200)) + '"});</script>')
+	parts.append('</div>')
+	return ''.join(parts)
+
+
+def generated_feed(rng, entries, paragraphs):
+	items = []
+	for i in range(entries):
+		content = long_form_html(rng, paragraphs)
+		items.append(f'''<item><title>Article {i}</title><link>https://example.com/article/{rng.randrange(10 ** 9)}</link>
+<pubDate>Mon, 03 Jul 2023 12:00:00 +0000</pubDate>
+<description><![CDATA[{paragraph(rng)}]]></description>
+<content:encoded><![CDATA[{content}]]></content:encoded></item>''')
+	return f'''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"><channel><title>bench</title>{''.join(items)}</channel></rss>'''.encode()
+
+
+# what check_feeds did per entry before
+def legacy_entry_texts(entry):
+	description_text = BeautifulSoup(entry.description, features="html.parser").get_text()
+	try:
+		content_json = json.dumps(entry.content)
+	except Exception:
+		content_json = ""
+	content_text = BeautifulSoup(content_json, features="html.parser").get_text()
+	return description_text, content_text
+
+
+# timed without tracemalloc (it slows python code down a lot), then run again to get the peak memory
+def measure(label, fn, entries):
+	start = time.perf_counter()
+	fn()
+	elapsed = time.perf_counter() - start
+	tracemalloc.start()
+	fn()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	print(f'{label:>28}: {elapsed:7.2f}s, {entries / elapsed:7.1f} entries/s, peak python memory {peak / 1e6:6.1f} MB')
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--fixtures', help='directory of saved feed files')
+	parser.add_argument('--feeds', type=int, default=20)
+	parser.add_argument('--entries', type=int, default=20, help='entries per generated feed')
+	parser.add_argument('--paragraphs', type=int, default=80, help='paragraphs per generated article')
+	parser.add_argument('--workers', type=int, default=2)
+	parser.add_argument('--max-chars', type=int, default=120000)
+	args = parser.parse_args()
+
+	if args.fixtures:
+		raw_feeds = [open(os.path.join(args.fixtures, name), 'rb').read() for name in sorted(os.listdir(args.fixtures))]
+	else:
+		rng = random.Random(0)
+		raw_feeds = [generated_feed(rng, args.entries, args.paragraphs) for i in range(args.feeds)]
+	feeds = [feedparser.parse(raw).entries for raw in raw_feeds]
+	entries = sum(len(f) for f in feeds)
+	size = sum(len(raw) for raw in raw_feeds)
+	print(f'{len(feeds)} feeds, {entries} entries, {size / 1e6:.1f} MB of feed xml')
+
+	measure('BeautifulSoup x2 (before)', lambda: [[legacy_entry_texts(e) for e in f] for f in feeds], entries)
+	measure('text_extract in process', lambda: [extract_batch([raw_entry(e) for e in f], args.max_chars) for f in feeds], entries)
+	pool = FeedProcessPool(args.workers, args.max_chars)
+	pool.start()
+	records = [[entry_record(e) for e in f] for f in feeds]
+	# tracemalloc only sees this process, the parsing happens in the workers
+	measure(f'text_extract, {args.workers} processes', lambda: [pool.extract_texts(f) for f in records], entries)
+	pool.shutdown()
+
+
+if __name__ == '__main__':
+	main()
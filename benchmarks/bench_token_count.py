@@ -0,0 +1,82 @@
+# Micro benchmark: token counting / truncation of large synthetic articles,
+# the previous implementation (encoder looked up per call, binary search over full re-encodes) vs the current one.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_token_count [--sizes 20000,200000,1000000]
+import argparse
+import random
+import time
+import tiktoken
+from openai_functions.openai import num_tokens_from_text, trim_text_to_token_limit
+
+PROMPT = 'You are chatgpt, an expert crypto article summariser.\n\n<NEWS_ITEM>\n[END ARTICLE]\n\nGive your answer in valid json.'
+WORDS = 'bitcoin ethereum price rally market token exchange defi liquidity whale the of and to in regulators ETF approval €uro ₿'.split()
+
+
+def legacy_num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
+	try:
+		encoding = tiktoken.encoding_for_model(model)
+	except KeyError:
+		encoding = tiktoken.get_encoding("cl100k_base")
+	return len(encoding.encode(text)) + 7
+
+
+def legacy_trim_text_to_token_limit(text, max_tokens, target_tokens, tolerance=0.05, prompt=None, insertion_key=None):
+	lower_bound = 0
+	upper_bound = len(prompt.replace(insertion_key, text) if prompt else text)
+	while lower_bound < upper_bound:
+		mid = (lower_bound + upper_bound) // 2
+		this_text_truncated = prompt.replace(insertion_key, text[:mid]) if prompt else text[:mid]
+		current_tokens = legacy_num_tokens_from_text(this_text_truncated)
+		if target_tokens * (1 - tolerance) <= current_tokens <= max_tokens:
+			return text[:mid]
+		if current_tokens < target_tokens * (1 - tolerance):
+			lower_bound = mid + 1
+		else:
+			upper_bound = mid - 1
+	return text[:lower_bound]
+
+
+def synthetic_article(n_chars):
+	random.seed(n_chars)
+	words = []
+	length = 0
+	while length < n_chars:
+		word = random.choice(WORDS)
+		words.append(word)
+		length += len(word) + 1
+	return ' '.join(words)
+
+
+def timed(fn, *args, repeat=3, **kwargs):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = fn(*args, **kwargs)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return result, best
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes', default='20000,200000,1000000')
+	parser.add_argument('--limit', type=int, default=15540)
+	args = parser.parse_args()
+
+	short_text = synthetic_article(500)
+	_, legacy = timed(lambda: [legacy_num_tokens_from_text(short_text) for _ in range(1000)])
+	_, current = timed(lambda: [num_tokens_from_text(short_text) for _ in range(1000)])
+	print(f'count 1000 short prompts: legacy {legacy * 1000:.1f}ms, current {current * 1000:.1f}ms')
+
+	for size in (int(s) for s in args.sizes.split(',')):
+		text = synthetic_article(size)
+		legacy_result, legacy = timed(legacy_trim_text_to_token_limit, text, args.limit, args.limit, prompt=PROMPT, insertion_key='<NEWS_ITEM>', repeat=1)
+		result, current = timed(trim_text_to_token_limit, text, args.limit, args.limit, prompt=PROMPT, insertion_key='<NEWS_ITEM>')
+		legacy_tokens = num_tokens_from_text(PROMPT.replace('<NEWS_ITEM>', legacy_result))
+		tokens = num_tokens_from_text(PROMPT.replace('<NEWS_ITEM>', result))
+		print(f'trim {size} chars to {args.limit} tokens: legacy {legacy * 1000:.1f}ms ({legacy_tokens} tokens), current {current * 1000:.1f}ms ({tokens} tokens), {legacy / current:.1f}x')
+
+
+if __name__ == '__main__':
+	main()
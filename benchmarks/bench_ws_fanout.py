@@ -0,0 +1,212 @@
+# Websocket fan out load test: hundreds of local clients, a few of which read slowly, receive a stream of published
+# messages. Compares the old delivery loop (poll a queue.Queue every 100ms, await each client's send in turn) with
+# ws_server's Broadcaster (per client queues and writer tasks).
+#
+# --variant / --encoding / --compression show what the slim variant, binary encodings and permessage-deflate do to egress.
+#
+# usage (from the repo root):
+#   python -m benchmarks.bench_ws_fanout [--clients 300] [--slow 5] [--messages 100] [--rate 5] [--size 4000]
+# server and clients share one process, so keep clients * rate * size within what one core can push (and deflate)
+import argparse
+import asyncio
+import json
+import logging
+import queue
+import random
+import socket
+import statistics
+import string
+import threading
+import time
+import websockets
+import ws_server.ws_server as ws_server
+from ws_server.broadcaster import Broadcaster
+from ws_server.encoding import msgpack, orjson
+
+SECRET = 'bench'
+SEND_BUFFER = 16384
+
+
+# the delivery loop ws_server used before the Broadcaster, with the same publish()/serve() interface
+class LegacyBroadcaster:
+	def __init__(self):
+		self.message_queue = queue.Queue()
+		self.connected_clients = set()
+
+	def attach(self, loop):
+		if loop:
+			loop.create_task(self.handle_message_queue())
+
+	def publish(self, event_type, data):
+		self.message_queue.put(json.dumps({'type': event_type, 'data': data}))
+
+	async def handle_message_queue(self):
+		while True:
+			while not self.message_queue.empty():
+				message = self.message_queue.get()
+				for client in list(self.connected_clients):
+					try:
+						await client.send(message)
+					except websockets.exceptions.ConnectionClosed:
+						self.connected_clients.discard(client)
+			await asyncio.sleep(0.1)
+
+	async def serve(self, websocket):
+		self.connected_clients.add(websocket)
+		await websocket.wait_closed()
+		self.connected_clients.discard(websocket)
+
+	def stats(self, per_client=False):
+		return {'clients': len(self.connected_clients)}
+
+
+def run_loop_in_thread():
+	loop = asyncio.new_event_loop()
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+	return loop
+
+
+def start_server(broadcaster, compression):
+	ws_server.broadcaster = broadcaster
+	ws_server.WS_SHARED_SECRET = SECRET
+	loop = run_loop_in_thread()
+
+	# small kernel send buffers, like a client on a slow link: otherwise loopback soaks up megabytes before a slow reader
+	# pushes back on the server at all
+	async def handler(websocket, path):
+		websocket.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+		await ws_server.handle_client(websocket, path)
+
+	async def start():
+		broadcaster.attach(asyncio.get_running_loop())
+		return await websockets.serve(handler, '127.0.0.1', 0, max_size=None, compression=compression)
+
+	server = asyncio.run_coroutine_threadsafe(start(), loop).result()
+	return loop, server, server.sockets[0].getsockname()[1]
+
+
+def decode(message, encoding):
+	if encoding == 'msgpack':
+		return msgpack.unpackb(message)
+	if encoding == 'orjson':
+		return orjson.loads(message)
+	return json.loads(message)
+
+
+async def client(port, expected, slow_delay, latencies, done, options):
+	connect_options = {}
+	if slow_delay:
+		# small buffers so a slow reader pushes back on the server quickly instead of the kernel soaking up megabytes
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+		sock.connect(('127.0.0.1', port))
+		connect_options = {'sock': sock, 'max_queue': 1, 'read_limit': 4096}
+	async with websockets.connect(f'ws://127.0.0.1:{port}', max_size=None, compression=options['compression'], **connect_options) as websocket:
+		await websocket.send(SECRET)
+		if options['variant'] != 'full' or options['encoding'] != 'json':
+			await websocket.send(json.dumps({'type': 'options', 'variant': options['variant'], 'encoding': options['encoding']}))
+			# the acknowledgement comes back in the new encoding
+			decode(await websocket.recv(), options['encoding'])
+		done['connected'] += 1
+		received = 0
+		try:
+			while received < expected:
+				message = await asyncio.wait_for(websocket.recv(), timeout=60)
+				received += 1
+				if slow_delay:
+					await asyncio.sleep(slow_delay)
+				else:
+					latencies.append(time.time() - decode(message, options['encoding'])['data']['t'])
+		except asyncio.TimeoutError:
+			pass
+		done['received'] += received
+		if not slow_delay:
+			done['fast_finished'] = time.time()
+
+
+async def stop_server(server):
+	server.close()
+	# closing handshakes with the slow clients wait behind their full buffers, don't hang on those
+	try:
+		await asyncio.wait_for(server.wait_closed(), timeout=15)
+	except asyncio.TimeoutError:
+		pass
+
+
+def run(mode, args):
+	broadcaster = LegacyBroadcaster() if mode == 'legacy' else Broadcaster(args.queue_size, 'drop_oldest')
+	compression = None if args.compression == 'none' else 'deflate'
+	server_loop, server, port = start_server(broadcaster, compression)
+	# the old loop only ever sent full json
+	options = {'variant': 'full', 'encoding': 'json', 'compression': compression} if mode == 'legacy' else {'variant': args.variant, 'encoding': args.encoding, 'compression': compression}
+	client_loop = run_loop_in_thread()
+	latencies = []
+	done = {'connected': 0, 'received': 0, 'fast_finished': 0}
+	futures = []
+	for i in range(args.clients):
+		slow_delay = args.slow_delay if i < args.slow else 0
+		futures.append(asyncio.run_coroutine_threadsafe(client(port, args.messages, slow_delay, latencies, done, options), client_loop))
+	while done['connected'] < args.clients:
+		time.sleep(0.05)
+	time.sleep(0.5)
+
+	# different random text per message, repeated padding would just compress away (permessage-deflate is on by default)
+	pads = [''.join(random.choices(string.ascii_letters + ' ', k=args.size)) for seq in range(args.messages)]
+	start = time.time()
+	for seq in range(args.messages):
+		broadcaster.publish('newsitem', {
+			't': time.time(),
+			'seq': seq,
+			'title': 'Bitcoin rallies as ETF inflows accelerate',
+			'link': f'https://example.com/news/{seq}',
+			'one_sentence_summary': pads[seq][:150],
+			'two_sentence_summary': pads[seq][:300],
+			'impact_importance': 6,
+			'summary': pads[seq][:500],
+			'description': pads[seq][:300],
+			'content': pads[seq]
+		})
+		time.sleep(1 / args.rate)
+	published = time.time()
+	# fast clients are done once they have everything, don't wait for the slow ones
+	fast = args.clients - args.slow
+	deadline = time.time() + 60
+	while len(latencies) < fast * args.messages and time.time() < deadline:
+		time.sleep(0.05)
+	finished = time.time()
+
+	stats = broadcaster.stats()
+	for future in futures:
+		future.cancel()
+	latencies.sort()
+	print(f'{mode:>12}: {len(latencies)}/{fast * args.messages} messages to fast clients, '
+		f'p50 {round(statistics.median(latencies) * 1000, 1) if latencies else "-"}ms '
+		f'p99 {round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else "-"}ms '
+		f'max {round(latencies[-1] * 1000, 1) if latencies else "-"}ms, '
+		f'all delivered {round(finished - published, 2)}s after the last publish (publishing took {round(published - start, 2)}s)')
+	if mode != 'legacy':
+		print(f'{"":>12}  {stats}')
+	asyncio.run_coroutine_threadsafe(stop_server(server), server_loop).result()
+	server_loop.call_soon_threadsafe(server_loop.stop)
+	client_loop.call_soon_threadsafe(client_loop.stop)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--clients', type=int, default=300)
+	parser.add_argument('--slow', type=int, default=5, help='how many of the clients read slowly')
+	parser.add_argument('--slow-delay', type=float, default=2, help='seconds a slow client waits after each message')
+	parser.add_argument('--messages', type=int, default=100)
+	parser.add_argument('--rate', type=float, default=5, help='messages published per second')
+	parser.add_argument('--size', type=int, default=4000, help='message size in bytes (roughly an event with article content)')
+	parser.add_argument('--queue-size', type=int, default=100, help='per client queue for the broadcaster')
+	parser.add_argument('--mode', choices=['legacy', 'broadcaster', 'both'], default='both')
+	parser.add_argument('--variant', choices=['full', 'slim'], default='full', help='event variant the clients ask for (broadcaster)')
+	parser.add_argument('--encoding', choices=['json', 'msgpack', 'orjson'], default='json', help='encoding the clients ask for (broadcaster)')
+	parser.add_argument('--compression', choices=['deflate', 'none'], default='deflate')
+	args = parser.parse_args()
+	logging.getLogger('my_logger').setLevel(logging.ERROR)
+	print(f'{args.clients} clients ({args.slow} slow), {args.messages} events with {args.size} bytes of content at {args.rate}/s, '
+		f'{args.variant} {args.encoding} frames, compression {args.compression}')
+	for mode in (['legacy', 'broadcaster'] if args.mode == 'both' else [args.mode]):
+		run(mode, args)
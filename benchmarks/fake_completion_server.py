@@ -0,0 +1,110 @@
+# Minimal local stand in for the chat completion api, for benchmarks and manual testing.
+# It answers POST /v1/chat/completions with canned json (a summary object or a sentiment list, depending on the prompt),
+# after an injected latency, and enforces its own requests-per-minute limit by answering 429 with a Retry-After header.
+#
+# usage (from the repo root):
+#   python -m benchmarks.fake_completion_server [--port 8808] [--latency 1.0] [--rpm 120]
+#   OPENAI_API_BASE=http://127.0.0.1:8808/v1 OPENAI_API_KEY=fake python rss_sentiment_analysis.py
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUMMARY_RESPONSE = {
+	"one_sentence_summary": "Bitcoin rallied.",
+	"two_sentence_summary": "Bitcoin rallied. Ethereum followed.",
+	"topic_keywords": "bitcoin, ethereum, rally",
+	"impact_importance": 4,
+	"is_crypto_news": True
+}
+SENTIMENT_RESPONSE = [
+	{"type": "coin", "name": "Bitcoin", "symbol": "BTC", "org_name": "", "sentiment": 6, "movement": 5, "indicator_certainty": 6},
+	{"type": "coin", "name": "Ethereum", "symbol": "ETH", "org_name": "Ethereum Foundation", "sentiment": 4, "movement": 3, "indicator_certainty": 4}
+]
+
+
+def canned_response(prompt):
+	if '"summary": {' in prompt and '"sentiments": [' in prompt:
+		return {'summary': SUMMARY_RESPONSE, 'sentiments': SENTIMENT_RESPONSE}
+	if 'summariser' in prompt:
+		return SUMMARY_RESPONSE
+	return SENTIMENT_RESPONSE
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+	latency = 1.0
+	rpm = 0
+	lock = threading.Lock()
+	recent = deque()
+	counters = {'requests': 0, 'rate_limited': 0}
+
+	def send_json(self, status, body, headers=None):
+		payload = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def over_limit(self):
+		if not self.rpm:
+			return False
+		with self.lock:
+			now = time.time()
+			while self.recent and self.recent[0] < now - 60:
+				self.recent.popleft()
+			if len(self.recent) >= self.rpm:
+				return True
+			self.recent.append(now)
+			return False
+
+	def do_POST(self):
+		request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+		with self.lock:
+			self.counters['requests'] += 1
+		if self.over_limit():
+			with self.lock:
+				self.counters['rate_limited'] += 1
+			self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}, {'Retry-After': '1'})
+			return
+		time.sleep(self.latency)
+		prompt = ''.join(m.get('content', '') for m in request.get('messages', []))
+		content = json.dumps(canned_response(prompt))
+		self.send_json(200, {
+			'id': 'chatcmpl-fake',
+			'object': 'chat.completion',
+			'created': int(time.time()),
+			'model': request.get('model'),
+			'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+			'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4, 'total_tokens': (len(prompt) + len(content)) // 4}
+		})
+
+	def log_message(self, *args):
+		pass
+
+
+def start_fake_completion_server(port=0, latency=1.0, rpm=0):
+	FakeCompletionHandler.latency = latency
+	FakeCompletionHandler.rpm = rpm
+	server = ThreadingHTTPServer(('127.0.0.1', port), FakeCompletionHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--port', type=int, default=8808)
+	parser.add_argument('--latency', type=float, default=1.0)
+	parser.add_argument('--rpm', type=int, default=0, help='requests per minute before answering 429 (0 = unlimited)')
+	args = parser.parse_args()
+	server = start_fake_completion_server(args.port, args.latency, args.rpm)
+	print(f'fake completion api listening on http://127.0.0.1:{server.server_address[1]}/v1')
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		server.shutdown()
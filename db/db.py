@@ -1,56 +1,186 @@
 #from sqlalchemy import create_engine, text
 #from sqlalchemy.exc import StatementError
 import psycopg2
+import psycopg2.extras
 import re
 import time
+import functools
 import threading
-from utils.helper_functions import loginfo, logerror, logdebug
+import queue
+from utils.helper_functions import loginfo, logerror
+
+class DBPoolTimeout(Exception):
+	pass
+
+
+# one checkout of a pooled connection, use as "with dbpool.connection() as conn:"
+# each checkout has its own object so concurrent threads never share (or release) each other's connection
+class PooledConnection:
+	def __init__(self, pool, timeout=None):
+		self.pool = pool
+		self.timeout = timeout
+		self.db = None
+
+	def __enter__(self):
+		self.db = self.pool.get_conn(self.timeout)
+		return self.db
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.pool.release(self.db)
+		self.db = None
+
 
 class DBPool:
-	def __init__(self, host, port, database, user, password, pool_size):
+	def __init__(self, host, port, database, user, password, pool_size, checkout_timeout=60, validate_after=30):
 		self.host = host
 		self.port = port
 		self.database = database
 		self.user = user
 		self.password = password
 		self.pool_size = pool_size
-		self.pool = {}
+		self.checkout_timeout = checkout_timeout
+		# idle connections older than this (seconds) are checked with a round trip before being handed out
+		self.validate_after = validate_after
+		# LIFO so the most recently used (warm) connections are reused first
+		self.idle = queue.LifoQueue()
 		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.checked_out = {}
 
 		for i in range(pool_size):
 			db = Database(host, port, database, user, password)
-			#db.connect()
-			self.pool[i] = {'db': db, 'in_use': False}
+			self.idle.put((db, time.monotonic()))
+
+		self.reset_stats()
 
+	# "with dbpool as conn:" still works, the checkout is kept per thread (and nests)
 	def __enter__(self):
-		self.conn = self.get_conn()
-		return self.conn
+		checkout = PooledConnection(self)
+		if not hasattr(self.local, 'checkouts'):
+			self.local.checkouts = []
+		conn = checkout.__enter__()
+		self.local.checkouts.append(checkout)
+		return conn
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
-		with self.lock:
-			#logdebug('releasing db lock')
-			for conn_id, conn_info in self.pool.items():
-				if conn_info['db'] == self.conn:
-					conn_info['in_use'] = False
-					break
-	
-	def get_conn(self):
-		while True:
+		self.local.checkouts.pop().__exit__(exc_type, exc_val, exc_tb)
+
+	def connection(self, timeout=None):
+		return PooledConnection(self, timeout)
+
+	def get_conn(self, timeout=None):
+		start = time.monotonic()
+		try:
+			db, idle_since = self.idle.get(timeout=timeout or self.checkout_timeout)
+		except queue.Empty:
 			with self.lock:
-					for conn_id, conn_info in self.pool.items():
-						if not conn_info['in_use']:
-							conn_info['in_use'] = True
-							#if conn_info['db'].is_connection_alive():
-							return conn_info['db']
-							#else:
-							#		conn_info['in_use'] = False
-			time.sleep(0.1)
+				self.counters['timeouts'] += 1
+			raise DBPoolTimeout(f'no database connection available after {timeout or self.checkout_timeout}s ({self.pool_size} in pool)')
+		now = time.monotonic()
+		if now - idle_since > self.validate_after and not db.is_connection_alive():
+			logerror('Idle database connection is dead, reconnecting')
+			db.close_connection()
+		with self.lock:
+			waited = now - start
+			self.counters['checkouts'] += 1
+			self.counters['wait_seconds'] += waited
+			self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], waited)
+			self.checked_out[id(db)] = time.monotonic()
+		return db
+
+	def release(self, db):
+		# don't hand the next borrower a connection stuck inside an open or failed transaction
+		try:
+			if db.connection and not db.connection.closed and db.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+				db.connection.rollback()
+		except Exception as e:
+			logerror('! release rollback failed')
+			logerror(e)
+			db.close_connection()
+		with self.lock:
+			checked_out_at = self.checked_out.pop(id(db), None)
+			if checked_out_at is not None:
+				self.counters['busy_seconds'] += time.monotonic() - checked_out_at
+		self.idle.put((db, time.monotonic()))
+
+	def reset_stats(self):
+		with self.lock:
+			self.counters = {'checkouts': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'busy_seconds': 0.0}
+			self.stats_since = time.monotonic()
+
+	def stats(self, reset=False):
+		with self.lock:
+			counters = dict(self.counters)
+			now = time.monotonic()
+			# include the time connections that are still checked out have been busy
+			busy = counters['busy_seconds'] + sum(now - t for t in self.checked_out.values())
+			elapsed = now - self.stats_since
+			in_use = len(self.checked_out)
+		if reset:
+			self.reset_stats()
+		return {
+			'size': self.pool_size,
+			'in_use': in_use,
+			'checkouts': counters['checkouts'],
+			'timeouts': counters['timeouts'],
+			'avg_wait_ms': round(counters['wait_seconds'] / counters['checkouts'] * 1000, 2) if counters['checkouts'] else None,
+			'max_wait_ms': round(counters['max_wait_seconds'] * 1000, 2),
+			'utilization': round(busy / (self.pool_size * elapsed), 3) if elapsed > 0 else None
+		}
 
 	def close_connections(self):
-		for conn_info in self.pool.values():
-			conn_info['db'].close_connection()
+		while True:
+			try:
+				db, idle_since = self.idle.get_nowait()
+			except queue.Empty:
+				break
+			db.close_connection()
+
+
+
+NAMED_PARAM = re.compile(r'(?<!:):(\w+)')
+
+# the translation only depends on the query and which names are passed, so each distinct pair is only done once
+@functools.lru_cache(maxsize=256)
+def translate_named_params(query, names):
+	return NAMED_PARAM.sub(lambda m: "%(" + m.group(1) + ")s" if m.group(1) in names else m.group(0), query)
+
+# Replace ":param" with "%(param)s" for psycopg2
+def to_psycopg2_sql(query, params):
+	if isinstance(params, dict):
+		return translate_named_params(query, frozenset(params))
+	return NAMED_PARAM.sub(lambda m: "%(" + m.group(1) + ")s" if m.group(1) in params else m.group(0), query)
 
 
+# handed to the work function of Database.execute_transaction; nothing is committed until the work function returns
+class Transaction:
+	def __init__(self, cursor, db):
+		self.cursor = cursor
+		self.db = db
+
+	def execute_query(self, query, params=None):
+		if params is None:
+			self.cursor.execute(query)
+		else:
+			self.cursor.execute(to_psycopg2_sql(query, params), params)
+		if self.cursor.description is not None:
+			return self.cursor.fetchall()
+		return self.cursor.rowcount
+
+	# multi row insert, query has a single "VALUES %s" and template is e.g. "(%(a)s, %(b)s)" when rows are dicts
+	def execute_values(self, query, rows, template=None, page_size=100, fetch=False):
+		return psycopg2.extras.execute_values(self.cursor, query, rows, template=template, page_size=page_size, fetch=fetch)
+
+	def execute_statement(self, statement, params=None):
+		return self.db.run_statement(self.cursor, statement, params)
+
+	# one EXECUTE per row, sent page_size at a time in a single round trip
+	def execute_statement_batch(self, statement, rows, page_size=100):
+		self.db.prepare(self.cursor, statement)
+		start = time.perf_counter()
+		psycopg2.extras.execute_batch(self.cursor, statement.execute_sql, [statement.args(row) for row in rows], page_size=page_size)
+		statement.timings.record((time.perf_counter() - start) * 1000)
+
 
 class Database:
 	def __init__(self, host, port, database, user, password):
@@ -59,10 +189,13 @@ class Database:
 		self.database = database
 		self.user = user
 		self.password = password
+		# names of the statements prepared on the current connection (prepared statements live as long as the session)
+		self.prepared = set()
 		self.connection = self.connect()
 
 	def connect(self):
 		loginfo("Attempting to connect...")
+		self.prepared = set()
 		connection = psycopg2.connect(
 			host=self.host,
 			port=self.port,
@@ -91,21 +224,21 @@ class Database:
 				if params is None:
 					cursor.execute(query)
 				else:
-					# Replace ":param" with "%(param)s" for psycopg2
-					psycopg2_sql = re.sub(r'(?<!:):(\w+)', lambda m: "%(" + m.group(1) + ")s" if m.group(1) in params else m.group(0), query)
+					psycopg2_sql = to_psycopg2_sql(query, params)
 					if type(params) is list:
 						psycopg2.extras.execute_values(cursor, psycopg2_sql, params, template=None, page_size=100)
 					else:
 						cursor.execute(psycopg2_sql, params)
 
-					if commit or (not query.strip().lower().startswith(("select", "(select"))):
-						self.connection.commit()
-						#try:
-							# this is to handle non-select statements that return vales (e.g. with RETURNING clause)
-						#	result = cursor.fetchall()
-						#	return result
-						#except Exception as e:
-						result = cursor.rowcount
+				# (this used to only happen for queries with params, so param-less writes were never committed)
+				if commit or (not query.strip().lower().startswith(("select", "(select"))):
+					self.connection.commit()
+					#try:
+						# this is to handle non-select statements that return vales (e.g. with RETURNING clause)
+					#	result = cursor.fetchall()
+					#	return result
+					#except Exception as e:
+					result = cursor.rowcount
 				if cursor.description is not None:
 					result = cursor.fetchall()
 
@@ -131,8 +264,90 @@ class Database:
 				logerror(f"Error executing query: {e}")
 				raise
 
+	# runs work(transaction) and commits once at the end, so several statements cost a single commit (and fsync)
+	# connection errors roll back and retry the whole unit of work like execute_query does, any other error rolls back and raises
+	def execute_transaction(self, work):
+		while True:
+			try:
+				if not self.connection or self.connection.closed:
+					self.connection = self.connect()
+				cursor = self.connection.cursor()
+				result = work(Transaction(cursor, self))
+				self.connection.commit()
+				return result
+			except (psycopg2.OperationalError, psycopg2.InternalError) as e:
+				logerror(f"Error executing transaction: {e}")
+				try:
+					logerror('Attempting to rollback transaction...')
+					self.connection.rollback()
+					logerror('rollback success')
+				except Exception as e:
+					logerror("rollback failed")
+					logerror(e)
+				self.close_connection()
+				time.sleep(5)  # Wait for 5 seconds before retrying
+			except Exception as e:
+				logerror(f"Error executing transaction: {e}")
+				try:
+					self.connection.rollback()
+				except Exception:
+					pass
+				raise
+
+	def prepare(self, cursor, statement):
+		if statement.name not in self.prepared:
+			cursor.execute(statement.prepare_sql)
+			self.prepared.add(statement.name)
+
+	def run_statement(self, cursor, statement, params):
+		self.prepare(cursor, statement)
+		start = time.perf_counter()
+		cursor.execute(statement.execute_sql, statement.args(params or {}))
+		result = cursor.fetchall() if cursor.description is not None else cursor.rowcount
+		statement.timings.record((time.perf_counter() - start) * 1000)
+		return result
+
+	# runs a registered statement (db/statements.py) and commits only if the statement says so; a statement that
+	# doesn't commit leaves its transaction open for the caller (the pool rolls it back on release)
+	# connection errors are retried like execute_query
+	def execute_statement(self, statement, params=None):
+		while True:
+			try:
+				if not self.connection or self.connection.closed:
+					self.connection = self.connect()
+				cursor = self.connection.cursor()
+				result = self.run_statement(cursor, statement, params)
+				if statement.commit:
+					self.connection.commit()
+				return result
+			except (psycopg2.OperationalError, psycopg2.InternalError) as e:
+				logerror(f"Error executing statement {statement.name}: {e}")
+				try:
+					self.connection.rollback()
+				except Exception as e:
+					logerror("rollback failed")
+					logerror(e)
+				self.close_connection()
+				time.sleep(5)  # Wait for 5 seconds before retrying
+			except Exception as e:
+				logerror(f"Error executing statement {statement.name}: {e}")
+				raise
+
+	def is_connection_alive(self):
+		try:
+			if not self.connection or self.connection.closed:
+				return False
+			cursor = self.connection.cursor()
+			cursor.execute('SELECT 1')
+			cursor.fetchall()
+			self.connection.rollback()
+			return True
+		except Exception:
+			return False
+
 	def close_connection(self):
 		if self.connection:
 			self.connection.close()
 			self.connection = None
+			self.prepared = set()
 			loginfo("Connection to the database closed.")
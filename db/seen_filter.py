@@ -0,0 +1,105 @@
+import hashlib
+import math
+import threading
+from db.statements import register_statement
+from utils.helper_functions import loginfo, logerror
+
+
+SELECT_RSS_NEWS_ITEMS_AFTER = register_statement('select_rss_news_items_after', "SELECT id, link, title FROM rss_news_items WHERE id > :last_id ORDER BY id LIMIT :batch_size;")
+
+
+def normalize_title(title):
+	# close to the title_hash expression in schema.sql (collapse whitespace, trim, lowercase)
+	return ' '.join((title or '').split()).lower()
+
+
+# Process local bloom filter of the links and normalised titles already in rss_news_items.
+# A definite miss means the item is new and the database doesn't need to be asked; a possible hit still has to be
+# confirmed with a query because of false positives.
+# Only rows this process has seen are in the filter (warm() at startup + add() on every insert), so rows written by
+# another process after startup will look new until the next restart; the unique link constraint still catches those.
+class SeenFilter:
+	def __init__(self, capacity=1000000, error_rate=0.001):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		# standard sizing: m = -n ln(p) / ln(2)^2 bits, k = (m / n) ln(2) hashes, with n = 2 keys (link + title) per item
+		num_keys = 2 * capacity
+		self.num_bits = max(8, int(-num_keys * math.log(error_rate) / (math.log(2) ** 2)))
+		self.num_hashes = max(1, round(self.num_bits / num_keys * math.log(2)))
+		self.bits = bytearray((self.num_bits + 7) // 8)
+		self.lock = threading.Lock()
+		self.count = 0
+		self.ready = False
+		self.counters = {'checks': 0, 'definite_misses': 0, 'possible_hits': 0, 'confirmed_hits': 0}
+
+	def positions(self, key):
+		# double hashing (Kirsch-Mitzenmacher) off one 128 bit digest
+		digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+	def add_key(self, key):
+		for pos in self.positions(key):
+			self.bits[pos >> 3] |= 1 << (pos & 7)
+
+	def contains_key(self, key):
+		bits = self.bits
+		return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+	def add(self, link, title):
+		with self.lock:
+			if link:
+				self.add_key('l:' + link)
+			if title:
+				self.add_key('t:' + normalize_title(title))
+			self.count += 1
+			if self.count == self.capacity:
+				logerror(f'SeenFilter reached its capacity of {self.capacity} items, the false positive rate will now climb')
+
+	def might_contain(self, link, title):
+		with self.lock:
+			hit = (bool(link) and self.contains_key('l:' + link)) or (bool(title) and self.contains_key('t:' + normalize_title(title)))
+			self.counters['checks'] += 1
+			self.counters['possible_hits' if hit else 'definite_misses'] += 1
+		return hit
+
+	# possible hits that the database then confirmed (or not), so we can report an observed false positive rate
+	def record_confirmation(self, confirmed_hits):
+		with self.lock:
+			self.counters['confirmed_hits'] += confirmed_hits
+
+	def warm(self, conn, batch_size=50000):
+		start_count = self.count
+		last_id = 0
+		while True:
+			rows = conn.execute_statement(SELECT_RSS_NEWS_ITEMS_AFTER, {'last_id': last_id, 'batch_size': batch_size})
+			if not rows:
+				break
+			for row_id, link, title in rows:
+				self.add(link, title)
+			last_id = rows[-1][0]
+		self.ready = True
+		loginfo(f'SeenFilter warmed with {self.count - start_count} news items', self.stats())
+
+	def memory_bytes(self):
+		return len(self.bits)
+
+	def estimated_false_positive_rate(self):
+		# (1 - e^(-kn/m))^k, with two keys (link + title) per item and a hit on either counting as a hit
+		single = (1 - math.exp(-self.num_hashes * 2 * self.count / self.num_bits)) ** self.num_hashes
+		return 1 - (1 - single) ** 2
+
+	def stats(self):
+		with self.lock:
+			counters = dict(self.counters)
+		false_positives = counters['possible_hits'] - counters['confirmed_hits']
+		negatives = counters['definite_misses'] + false_positives
+		return {
+			'items': self.count,
+			'memory_bytes': self.memory_bytes(),
+			'num_hashes': self.num_hashes,
+			'estimated_false_positive_rate': float('%.3g' % self.estimated_false_positive_rate()),
+			'observed_false_positive_rate': round(false_positives / negatives, 6) if negatives else None,
+			**counters
+		}
@@ -0,0 +1,110 @@
+import re
+import threading
+from bisect import bisect_left
+
+# ":name" but not the "::type" casts
+NAMED_PARAM = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+STATEMENT_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+# upper bounds (ms) of the timing histogram buckets, anything slower than the last one goes in an overflow bucket
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class TimingHistogram:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.counts = [0] * (len(TIMING_BUCKETS_MS) + 1)
+		self.count = 0
+		self.total_ms = 0.0
+		self.max_ms = 0.0
+
+	def record(self, ms):
+		with self.lock:
+			self.counts[bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+			self.count += 1
+			self.total_ms += ms
+			self.max_ms = max(self.max_ms, ms)
+
+	# upper bound of the bucket the q-th quantile falls in (the max for the overflow bucket)
+	def quantile(self, q):
+		target = q * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if n and seen >= target:
+				return TIMING_BUCKETS_MS[i] if i < len(TIMING_BUCKETS_MS) else round(self.max_ms, 2)
+		return None
+
+	def stats(self, reset=False):
+		with self.lock:
+			if not self.count:
+				return None
+			labels = [f'<={b}ms' for b in TIMING_BUCKETS_MS] + [f'>{TIMING_BUCKETS_MS[-1]}ms']
+			stats = {
+				'count': self.count,
+				'avg_ms': round(self.total_ms / self.count, 2),
+				'max_ms': round(self.max_ms, 2),
+				'p50_ms': self.quantile(0.5),
+				'p95_ms': self.quantile(0.95),
+				'p99_ms': self.quantile(0.99),
+				'buckets': {label: n for label, n in zip(labels, self.counts) if n}
+			}
+			if reset:
+				self.reset()
+			return stats
+
+
+# A named query that is translated once, when it is registered: ":param" placeholders become $1..$n for a server side
+# PREPARE, and every execution is a cheap "EXECUTE name (%s, ...)" (see Database.execute_statement).
+# commit says whether Database.execute_statement commits after running it; inside execute_transaction the
+# transaction decides and this is ignored.
+class Statement:
+	def __init__(self, name, sql, commit=False):
+		self.name = name
+		self.sql = sql
+		self.commit = commit
+		self.param_names = []
+
+		def to_positional(m):
+			if m.group(1) not in self.param_names:
+				self.param_names.append(m.group(1))
+			return '$' + str(self.param_names.index(m.group(1)) + 1)
+
+		body = NAMED_PARAM.sub(to_positional, sql).strip().rstrip(';')
+		self.prepare_sql = f'PREPARE {name} AS {body}'
+		self.execute_sql = f'EXECUTE {name}' + (' (' + ', '.join(['%s'] * len(self.param_names)) + ')' if self.param_names else '')
+		self.timings = TimingHistogram()
+
+	def args(self, params):
+		return [params[name] for name in self.param_names]
+
+
+statements = {}
+statements_lock = threading.Lock()
+
+def register_statement(name, sql, commit=False):
+	if not STATEMENT_NAME.match(name):
+		raise ValueError(f'invalid statement name {name!r}')
+	with statements_lock:
+		existing = statements.get(name)
+		if existing:
+			if existing.sql != sql or existing.commit != commit:
+				raise ValueError(f'statement {name!r} is already registered with a different query')
+			return existing
+		statement = Statement(name, sql, commit)
+		statements[name] = statement
+		return statement
+
+# timing histograms of every statement that has run (since the last reset)
+def statement_stats(reset=False):
+	with statements_lock:
+		registered = list(statements.values())
+	stats = {}
+	for statement in registered:
+		timings = statement.timings.stats(reset)
+		if timings:
+			stats[statement.name] = timings
+	return stats
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from db.seen_filter import normalize_title
+from db.statements import register_statement
+
+
+# pending_articles (schema.sql): one row per article waiting for the llm. available_at is when a row can be leased
+# next, so it doubles as the retry time and, while a row is leased, as its visibility timeout.
+# Rows are leased highest priority first:
+#   base_priority = published (in hours since the epoch, a date in the future counts as now) + importance_weight * source_importance
+#   priority = base_priority + cluster_weight * ln(cluster_size)
+# i.e. one point of a source's average impact_importance is worth importance_weight hours of recency, and every e-fold
+# of outlets carrying the same story (cluster_size, the queued rows with the same cluster_key) cluster_weight hours.
+# Only the difference between rows matters, so the recency term doesn't have to change as time passes.
+ENQUEUE_PENDING_ARTICLES = register_statement('enqueue_pending_articles', """
+	INSERT INTO pending_articles (link, source, article, data, published, source_importance, cluster_key, base_priority, priority)
+	SELECT link, source, article, data::jsonb, published::timestamptz, importance, cluster_key,
+		EXTRACT(EPOCH FROM least(coalesce(published::timestamptz, now()), now())) / 3600 + :importance_weight::float8 * importance,
+		EXTRACT(EPOCH FROM least(coalesce(published::timestamptz, now()), now())) / 3600 + :importance_weight::float8 * importance
+	FROM unnest(:links::text[], :sources::text[], :articles::text[], :data::text[], :published::text[], :importances::float8[], :cluster_keys::text[])
+		AS i(link, source, article, data, published, importance, cluster_key)
+	ON CONFLICT (link) DO NOTHING
+	RETURNING id;
+""", commit=True)
+
+UPDATE_PENDING_CLUSTERS = register_statement('update_pending_clusters', """
+	UPDATE pending_articles p
+	SET cluster_size = c.size, priority = p.base_priority + :cluster_weight::float8 * ln(c.size)
+	FROM (
+		SELECT cluster_key, count(*) AS size FROM pending_articles
+		WHERE cluster_key = ANY(:cluster_keys::text[]) AND failed_at IS NULL
+		GROUP BY cluster_key
+	) c
+	WHERE p.cluster_key = c.cluster_key AND p.cluster_size <> c.size;
+""", commit=True)
+
+# SKIP LOCKED: concurrent workers (threads or other nodes) each get different rows instead of queueing on each other.
+# Only one article of a cluster is worked on at a time, so the others can reuse its result once it is stored: the
+# NOT EXISTS skips clusters with a lease, and a transaction level advisory lock per cluster keeps two concurrent
+# leases (which can't see each other's uncommitted rows) from both picking the same one. The lock is taken outside
+# the ordered subquery (OFFSET 0 keeps the planner from pushing it down into the scan), so only for the rows actually
+# pulled up to the limit.
+LEASE_PENDING_ARTICLES = register_statement('lease_pending_articles', """
+	UPDATE pending_articles p
+	SET attempts = p.attempts + 1, lease_token = :lease_token, leased_at = now(),
+		available_at = now() + make_interval(secs => :visibility_timeout::int)
+	FROM (
+		SELECT id FROM (
+			SELECT id, cluster_key FROM pending_articles a
+			WHERE failed_at IS NULL AND available_at <= now()
+				AND NOT EXISTS (
+					SELECT 1 FROM pending_articles c
+					WHERE c.cluster_key = a.cluster_key AND c.lease_token IS NOT NULL AND c.available_at > now() AND c.failed_at IS NULL
+				)
+			ORDER BY deferred, priority DESC, id
+			OFFSET 0
+			FOR UPDATE SKIP LOCKED
+		) candidates
+		WHERE pg_try_advisory_xact_lock(hashtext(coalesce(cluster_key, id::text)))
+		LIMIT :limit
+	) leased
+	WHERE p.id = leased.id
+	RETURNING p.id, p.article, p.data, p.attempts, p.cluster_key;
+""", commit=True)
+
+ACK_PENDING_ARTICLE = register_statement('ack_pending_article', """
+	DELETE FROM pending_articles WHERE id = :id AND lease_token = :lease_token;
+""", commit=True)
+
+# back in the queue after delay seconds, or failed for good once it has had max_attempts leases
+RETRY_PENDING_ARTICLE = register_statement('retry_pending_article', """
+	UPDATE pending_articles
+	SET lease_token = NULL, last_error = :error,
+		available_at = now() + make_interval(secs => :delay::int),
+		failed_at = CASE WHEN attempts >= :max_attempts::int THEN now() END
+	WHERE id = :id AND lease_token = :lease_token;
+""", commit=True)
+
+# on shutdown: straight back in the queue, without using up an attempt
+RELEASE_PENDING_ARTICLE = register_statement('release_pending_article', """
+	UPDATE pending_articles
+	SET lease_token = NULL, available_at = now(), attempts = attempts - 1
+	WHERE id = :id AND lease_token = :lease_token;
+""", commit=True)
+
+# Load shedding: once an article has been queued for longer than the latency sla and it is low value, i.e. from a
+# source whose articles average less than min_importance (a percentile of all sources, see SourceImportance) and not
+# (yet) carried by min_cluster_size outlets, it is either dropped or deferred (only leased when nothing else is
+# waiting). Rows being worked on are left alone. Dropped rows are marked failed rather than deleted, so the pollers
+# don't queue the link again.
+STALE_PENDING_ARTICLES = """
+	FROM pending_articles
+	WHERE failed_at IS NULL AND NOT deferred AND (lease_token IS NULL OR available_at <= now())
+		AND created_at < now() - make_interval(secs => :sla::int)
+		AND source_importance < :min_importance::float8 AND cluster_size < :min_cluster_size::int
+"""
+
+DROP_STALE_PENDING_ARTICLES = register_statement('drop_stale_pending_articles', """
+	UPDATE pending_articles SET failed_at = now(), lease_token = NULL, last_error = 'dropped: stale'
+	WHERE id IN (SELECT id """ + STALE_PENDING_ARTICLES + """ FOR UPDATE SKIP LOCKED);
+""", commit=True)
+
+DEFER_STALE_PENDING_ARTICLES = register_statement('defer_stale_pending_articles', """
+	UPDATE pending_articles SET deferred = true WHERE id IN (SELECT id """ + STALE_PENDING_ARTICLES + """ FOR UPDATE SKIP LOCKED);
+""", commit=True)
+
+PENDING_ARTICLES_STATS = register_statement('pending_articles_stats', """
+	SELECT
+		count(*) FILTER (WHERE failed_at IS NULL AND available_at <= now()),
+		count(*) FILTER (WHERE failed_at IS NULL AND available_at > now() AND lease_token IS NOT NULL),
+		count(*) FILTER (WHERE failed_at IS NULL AND available_at > now() AND lease_token IS NULL),
+		count(*) FILTER (WHERE failed_at IS NULL AND deferred),
+		count(*) FILTER (WHERE failed_at IS NOT NULL),
+		EXTRACT(EPOCH FROM now() - min(created_at) FILTER (WHERE failed_at IS NULL))::float8
+	FROM pending_articles;
+""")
+
+# average impact_importance per source over the last :days days
+SELECT_SOURCE_IMPORTANCE = register_statement('select_source_importance', """
+	SELECT source, avg(impact_importance)::float8, count(*)
+	FROM rss_news_items
+	WHERE impact_importance IS NOT NULL AND published > now() - make_interval(days => :days::int)
+	GROUP BY source;
+""")
+
+
+class LeaseLost(Exception):
+	pass
+
+
+class Lease:
+	def __init__(self, id, token, article, data, attempts, cluster_key):
+		self.id = id
+		self.token = token
+		self.article = article
+		self.data = data
+		self.attempts = attempts
+		self.cluster_key = cluster_key
+
+
+def encode_data(value):
+	if isinstance(value, datetime):
+		return value.isoformat()
+	return str(value)
+
+
+# the cluster of an article when the caller has nothing better: its normalised title
+def title_cluster_key(title):
+	return hashlib.md5(normalize_title(title).encode()).hexdigest()
+
+
+# Historical average impact_importance of each source (a feed url, or a cryptopanic domain), reloaded every
+# refresh_interval seconds. Averages are pulled towards the overall mean by prior_weight articles' worth, so a source
+# with a handful of stored articles doesn't jump to the top (or bottom) of the queue; unknown sources get the mean.
+# percentile(q) is the importance that q percent of the sources fall below, None until there are any.
+class SourceImportance:
+	def __init__(self, refresh_interval=3600, days=30, prior_weight=20, default=5.0):
+		self.refresh_interval = refresh_interval
+		self.days = days
+		self.prior_weight = prior_weight
+		self.default = default
+		self.importance = {}
+		self.ranked = []
+		self.loaded_at = None
+		self.lock = threading.Lock()
+
+	def refresh(self, conn):
+		rows = conn.execute_statement(SELECT_SOURCE_IMPORTANCE, {'days': self.days})
+		total = sum(count for source, average, count in rows)
+		mean = sum(average * count for source, average, count in rows) / total if total else self.default
+		importance = {source: (average * count + mean * self.prior_weight) / (count + self.prior_weight) for source, average, count in rows}
+		with self.lock:
+			self.importance = importance
+			self.ranked = sorted(importance.values())
+			self.default = mean
+			self.loaded_at = time.time()
+
+	def refresh_if_due(self, conn):
+		if self.loaded_at is None or time.time() - self.loaded_at > self.refresh_interval:
+			self.refresh(conn)
+
+	def lookup(self, conn, sources):
+		self.refresh_if_due(conn)
+		with self.lock:
+			return [self.importance.get(source, self.default) for source in sources]
+
+	def percentile(self, conn, q):
+		self.refresh_if_due(conn)
+		with self.lock:
+			if not self.ranked:
+				return None
+			return self.ranked[min(int(len(self.ranked) * q / 100), len(self.ranked) - 1)]
+
+
+# Durable queue of the articles found by the pollers, consumed by the llm workers. A lease hides a row from other
+# workers for visibility_timeout seconds; a worker that dies (or a node that is killed) without acking just lets
+# it expire, and the row is leased again. visibility_timeout has to be longer than processing an article can take.
+# Failed attempts are retried after retry_delay seconds, doubling every time up to max_retry_delay, and after
+# max_attempts of them the row is marked failed (kept for inspection, see schema.sql).
+# Priorities and load shedding are described with the statements above; stale_action is 'drop', 'defer' or None
+# (never shed), stale_importance_percentile the percentile of the source averages below which a source counts as low
+# value, and shedding runs at most every shed_interval seconds, from lease().
+# conn is a db.db.Database or, for ack/complete, a Transaction.
+class WorkQueue:
+	def __init__(self, visibility_timeout=900, max_attempts=6, retry_delay=60, max_retry_delay=3600,
+			importance_weight=2.0, cluster_weight=3.0, latency_sla=3600, stale_action='defer', stale_importance_percentile=25,
+			stale_min_cluster_size=2, shed_interval=60, source_importance=None):
+		self.visibility_timeout = visibility_timeout
+		self.max_attempts = max_attempts
+		self.retry_delay = retry_delay
+		self.max_retry_delay = max_retry_delay
+		self.importance_weight = importance_weight
+		self.cluster_weight = cluster_weight
+		self.latency_sla = latency_sla
+		if stale_action not in ('drop', 'defer', None):
+			raise ValueError(f'unknown stale_action {stale_action!r}')
+		self.stale_action = stale_action
+		self.stale_importance_percentile = stale_importance_percentile
+		self.stale_min_cluster_size = stale_min_cluster_size
+		self.shed_interval = shed_interval
+		self.last_shed = 0
+		self.source_importance = source_importance or SourceImportance()
+		self.lock = threading.Lock()
+		self.counts = {'enqueued': 0, 'leased': 0, 'acked': 0, 'retried': 0, 'failed': 0, 'released': 0, 'lost': 0, 'dropped': 0, 'deferred': 0}
+
+	def count(self, key, n=1):
+		with self.lock:
+			self.counts[key] += n
+
+	# items are (article, data) pairs, data a json serialisable dict with at least 'link', 'source', 'title' and
+	# 'published' (datetimes are stored as iso strings); links that are already queued are left alone.
+	# cluster_keys (one per item) group the articles about the same story (see nlp/near_duplicates.py), by default the
+	# ones with the same title.
+	# Returns the number of new rows.
+	def enqueue(self, conn, items, cluster_keys=None):
+		if not items:
+			return 0
+		if cluster_keys is None:
+			cluster_keys = [title_cluster_key(data.get('title')) for article, data in items]
+		sources = [data['source'] for article, data in items]
+		params = {
+			'links': [data['link'] for article, data in items],
+			'sources': sources,
+			'articles': [article for article, data in items],
+			'data': [json.dumps(data, default=encode_data) for article, data in items],
+			'published': [encode_data(data['published']) if data.get('published') else None for article, data in items],
+			'importances': self.source_importance.lookup(conn, sources),
+			'cluster_keys': cluster_keys,
+			'importance_weight': self.importance_weight
+		}
+		added = len(conn.execute_statement(ENQUEUE_PENDING_ARTICLES, params))
+		if added:
+			conn.execute_statement(UPDATE_PENDING_CLUSTERS, {'cluster_keys': list(set(cluster_keys)), 'cluster_weight': self.cluster_weight})
+		self.count('enqueued', added)
+		return added
+
+	# drops or defers the stale, low value rows (see STALE_PENDING_ARTICLES)
+	def shed(self, conn):
+		if self.stale_action is None:
+			return 0
+		min_importance = self.source_importance.percentile(conn, self.stale_importance_percentile)
+		if min_importance is None:
+			return 0
+		statement = DROP_STALE_PENDING_ARTICLES if self.stale_action == 'drop' else DEFER_STALE_PENDING_ARTICLES
+		shed = conn.execute_statement(statement, {'sla': self.latency_sla, 'min_importance': min_importance, 'min_cluster_size': self.stale_min_cluster_size})
+		self.count('dropped' if self.stale_action == 'drop' else 'deferred', shed)
+		return shed
+
+	def lease(self, conn, limit=1):
+		with self.lock:
+			shed_due = time.time() - self.last_shed >= self.shed_interval
+			if shed_due:
+				self.last_shed = time.time()
+		if shed_due:
+			self.shed(conn)
+		token = uuid.uuid4().hex
+		rows = conn.execute_statement(LEASE_PENDING_ARTICLES, {'lease_token': token, 'visibility_timeout': self.visibility_timeout, 'limit': limit})
+		self.count('leased', len(rows))
+		return [Lease(id, token, article, data, attempts, cluster_key) for id, article, data, attempts, cluster_key in rows]
+
+	# False if the lease had already expired and someone else has leased (or finished) the row since
+	def ack(self, conn, lease):
+		acked = conn.execute_statement(ACK_PENDING_ARTICLE, {'id': lease.id, 'lease_token': lease.token}) == 1
+		if acked:
+			self.count('acked')
+		return acked
+
+	# ack inside the transaction that stores the article's results, so both commit or neither does; raises LeaseLost
+	# (rolling the transaction back) when the row went to another worker meanwhile
+	def complete(self, tx, lease):
+		if not self.ack(tx, lease):
+			self.count('lost')
+			raise LeaseLost(f'lease on pending article {lease.id} expired')
+
+	def retry(self, conn, lease, error=None):
+		delay = min(self.retry_delay * 2 ** (lease.attempts - 1), self.max_retry_delay)
+		params = {'id': lease.id, 'lease_token': lease.token, 'error': str(error)[:1000] if error is not None else None, 'delay': delay, 'max_attempts': self.max_attempts}
+		if conn.execute_statement(RETRY_PENDING_ARTICLE, params) == 1:
+			self.count('failed' if lease.attempts >= self.max_attempts else 'retried')
+
+	def release(self, conn, lease):
+		if conn.execute_statement(RELEASE_PENDING_ARTICLE, {'id': lease.id, 'lease_token': lease.token}) == 1:
+			self.count('released')
+
+	def stats(self, conn=None):
+		with self.lock:
+			stats = dict(self.counts)
+		if conn is not None:
+			ready, leased, delayed, deferred, failed, oldest = conn.execute_statement(PENDING_ARTICLES_STATS)[0]
+			stats.update({'ready': ready, 'in_progress': leased, 'delayed': delayed, 'deferred_rows': deferred, 'failed_rows': failed,
+				'oldest_age_s': round(oldest, 1) if oldest is not None else None})
+		return stats
@@ -0,0 +1,73 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Per-feed http cache (ETag, Last-Modified and a hash of the last body we processed), persisted in a small sqlite file
+# so it survives restarts.
+# Validators are only written with store() once a feed has been fully handled, so if we die half way through a feed
+# it will be downloaded and parsed again on the next sweep rather than silently skipped.
+class FeedCache:
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.execute("""
+			CREATE TABLE IF NOT EXISTS feed_cache (
+				url TEXT PRIMARY KEY,
+				etag TEXT,
+				last_modified TEXT,
+				body_hash TEXT,
+				updated_at REAL
+			)
+		""")
+		self.connection.commit()
+		self.counters = {'not_modified': 0, 'unchanged': 0, 'miss': 0, 'bytes_downloaded': 0}
+
+	def get(self, url):
+		with self.lock:
+			row = self.connection.execute("SELECT etag, last_modified, body_hash FROM feed_cache WHERE url = ?", (url,)).fetchone()
+		if not row:
+			return None
+		return {'etag': row[0], 'last_modified': row[1], 'body_hash': row[2]}
+
+	def conditional_headers(self, url):
+		headers = {}
+		entry = self.get(url)
+		if entry:
+			if entry['etag']:
+				headers['If-None-Match'] = entry['etag']
+			if entry['last_modified']:
+				headers['If-Modified-Since'] = entry['last_modified']
+		return headers
+
+	def store(self, url, etag, last_modified, body_hash):
+		with self.lock:
+			self.connection.execute("""
+				INSERT INTO feed_cache (url, etag, last_modified, body_hash, updated_at) VALUES (?, ?, ?, ?, ?)
+				ON CONFLICT(url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, body_hash = excluded.body_hash, updated_at = excluded.updated_at
+			""", (url, etag, last_modified, body_hash, time.time()))
+			self.connection.commit()
+
+	def record(self, outcome, bytes_downloaded=0):
+		with self.lock:
+			self.counters[outcome] += 1
+			self.counters['bytes_downloaded'] += bytes_downloaded
+
+	def stats(self, reset=False):
+		with self.lock:
+			stats = dict(self.counters)
+			if reset:
+				for key in self.counters:
+					self.counters[key] = 0
+		requests_made = stats['not_modified'] + stats['unchanged'] + stats['miss']
+		stats['hit_ratio'] = round((stats['not_modified'] + stats['unchanged']) / requests_made, 3) if requests_made else None
+		return stats
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+
+def hash_body(content):
+	return hashlib.sha256(content).hexdigest()
@@ -0,0 +1,151 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+import requests
+from feeds.feed_cache import hash_body
+from utils.helper_functions import loginfo, logerror
+
+DEFAULT_HEADERS = {
+	'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:95.0) Gecko/20100101 Firefox/95.0'
+}
+
+# Downloads a list of feeds in parallel.
+# - max_workers bounds the total number of requests in flight
+# - per_host_limit bounds the requests in flight against any single host (several feeds share a host e.g. medium.com)
+# - deadline is one global budget (seconds) for the whole sweep, so a handful of slow hosts can't push a sweep past the schedule interval
+# - timeout is the per request socket timeout, which is additionally clamped to whatever is left of the deadline
+# - cache (optional FeedCache) makes the requests conditional; feeds that answer 304 or whose body hash is unchanged
+#   come back with not_modified=True and no content, so the caller can skip parsing them entirely
+class FeedFetcher:
+	def __init__(self, max_workers=16, per_host_limit=2, timeout=30, deadline=300, headers=None, chunk_size=65536, cache=None):
+		self.max_workers = max_workers
+		self.per_host_limit = per_host_limit
+		self.timeout = timeout
+		self.deadline = deadline
+		self.headers = headers or DEFAULT_HEADERS
+		self.chunk_size = chunk_size
+		self.cache = cache
+		self.host_locks = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def get_session(self):
+		# requests.Session isn't guaranteed thread safe, so keep one (keep-alive) session per worker thread
+		session = getattr(self.local, 'session', None)
+		if session is None:
+			session = requests.Session()
+			session.headers.update(self.headers)
+			self.local.session = session
+		return session
+
+	def get_host_semaphore(self, url):
+		host = urlsplit(url).netloc.lower()
+		with self.lock:
+			if host not in self.host_locks:
+				self.host_locks[host] = threading.BoundedSemaphore(self.per_host_limit)
+			return self.host_locks[host]
+
+	def fetch_one(self, url, expires_at, cancelled):
+		start = time.time()
+		result = new_result(url)
+		host_semaphore = self.get_host_semaphore(url)
+		remaining = expires_at - time.time()
+		if cancelled.is_set() or remaining <= 0 or not host_semaphore.acquire(timeout=remaining):
+			result['error'] = 'deadline exceeded before request started'
+			return result
+		try:
+			remaining = expires_at - time.time()
+			if cancelled.is_set() or remaining <= 0:
+				result['error'] = 'deadline exceeded before request started'
+				return result
+			# requests' timeout applies per socket operation, so stream the body and check the deadline between chunks
+			# to stop a slow-drip server from holding the worker past the deadline
+			request_headers = self.cache.conditional_headers(url) if self.cache else {}
+			with self.get_session().get(url, headers=request_headers, timeout=min(self.timeout, remaining), stream=True) as response:
+				result['status'] = response.status_code
+				if response.status_code == 304:
+					result['not_modified'] = True
+					self.cache.record('not_modified')
+					return result
+				response.raise_for_status()
+				chunks = []
+				for chunk in response.iter_content(self.chunk_size):
+					if cancelled.is_set() or time.time() > expires_at:
+						raise TimeoutError('deadline exceeded while reading response body')
+					chunks.append(chunk)
+				content = b''.join(chunks)
+				result['etag'] = response.headers.get('ETag')
+				result['last_modified'] = response.headers.get('Last-Modified')
+				result['body_hash'] = hash_body(content)
+				if self.cache:
+					# plenty of feeds ignore conditional requests but serve byte identical bodies, so compare hashes too
+					cached = self.cache.get(url)
+					if cached and cached['body_hash'] == result['body_hash']:
+						result['not_modified'] = True
+						self.cache.record('unchanged', len(content))
+						return result
+					self.cache.record('miss', len(content))
+				result['content'] = content
+		except Exception as e:
+			result['error'] = str(e)
+		finally:
+			host_semaphore.release()
+			result['elapsed'] = round(time.time() - start, 3)
+		return result
+
+	# returns {url: result} in the order the urls were given (duplicates are fetched once)
+	# each result is a dict with keys: url, content (raw bytes or None), status, error, elapsed, not_modified,
+	# plus the etag, last_modified and body_hash to hand back to mark_processed()
+	def fetch_all(self, urls, should_stop=None):
+		urls = list(dict.fromkeys(urls))
+		expires_at = time.time() + self.deadline
+		cancelled = threading.Event()
+		results = {}
+
+		executor = ThreadPoolExecutor(max_workers=min(self.max_workers, max(len(urls), 1)))
+		try:
+			futures = {executor.submit(self.fetch_one, url, expires_at, cancelled): url for url in urls}
+			pending = set(futures)
+			while pending:
+				remaining = expires_at - time.time()
+				if remaining <= 0 or (should_stop and should_stop()):
+					break
+				done, pending = wait(pending, timeout=min(remaining, 1))
+				for future in done:
+					results[futures[future]] = future.result()
+		finally:
+			cancelled.set()
+			executor.shutdown(wait=False, cancel_futures=True)
+
+		for url in urls:
+			if url not in results:
+				results[url] = new_result(url)
+				results[url]['error'] = 'deadline exceeded'
+
+		failed = sum(1 for r in results.values() if r['error'])
+		if failed:
+			logerror(f'{failed}/{len(urls)} feeds failed to download')
+		loginfo(f'Fetched {len(urls) - failed}/{len(urls)} feeds in', round(time.time() - (expires_at - self.deadline), 1), 's')
+		if self.cache:
+			loginfo('Feed cache:', self.cache.stats(reset=True))
+		return {url: results[url] for url in urls}
+
+	# call once a fetched feed has been fully handled so the next sweep can send conditional requests for it
+	def mark_processed(self, result):
+		if self.cache and result['content'] is not None:
+			self.cache.store(result['url'], result['etag'], result['last_modified'], result['body_hash'])
+
+
+def new_result(url):
+	return {
+		'url': url,
+		'content': None,
+		'status': None,
+		'error': None,
+		'elapsed': None,
+		'not_modified': False,
+		'etag': None,
+		'last_modified': None,
+		'body_hash': None
+	}
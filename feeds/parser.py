@@ -0,0 +1,95 @@
+import multiprocessing
+import signal
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import feedparser
+from feeds.text_extract import extract_batch, raw_entry
+from utils.helper_functions import logerror
+
+
+# The entries of a feed as plain dicts of strings instead of feedparser's FeedParserDicts, which are a lot heavier to
+# build, keep and pickle back from a worker process. Only entries with a title and a link.
+# description_html / contents are the raw values for feeds.text_extract (contents is a list of (type, value)).
+def entry_record(entry):
+	description_html, contents = raw_entry(entry)
+	return {
+		'title': entry.title,
+		'link': entry.link,
+		'published': entry.get('published'),
+		'summary': entry.get('summary'),
+		'description_html': description_html,
+		'contents': contents
+	}
+
+
+def parse_feed(content):
+	feed = feedparser.parse(content)
+	return [entry_record(entry) for entry in feed.entries if entry.get('title') and entry.get('link')]
+
+
+def ignore_sigint():
+	# ctrl+c goes to the whole process group, the main process does the shutting down
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Worker processes for the CPU heavy, pure python parts of a feed sweep: feedparser.parse of every downloaded feed
+# (all submitted at once, so a sweep scales with the number of cores) and the text extraction of the new entries.
+# Workers are forked, create this (and call start()) before the process starts any threads.
+# With workers=0, or once the pool has broken, everything runs in the calling thread.
+class FeedProcessPool:
+	def __init__(self, workers=2, max_chars=None):
+		self.workers = workers
+		self.max_chars = max_chars
+		self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'), initializer=ignore_sigint) if workers > 0 else None
+
+	def start(self):
+		# fork the workers now, ProcessPoolExecutor only starts them with the first task
+		if self.pool is not None:
+			self.pool.submit(int).result()
+
+	def broken(self, e):
+		logerror('! feed process pool broken, parsing in process from now on')
+		logerror(e)
+		self.pool = None
+
+	def submit(self, fn, *args):
+		if self.pool is not None:
+			try:
+				return self.pool.submit(fn, *args)
+			except BrokenProcessPool as e:
+				self.broken(e)
+		future = Future()
+		try:
+			future.set_result(fn(*args))
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	def result(self, future, fn, *args):
+		try:
+			return future.result()
+		except BrokenProcessPool as e:
+			if self.pool is not None:
+				self.broken(e)
+			return fn(*args)
+
+	# {key: raw feed bytes} -> yields (key, entry records or the exception parsing raised), in the given order
+	def parse_all(self, contents):
+		futures = [(key, content, self.submit(parse_feed, content)) for key, content in contents.items()]
+		for key, content, future in futures:
+			try:
+				yield key, self.result(future, parse_feed, content)
+			except Exception as e:
+				yield key, e
+
+	# (description text, content text) of each record, one slice of the records per worker
+	def extract_texts(self, records):
+		raw_entries = [(record['description_html'], record['contents']) for record in records]
+		step = -(-len(raw_entries) // max(self.workers, 1)) or 1
+		batches = [raw_entries[i:i + step] for i in range(0, len(raw_entries), step)]
+		futures = [self.submit(extract_batch, batch, self.max_chars) for batch in batches]
+		return [texts for future, batch in zip(futures, batches) for texts in self.result(future, extract_batch, batch, self.max_chars)]
+
+	def shutdown(self):
+		if self.pool is not None:
+			self.pool.shutdown(cancel_futures=True)
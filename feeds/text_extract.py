@@ -0,0 +1,133 @@
+import re
+from html.parser import HTMLParser
+
+# lxml's parser is a lot faster, html.parser is the fallback when it isn't installed
+try:
+	from lxml import etree
+except ImportError:
+	etree = None
+
+
+# text inside these is never part of the article
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template', 'head', 'svg', 'iframe', 'object'}
+# a line break around these, so paragraphs don't run into each other
+BLOCK_TAGS = {'p', 'br', 'div', 'li', 'ul', 'ol', 'tr', 'table', 'blockquote', 'pre', 'section', 'article', 'header', 'footer',
+	'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'figure', 'figcaption', 'hr', 'dd', 'dt'}
+WHITESPACE = re.compile(r'[ \t\r\f\v\xa0]+')
+BLANK_LINES = re.compile(r'\s*\n\s*')
+FEED_CHUNK_SIZE = 65536
+
+
+class TextCollector:
+	# lxml parser target / html.parser callbacks: keeps the text outside SKIPPED_TAGS until max_chars of it are collected
+	def __init__(self, max_chars=None):
+		self.max_chars = max_chars
+		self.parts = []
+		self.length = 0
+		self.skipping = 0
+
+	@property
+	def full(self):
+		return self.max_chars is not None and self.length >= self.max_chars
+
+	def start(self, tag, attrib=None):
+		tag = tag.lower()
+		if tag in SKIPPED_TAGS:
+			self.skipping += 1
+		elif tag in BLOCK_TAGS:
+			self.parts.append('\n')
+
+	def end(self, tag):
+		tag = tag.lower()
+		if tag in SKIPPED_TAGS:
+			self.skipping = max(0, self.skipping - 1)
+		elif tag in BLOCK_TAGS:
+			self.parts.append('\n')
+
+	def data(self, text):
+		if not self.skipping and not self.full:
+			self.parts.append(text)
+			self.length += len(text)
+
+	def comment(self, text):
+		pass
+
+	def close(self):
+		return self.text()
+
+	def text(self):
+		text = BLANK_LINES.sub('\n', WHITESPACE.sub(' ', ''.join(self.parts))).strip()
+		return text[:self.max_chars] if self.max_chars is not None else text
+
+
+class StdlibParser(HTMLParser):
+	def __init__(self, collector):
+		super().__init__(convert_charrefs=True)
+		self.collector = collector
+
+	def handle_starttag(self, tag, attrs):
+		self.collector.start(tag)
+
+	def handle_startendtag(self, tag, attrs):
+		self.collector.start(tag)
+		self.collector.end(tag)
+
+	def handle_endtag(self, tag):
+		self.collector.end(tag)
+
+	def handle_data(self, data):
+		self.collector.data(data)
+
+
+# Plain text of an html fragment. The html is fed to the parser in chunks and parsing stops as soon as max_chars of
+# text have been collected, so a huge article costs no more than its first max_chars.
+def html_to_text(html, max_chars=None):
+	if not html:
+		return ''
+	collector = TextCollector(max_chars)
+	if etree is not None:
+		parser = etree.HTMLParser(target=collector, no_network=True, recover=True)
+		feed, close = parser.feed, parser.close
+	else:
+		parser = StdlibParser(collector)
+		feed, close = parser.feed, parser.close
+	try:
+		for offset in range(0, len(html), FEED_CHUNK_SIZE):
+			feed(html[offset:offset + FEED_CHUNK_SIZE])
+			if collector.full:
+				break
+		else:
+			close()
+	except Exception:
+		# lxml raises on some hopeless input, keep whatever text was collected before that
+		pass
+	return collector.text()
+
+
+# the (description, content) text of a feed entry from its raw values: entry.description (html) and the 'value' of
+# each of entry.content (html, or text/plain taken as is); each capped at max_chars
+def entry_texts(description, contents, max_chars=None):
+	description_text = html_to_text(description, max_chars)
+	parts = []
+	length = 0
+	for content_type, value in contents:
+		if max_chars is not None and length >= max_chars:
+			break
+		remaining = max_chars - length if max_chars is not None else None
+		if content_type == 'text/plain':
+			text = value[:remaining].strip()
+		else:
+			text = html_to_text(value, remaining)
+		if text:
+			parts.append(text)
+			length += len(text) + 1
+	return description_text, '\n'.join(parts)
+
+
+# the raw values entry_texts() needs, picklable (a FeedParserDict entry is a lot heavier to send between processes)
+def raw_entry(entry):
+	return (entry.get('description') or '', [(c.get('type') or 'text/html', c.get('value') or '') for c in entry.get('content') or []])
+
+
+def extract_batch(raw_entries, max_chars):
+	return [entry_texts(description, contents, max_chars) for description, contents in raw_entries]
@@ -0,0 +1,47 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Thread safe in memory memo of token match results. Entries expire after ttl seconds, and the least recently used
+# ones are dropped once there are more than max_entries.
+class MatchCache:
+	def __init__(self, ttl=6 * 3600, max_entries=20000):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+	# returns (found, value), a cached "no match" is a valid value
+	def get(self, key):
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				stored_at, value = entry
+				if now - stored_at < self.ttl:
+					self.entries.move_to_end(key)
+					self.counters['hits'] += 1
+					return True, value
+				del self.entries[key]
+				self.counters['expired'] += 1
+			self.counters['misses'] += 1
+		return False, None
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries[key] = (time.monotonic(), value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+				self.counters['evicted'] += 1
+
+	def stats(self, reset=False):
+		with self.lock:
+			stats = dict(self.counters, size=len(self.entries))
+			if reset:
+				self.counters = dict.fromkeys(self.counters, 0)
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+		return stats
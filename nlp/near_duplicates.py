@@ -0,0 +1,188 @@
+import hashlib
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from db.seen_filter import normalize_title
+from db.statements import register_statement
+
+# without numpy there are no signatures, and only the articles with the same title are clustered
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+
+WORD = re.compile(r'[^\W_]+')
+# a prime just above 2**32: with a, b and the shingle hashes below 2**32, a * x + b fits in a uint64 without wrapping
+PRIME = 4294967311
+
+# recent articles to warm the index with: the stored ones (with the cluster they were stored under) and the queued ones.
+# Stored rows without a cluster_key (from before the column, see schema.sql) are left out: a cluster made up for them
+# would never find their analysis.
+SELECT_RECENT_ARTICLE_TEXTS = register_statement('select_recent_article_texts', """
+	SELECT link, title, concat_ws(' ', title, description, content), cluster_key, EXTRACT(EPOCH FROM created)::float8
+	FROM (
+		SELECT link, title, description, content, cluster_key, published AT TIME ZONE 'UTC' AS created
+		FROM rss_news_items
+		WHERE published > (now() - make_interval(secs => :window::int)) AT TIME ZONE 'UTC' AND cluster_key IS NOT NULL
+		UNION ALL
+		SELECT link, data->>'title', data->>'description', data->>'content', cluster_key, created_at
+		FROM pending_articles
+		WHERE failed_at IS NULL
+	) recent
+	ORDER BY created;
+""")
+
+
+def link_cluster_key(link):
+	return hashlib.md5(link.encode()).hexdigest()
+
+
+def shingles(text, size=3, max_words=2000):
+	words = WORD.findall(text.lower())[:max_words]
+	if len(words) < size:
+		return {' '.join(words)} if words else set()
+	return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+# Near duplicate detection over the text of recent articles (the same press release syndicated by several outlets,
+# with a different title or intro). Each article gets a MinHash signature over the word shingles of its text, and
+# locality sensitive hashing on bands of the signature finds the earlier articles that are likely similar; the best of
+# those with an estimated Jaccard similarity of at least `threshold` decides the cluster, otherwise the article starts
+# its own. Articles with the same normalised title always end up in the same cluster.
+# With bands x rows = num_perm, a pair with similarity s becomes a candidate with probability 1 - (1 - s^rows)^bands
+# (16 x 8: 95% at 0.8, 10% at 0.5). Articles older than window seconds are forgotten.
+# A link that is already in the index keeps the cluster it got the first time.
+class NearDuplicateIndex:
+	def __init__(self, num_perm=128, bands=16, threshold=0.8, window=48 * 3600, shingle_size=3, max_words=2000, seed=1):
+		if num_perm % bands:
+			raise ValueError('num_perm has to be a multiple of bands')
+		self.num_perm = num_perm
+		self.bands = bands
+		self.rows = num_perm // bands
+		self.threshold = threshold
+		self.window = window
+		self.shingle_size = shingle_size
+		self.max_words = max_words
+		if np is not None:
+			rng = np.random.default_rng(seed)
+			self.a = rng.integers(1, 2 ** 32, num_perm, dtype=np.uint64)[:, None]
+			self.b = rng.integers(0, 2 ** 32, num_perm, dtype=np.uint64)[:, None]
+		# article id -> (cluster key, signature, title, link, added at), and per band: band bytes -> article ids
+		self.articles = {}
+		self.buckets = [{} for i in range(bands)]
+		self.titles = {}
+		self.links = {}
+		self.added = deque()
+		self.next_id = 0
+		self.lock = threading.Lock()
+		self.counters = {'assigned': 0, 'known': 0, 'near_duplicates': 0, 'same_title': 0, 'evicted': 0}
+
+	def signature(self, text):
+		if np is None:
+			return None
+		hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles(text, self.shingle_size, self.max_words)), np.uint64)
+		if not len(hashes):
+			return None
+		return ((self.a * hashes[None, :] + self.b) % np.uint64(PRIME)).min(axis=1)
+
+	def band_keys(self, signature):
+		return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+	def evict(self, now):
+		while self.added and self.added[0][0] < now - self.window:
+			added_at, article_id = self.added.popleft()
+			cluster_key, signature, title, link, added_at = self.articles.pop(article_id)
+			if signature is not None:
+				for band, key in zip(self.buckets, self.band_keys(signature)):
+					ids = band.get(key)
+					if ids is not None:
+						ids.discard(article_id)
+						if not ids:
+							del band[key]
+			if title and self.titles.get(title) == article_id:
+				del self.titles[title]
+			if link and self.links.get(link) == article_id:
+				del self.links[link]
+			self.counters['evicted'] += 1
+
+	def best_match(self, signature):
+		candidates = set()
+		for band, key in zip(self.buckets, self.band_keys(signature)):
+			candidates.update(band.get(key, ()))
+		best, best_similarity = None, self.threshold
+		for article_id in candidates:
+			similarity = float(np.count_nonzero(self.articles[article_id][1] == signature)) / self.num_perm
+			if similarity >= best_similarity:
+				best, best_similarity = article_id, similarity
+		return best
+
+	# the cluster key of an article with this text and title; new_key is used (and returned) when it starts a cluster.
+	# The article is added to the index either way, under the returned key, unless its link is already in there.
+	def assign(self, text, new_key, title=None, added_at=None, link=None):
+		known = self.known_cluster(link)
+		if known is not None:
+			return known
+		signature = self.signature(text or '')
+		title = normalize_title(title) or None
+		now = time.time()
+		with self.lock:
+			self.evict(now)
+			if link in self.links:
+				self.counters['known'] += 1
+				return self.articles[self.links[link]][0]
+			self.counters['assigned'] += 1
+			cluster_key = new_key
+			if title in self.titles:
+				cluster_key = self.articles[self.titles[title]][0]
+				self.counters['same_title'] += 1
+			elif signature is not None:
+				match = self.best_match(signature)
+				if match is not None:
+					cluster_key = self.articles[match][0]
+					self.counters['near_duplicates'] += 1
+			self.add(cluster_key, signature, title, link, added_at if added_at is not None else now)
+		return cluster_key
+
+	# the cluster key the link got when it was added, None if it isn't in the index
+	def known_cluster(self, link):
+		if link is None:
+			return None
+		with self.lock:
+			article_id = self.links.get(link)
+			if article_id is None:
+				return None
+			self.counters['known'] += 1
+			return self.articles[article_id][0]
+
+	def add(self, cluster_key, signature, title, link, added_at):
+		article_id = self.next_id
+		self.next_id += 1
+		self.articles[article_id] = (cluster_key, signature, title, link, added_at)
+		self.added.append((added_at, article_id))
+		if signature is not None:
+			for band, key in zip(self.buckets, self.band_keys(signature)):
+				band.setdefault(key, set()).add(article_id)
+		if title:
+			self.titles.setdefault(title, article_id)
+		if link:
+			self.links[link] = article_id
+
+	# the articles of the last window from the database, stored ones keep the cluster they were stored under
+	def warm(self, conn):
+		rows = conn.execute_statement(SELECT_RECENT_ARTICLE_TEXTS, {'window': self.window})
+		for link, title, text, cluster_key, created in rows:
+			signature = self.signature(text or '')
+			title = normalize_title(title) or None
+			with self.lock:
+				self.add(cluster_key or link_cluster_key(link), signature, title, link, created if created is not None else time.time())
+		return len(rows)
+
+	def stats(self, reset=False):
+		with self.lock:
+			stats = dict(self.counters, size=len(self.articles))
+			if reset:
+				self.counters = dict.fromkeys(self.counters, 0)
+		return stats
@@ -1,11 +1,43 @@
+import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
+from dotenv import load_dotenv
+from nlp.token_index import load_token_index, normalize_name
+from nlp.match_cache import MatchCache
 
+load_dotenv()
 
-def get_cmc_closest_match(name):
+# local token list snapshots (json from the CMC map / Coinpaprika coins endpoints, or csv with id,name,symbol,slug,rank,aliases)
+# when one is configured its matcher runs in process, otherwise we fall back to the remote fuzzy search
+CMC_TOKENS_PATH=os.getenv("CMC_TOKENS_PATH")
+COINPAPRIKA_TOKENS_PATH=os.getenv("COINPAPRIKA_TOKENS_PATH")
+TOKEN_MATCH_MIN_SCORE=float(os.getenv("TOKEN_MATCH_MIN_SCORE", 60))
+
+cmc_index = load_token_index(CMC_TOKENS_PATH, TOKEN_MATCH_MIN_SCORE)
+coinpaprika_index = load_token_index(COINPAPRIKA_TOKENS_PATH, TOKEN_MATCH_MIN_SCORE)
+
+# remote matcher: results are memoised per normalised name, requests share one keep-alive session and time out
+TOKEN_MATCH_CACHE_TTL=int(os.getenv("TOKEN_MATCH_CACHE_TTL", 6 * 3600))
+TOKEN_MATCH_CACHE_MAX_ENTRIES=int(os.getenv("TOKEN_MATCH_CACHE_MAX_ENTRIES", 20000))
+TOKEN_MATCH_TIMEOUT=float(os.getenv("TOKEN_MATCH_TIMEOUT", 10))
+TOKEN_MATCH_WORKERS=int(os.getenv("TOKEN_MATCH_WORKERS", 8))
+
+match_cache = MatchCache(TOKEN_MATCH_CACHE_TTL, TOKEN_MATCH_CACHE_MAX_ENTRIES)
+
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=TOKEN_MATCH_WORKERS)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+lookup_executor = ThreadPoolExecutor(max_workers=TOKEN_MATCH_WORKERS, thread_name_prefix='token-match')
+
+
+# None on a failed request, so errors aren't cached
+def fetch_cmc_match(name):
 	try:
 		url = '###' + quote(name)
-		result = requests.get(url).json()
+		result = session.get(url, timeout=TOKEN_MATCH_TIMEOUT).json()
 		if result and result['data'] and result['data']['results']:
 			best_match_data = result['data']['results'][0]
 			best_match_id = best_match_data[7]
@@ -18,6 +50,7 @@ def get_cmc_closest_match(name):
 			}
 	except Exception as e:
 		print(e)
+		return None
 
 	return {
 			'id': None,
@@ -25,10 +58,10 @@ def get_cmc_closest_match(name):
 			'score': None
 		}
 
-def get_coinpaprika_closest_match(name):
+def fetch_coinpaprika_match(name):
 	try:
 		url = '###' + quote(name)
-		result = requests.get(url).json()
+		result = session.get(url, timeout=TOKEN_MATCH_TIMEOUT).json()
 		if result and result['data'] and result['data']['results']:
 			best_match_data = result['data']['results'][0]
 			best_match_id = best_match_data[1]
@@ -39,8 +72,48 @@ def get_coinpaprika_closest_match(name):
 			}
 	except Exception as e:
 		print(e)
+		return None
 
 	return {
 			'id': None,
 			'score': None
-		}
\ No newline at end of file
+		}
+
+def cached_match(source, fetch, name, empty):
+	key = (source, normalize_name(name))
+	if not key[1]:
+		return dict(empty)
+	found, match = match_cache.get(key)
+	if not found:
+		match = fetch(name)
+		if match is None:
+			return dict(empty)
+		match_cache.put(key, match)
+	return dict(match)
+
+def get_cmc_closest_match(name, symbol=None):
+	if cmc_index:
+		return cmc_index.match(name, symbol)
+	return cached_match('cmc', fetch_cmc_match, name, {'id': None, 'name': None, 'score': None})
+
+def get_coinpaprika_closest_match(name, symbol=None):
+	if coinpaprika_index:
+		return coinpaprika_index.match(name, symbol)
+	return cached_match('coinpaprika', fetch_coinpaprika_match, name, {'id': None, 'score': None})
+
+# resolves the cmc and coinpaprika matches for all of an article's (name, symbol) pairs at once
+# returns a list of (cmc_match, coinpaprika_match) in the same order; remote lookups for names that normalise the same
+# are only made once
+def resolve_token_matches(entities):
+	pending = []
+	for index, get_match in ((cmc_index, get_cmc_closest_match), (coinpaprika_index, get_coinpaprika_closest_match)):
+		if index:
+			pending.append([get_match(name, symbol) for name, symbol in entities])
+			continue
+		futures = {}
+		for name, symbol in entities:
+			if normalize_name(name) not in futures:
+				futures[normalize_name(name)] = lookup_executor.submit(get_match, name, symbol)
+		pending.append([futures[normalize_name(name)] for name, symbol in entities])
+	results = [[m if isinstance(m, dict) else dict(m.result()) for m in matches] for matches in pending]
+	return list(zip(*results))
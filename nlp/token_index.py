@@ -0,0 +1,138 @@
+import csv
+import json
+import re
+from collections import Counter
+from utils.helper_functions import loginfo, logerror
+
+# trailing words the llm (and the token lists) are inconsistent about, "Chainlink" vs "Chainlink Token" etc.
+NAME_SUFFIXES = ('token', 'coin', 'network', 'protocol', 'finance', 'chain')
+
+
+def normalize_name(name):
+	return ' '.join(re.sub(r'[^0-9a-z]+', ' ', (name or '').lower()).split())
+
+def name_variants(name):
+	normalized = normalize_name(name)
+	variants = {normalized, normalized.replace(' ', '')}
+	words = normalized.split()
+	if len(words) > 1 and words[-1] in NAME_SUFFIXES:
+		variants.add(' '.join(words[:-1]))
+	return {v for v in variants if v}
+
+def trigrams(text):
+	padded = '  ' + text + ' '
+	return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# In process resolver over a local snapshot of a token list (CMC /v1/cryptocurrency/map, Coinpaprika /v1/coins, or a
+# CSV with the same columns). Exact hits on the normalised name, aliases/slug and symbol are dict lookups; anything else
+# falls back to a trigram (dice coefficient) fuzzy match over the indexed names.
+# match() returns the same {'id', 'name', 'score'} shape as the remote matchers, score is 0-100.
+class TokenIndex:
+	def __init__(self, records, min_score=60):
+		self.min_score = min_score
+		self.records = []
+		self.by_name = {}
+		self.by_symbol = {}
+		self.grams = {}
+		self.keys = []
+		self.key_grams = []
+		# better ranked tokens first, so they win exact collisions (lots of things are called "BTC" something)
+		for record in sorted(records, key=lambda r: (r['rank'] or float('inf'))):
+			pos = len(self.records)
+			self.records.append(record)
+			if record['symbol']:
+				self.by_symbol.setdefault(record['symbol'].upper(), pos)
+			for alias in [record['name'], record['slug']] + record['aliases']:
+				for variant in name_variants(alias):
+					if variant in self.by_name:
+						continue
+					self.by_name[variant] = pos
+					key = len(self.keys)
+					self.keys.append(pos)
+					grams = trigrams(variant)
+					self.key_grams.append(len(grams))
+					for gram in grams:
+						self.grams.setdefault(gram, []).append(key)
+
+	def __len__(self):
+		return len(self.records)
+
+	def result(self, pos, score):
+		record = self.records[pos]
+		return {'id': record['id'], 'name': record['name'], 'score': score}
+
+	def fuzzy(self, normalized):
+		grams = trigrams(normalized)
+		shared = Counter()
+		for gram in grams:
+			shared.update(self.grams.get(gram, ()))
+		best_key, best_score = None, 0
+		for key, count in shared.items():
+			score = 200 * count / (len(grams) + self.key_grams[key])
+			# ties go to the better ranked token (lower position)
+			if score > best_score or (score == best_score and self.keys[key] < self.keys[best_key]):
+				best_key, best_score = key, score
+		if best_key is None or best_score < self.min_score:
+			return None
+		return self.result(self.keys[best_key], round(best_score, 1))
+
+	def match(self, name, symbol=None):
+		for variant in name_variants(name):
+			if variant in self.by_name:
+				return self.result(self.by_name[variant], 100)
+		# the llm often gives the ticker as the name
+		for candidate in (name, symbol):
+			if candidate and candidate.strip().upper() in self.by_symbol:
+				return self.result(self.by_symbol[candidate.strip().upper()], 100)
+		normalized = normalize_name(name)
+		match = self.fuzzy(normalized) if normalized else None
+		return match or {'id': None, 'name': None, 'score': None}
+
+	@classmethod
+	def load(cls, path, min_score=60):
+		return cls(load_token_records(path), min_score)
+
+
+def load_token_records(path):
+	if path.lower().endswith('.csv'):
+		with open(path, newline='', encoding='utf-8') as f:
+			rows = list(csv.DictReader(f))
+	else:
+		with open(path, encoding='utf-8') as f:
+			rows = json.load(f)
+		if isinstance(rows, dict):
+			rows = rows.get('data', [])
+	records = []
+	for row in rows:
+		if row.get('is_active') in (False, 0, '0', 'false', 'False'):
+			continue
+		aliases = row.get('aliases') or []
+		if isinstance(aliases, str):
+			aliases = [a for a in aliases.split('|') if a]
+		try:
+			rank = int(row.get('rank') or 0) or None
+		except ValueError:
+			rank = None
+		records.append({
+			'id': str(row['id']),
+			'name': row.get('name') or '',
+			'symbol': row.get('symbol') or '',
+			'slug': row.get('slug') or '',
+			'aliases': aliases,
+			'rank': rank
+		})
+	return records
+
+# returns None (so callers use the remote matcher) if no path is configured or the snapshot can't be loaded
+def load_token_index(path, min_score=60):
+	if not path:
+		return None
+	try:
+		index = TokenIndex.load(path, min_score)
+		loginfo(f'Loaded {len(index)} tokens from {path}')
+		return index
+	except Exception as e:
+		logerror(f'! could not load token list {path}')
+		logerror(e)
+		return None
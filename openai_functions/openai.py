@@ -3,10 +3,70 @@ import openai
 from openai import ChatCompletion
 import os
 import time
+import threading
+import functools
 from dotenv import load_dotenv
+from openai_functions.rate_limiter import RateLimiter
+from openai_functions.response_cache import ResponseCache
 load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# point OPENAI_API_BASE at a local fake completion server for testing (the openai client reads it from the env)
+
+# shared by every thread calling do_chat_completion, replaces the fixed sleeps between calls
+OPENAI_REQUESTS_PER_MINUTE=int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 60))
+OPENAI_TOKENS_PER_MINUTE=int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 90000))
+rate_limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
+
+# completion responses are cached on disk so identical requests are never paid for twice (set LLM_CACHE_PATH= to disable)
+LLM_CACHE_PATH=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL=int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 100000))
+response_cache = ResponseCache(LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES) if LLM_CACHE_PATH else None
+
+
+# latency and token usage per prompt mode (e.g. split vs combined), so the modes can be compared
+class CompletionStats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.modes = {}
+
+	def record(self, mode, latency, usage, fallback=False):
+		with self.lock:
+			stats = self.modes.setdefault(mode, {'articles': 0, 'calls': 0, 'cache_hits': 0, 'fallbacks': 0, 'latency': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0})
+			if fallback:
+				stats['fallbacks'] += 1
+			else:
+				stats['articles'] += 1
+			stats['calls'] += usage.get('calls', 0)
+			stats['cache_hits'] += usage.get('cache_hits', 0)
+			stats['latency'] += latency
+			stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+			stats['completion_tokens'] += usage.get('completion_tokens', 0)
+
+	def stats(self):
+		with self.lock:
+			result = {}
+			for mode, stats in self.modes.items():
+				attempts = stats['articles'] + stats['fallbacks']
+				result[mode] = dict(stats,
+					avg_latency=round(stats['latency'] / attempts, 2) if attempts else None,
+					avg_tokens=round((stats['prompt_tokens'] + stats['completion_tokens']) / attempts) if attempts else None
+				)
+			return result
+
+completion_stats = CompletionStats()
+
+# tiktoken.encoding_for_model is slow enough to matter when it's called for every count, so only do it once per model
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+	try:
+			return tiktoken.encoding_for_model(model)
+	except KeyError:
+			return tiktoken.get_encoding("cl100k_base")
+
+# role + message framing + reply priming, see num_tokens_from_text
+MESSAGE_OVERHEAD_TOKENS = 7
 
 def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
 	messages = [
@@ -16,10 +76,7 @@ def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
 		}
 	]
 	"""Returns the number of tokens used by a list of messages."""
-	try:
-			encoding = tiktoken.encoding_for_model(model)
-	except KeyError:
-			encoding = tiktoken.get_encoding("cl100k_base")
+	encoding = get_encoding(model)
 	if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
 			num_tokens = 0
 			for message in messages:
@@ -34,65 +91,105 @@ def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
 			raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.
 	See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
 
+# an upper bound on num_tokens_from_text without encoding anything: a (byte level bpe) token is never shorter than one utf-8 byte
+def max_tokens_from_text(text):
+	return len(text.encode('utf-8')) + MESSAGE_OVERHEAD_TOKENS
+
 
 # this can be either used with text alone, or with text that needs to be inserted into a prompt before num tokens is calculated
+# the text is encoded once and the token array is cut at the budget left over by the prompt, rather than binary searching
+# on re-encodes of the whole prompt. tolerance is kept for compatibility, the result always fills the budget as closely as possible
 def trim_text_to_token_limit(text, max_tokens, target_tokens, tolerance=0.05, prompt=None, insertion_key=None):
-	# Initial bounds for binary search
-	lower_bound = 0
 	if prompt:
-		this_text = prompt.replace(insertion_key, text)
+		occurrences = max(1, prompt.count(insertion_key))
+		overhead = num_tokens_from_text(prompt.replace(insertion_key, ''))
 	else:
-		this_text = text
-	upper_bound = len(this_text)
+		occurrences = 1
+		overhead = num_tokens_from_text('')
+	budget = (min(max_tokens, target_tokens) - overhead) // occurrences
+	if budget <= 0:
+		return ''
 
-	# Perform binary search to find the approximate cutoff point
-	while lower_bound < upper_bound:
-		# Get the middle point of the current bounds
-		mid = (lower_bound + upper_bound) // 2
+	# fast path: if even the byte length fits, the token count does too
+	if len(text.encode('utf-8')) <= budget:
+		return text
 
-		# Estimate the token count based on the provided function
-		if prompt:
-			this_text_truncated = prompt.replace(insertion_key, text[:mid])
-		else:
-			this_text_truncated = text[:mid]
-		current_tokens = num_tokens_from_text(this_text_truncated)
-		#print(max_tokens, current_tokens)
-
-		# Check if the current token count is within the tolerance
-		if target_tokens * (1 - tolerance) <= current_tokens <= max_tokens:
-			return text[:mid]
-
-		# Adjust the bounds based on the current token count
-		if current_tokens < target_tokens * (1 - tolerance):
-			lower_bound = mid + 1
-		else:
-			upper_bound = mid - 1
+	encoding = get_encoding("gpt-3.5-turbo-0301")
+	# only encode as much of the text as the budget needs: start with a window of ~6 characters per token and grow it
+	# (by the characters per token seen so far) until it holds more tokens than the budget.
+	# tokens well before the window's end are the same as the full text's, so cutting inside the window is safe
+	window = budget * 6
+	tokens = encoding.encode(text[:window])
+	while window < len(text) and len(tokens) <= budget + 16:
+		window = max(window * 5 // 4, int(window / max(len(tokens), 1) * (budget + 64) * 1.2))
+		tokens = encoding.encode(text[:window])
+	while len(tokens) > budget:
+		# decode_bytes + ignore drops a multi byte character cut in half at the end, so this is always a prefix of text
+		truncated = encoding.decode_bytes(tokens[:budget]).decode('utf-8', errors='ignore')
+		# tokens can merge differently where the text meets the rest of the prompt, so check the real count once
+		this_text = prompt.replace(insertion_key, truncated) if prompt else truncated
+		excess = num_tokens_from_text(this_text) - max_tokens
+		if excess <= 0:
+			return truncated
+		budget -= excess
+	return text
 
-	# If the loop doesn't return early, return the closest possible approximation
-	return text[:lower_bound]
+def retry_after_seconds(error):
+	try:
+		return float((error.headers or {}).get('retry-after'))
+	except (TypeError, ValueError):
+		return None
 
-def do_chat_completion(prompt_template, text, insertion_key, completion_tokens, max_tries=5):
+# usage: optional dict, the call's token usage (prompt_tokens, completion_tokens, calls) is added to it
+# validate: optional function of the response text, only responses it accepts are cached (and a cached response it
+# rejects is dropped and asked for again), so one malformed answer isn't handed back on every retry
+def do_chat_completion(prompt_template, text, insertion_key, completion_tokens, max_tries=5, should_stop=None, usage=None, validate=None):
 	prompt = prompt_template.replace(insertion_key, text)
 	success = False
 	tries = 0
+	temperature = 0
 	
 	completion_tokens = 800
-	n_tokens = num_tokens_from_text(prompt)
-	# This model's maximum context length is 16385 tokens
-	if n_tokens+completion_tokens > 16300:
-		truncated_article = trim_text_to_token_limit(text, 16340-completion_tokens, 16340-completion_tokens, tolerance=0.05, prompt=prompt_template, insertion_key=insertion_key)
-		prompt = prompt_template.replace(insertion_key, truncated_article)
-		model = "gpt-3.5-turbo-16k"
-	elif n_tokens+completion_tokens > 4050:
-		model = "gpt-3.5-turbo-16k"
-	else:
+	truncated_article = text
+	if max_tokens_from_text(prompt)+completion_tokens <= 4050:
+		# fast path: short enough for the 4k model even at one token per byte, so skip encoding it
+		# (the rate limiter only needs an estimate, ~4 characters per token like the api's own rate limiter)
+		n_tokens = len(prompt) // 4 + MESSAGE_OVERHEAD_TOKENS
 		model="gpt-3.5-turbo-0613"
+	else:
+		# This model's maximum context length is 16385 tokens
+		# trim first: it never encodes more of a huge article than the 16k budget needs (and returns short ones as is)
+		truncated_article = trim_text_to_token_limit(text, 16340-completion_tokens, 16340-completion_tokens, tolerance=0.05, prompt=prompt_template, insertion_key=insertion_key)
+		if len(truncated_article) < len(text):
+			prompt = prompt_template.replace(insertion_key, truncated_article)
+			# trim_text_to_token_limit has already checked the truncated prompt's count
+			n_tokens = 16340-completion_tokens
+			model = "gpt-3.5-turbo-16k"
+		else:
+			n_tokens = num_tokens_from_text(prompt)
+			if n_tokens+completion_tokens > 4050:
+				model = "gpt-3.5-turbo-16k"
+			else:
+				model="gpt-3.5-turbo-0613"
+
+	if response_cache:
+		cache_key = ResponseCache.make_key(model, prompt_template, truncated_article, temperature)
+		response_content = response_cache.get(cache_key)
+		if response_content is not None and validate is not None and not validate(response_content):
+			response_cache.delete(cache_key)
+			response_content = None
+		if response_content is not None:
+			if usage is not None:
+				usage['cache_hits'] = usage.get('cache_hits', 0) + 1
+			return response_content
 
 	while not success and tries < max_tries:
+		if not rate_limiter.acquire(n_tokens + completion_tokens, should_stop=should_stop):
+			return None
 		try:
 			response = ChatCompletion.create(
 				model=model,
-				temperature=0,
+				temperature=temperature,
 				max_tokens=800,
 				request_timeout=60,
 				messages=[
@@ -103,14 +200,24 @@ def do_chat_completion(prompt_template, text, insertion_key, completion_tokens,
 				]
 			)
 			success = True
-			response_content = response.choices[0].message.content			
-			time.sleep(5)
+			response_content = response.choices[0].message.content
+			rate_limiter.success()
+			if response_cache and (validate is None or validate(response_content)):
+				response_cache.put(cache_key, model, response_content)
+			if usage is not None:
+				usage['calls'] = usage.get('calls', 0) + 1
+				usage['prompt_tokens'] = usage.get('prompt_tokens', 0) + response.get('usage', {}).get('prompt_tokens', 0)
+				usage['completion_tokens'] = usage.get('completion_tokens', 0) + response.get('usage', {}).get('completion_tokens', 0)
 			return response_content
+		except openai.error.RateLimitError as e:
+			print(e)
+			rate_limiter.backoff(retry_after_seconds(e))
+			tries += 1
 		except Exception as e:
 			print(e)
 			# 16k model error:
 			# This model's maximum context length is 16385 tokens
-			if e.user_message.startswith("This model's maximum context length is 4097 tokens"):
+			if (getattr(e, 'user_message', None) or '').startswith("This model's maximum context length is 4097 tokens"):
 					model = "gpt-3.5-turbo-16k"
 			else:
 					print('.')
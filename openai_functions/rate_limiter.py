@@ -0,0 +1,74 @@
+import threading
+import time
+from utils.helper_functions import loginfo
+
+
+# Shared limiter for every thread that talks to the completion api.
+# Two token buckets (requests per minute and tokens per minute) refill continuously; acquire() blocks until both have
+# room for the call. When the api answers 429 anyway, backoff() pauses *all* callers for an exponentially growing delay
+# (or the server's Retry-After), and successful calls shrink the delay back down again.
+class RateLimiter:
+	def __init__(self, requests_per_minute, tokens_per_minute, min_backoff=1, max_backoff=60):
+		self.requests_per_second = requests_per_minute / 60
+		self.tokens_per_second = tokens_per_minute / 60
+		self.max_requests = requests_per_minute
+		self.max_tokens = tokens_per_minute
+		self.available_requests = requests_per_minute
+		self.available_tokens = tokens_per_minute
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.backoff_delay = 0
+		self.paused_until = 0
+		self.last_refill = time.monotonic()
+		self.lock = threading.Lock()
+		self.counters = {'acquired': 0, 'waited_seconds': 0.0, 'rate_limited': 0}
+
+	def refill(self, now):
+		elapsed = now - self.last_refill
+		self.last_refill = now
+		self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.requests_per_second)
+		self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.tokens_per_second)
+
+	# blocks until there is budget for one request using `tokens` tokens (prompt + max completion)
+	def acquire(self, tokens, should_stop=None):
+		# a single call bigger than the whole per minute budget would never fit, so let it through on a full bucket
+		tokens = min(tokens, self.max_tokens)
+		start = time.monotonic()
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.refill(now)
+				if now >= self.paused_until and self.available_requests >= 1 and self.available_tokens >= tokens:
+					self.available_requests -= 1
+					self.available_tokens -= tokens
+					self.counters['acquired'] += 1
+					self.counters['waited_seconds'] += now - start
+					return True
+				wait = max(
+					self.paused_until - now,
+					(1 - self.available_requests) / self.requests_per_second,
+					(tokens - self.available_tokens) / self.tokens_per_second
+				)
+			if should_stop and should_stop():
+				return False
+			time.sleep(min(max(wait, 0.01), 1))
+
+	def backoff(self, retry_after=None):
+		with self.lock:
+			self.counters['rate_limited'] += 1
+			now = time.monotonic()
+			# other workers' requests that were already in flight when we paused will 429 too, don't escalate for those
+			if now < self.paused_until:
+				return
+			self.backoff_delay = min(self.max_backoff, max(self.min_backoff, self.backoff_delay * 2))
+			delay = max(self.backoff_delay, retry_after or 0)
+			self.paused_until = now + delay
+		loginfo(f'Rate limited by the completion api, pausing all requests for {round(delay, 1)}s')
+
+	def success(self):
+		with self.lock:
+			self.backoff_delay = self.backoff_delay / 2 if self.backoff_delay > self.min_backoff else 0
+
+	def stats(self):
+		with self.lock:
+			return dict(self.counters, backoff_delay=self.backoff_delay)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from utils.helper_functions import loginfo
+
+
+# Persistent cache of completion responses, keyed by a hash of everything that determines the answer
+# (model, prompt template, the (truncated) article text and temperature).
+# Entries expire after ttl seconds, and once there are more than max_entries the least recently used ones are evicted.
+# Checked before any network call, so reprocessing the same text (a crash before insert, syndicated copies,
+# cryptopanic/rss overlap) doesn't pay for the model again.
+class ResponseCache:
+	def __init__(self, path, ttl=7 * 24 * 3600, max_entries=100000, evict_every=100):
+		self.path = path
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.evict_every = evict_every
+		self.puts = 0
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.execute("""
+			CREATE TABLE IF NOT EXISTS llm_response_cache (
+				key TEXT PRIMARY KEY,
+				model TEXT,
+				response TEXT,
+				created_at REAL,
+				last_used_at REAL
+			)
+		""")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS llm_response_cache_last_used_idx ON llm_response_cache (last_used_at)")
+		self.connection.commit()
+		self.counters = {'hits': 0, 'misses': 0, 'evicted': 0, 'invalidated': 0}
+
+	@staticmethod
+	def make_key(model, prompt_template, text, temperature):
+		return hashlib.sha256(json.dumps([model, prompt_template, text, temperature]).encode('utf-8')).hexdigest()
+
+	def get(self, key):
+		now = time.time()
+		with self.lock:
+			row = self.connection.execute("SELECT response FROM llm_response_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl)).fetchone()
+			if row:
+				self.connection.execute("UPDATE llm_response_cache SET last_used_at = ? WHERE key = ?", (now, key))
+				self.connection.commit()
+				self.counters['hits'] += 1
+				return row[0]
+			self.counters['misses'] += 1
+		return None
+
+	def put(self, key, model, response):
+		now = time.time()
+		with self.lock:
+			self.connection.execute("""
+				INSERT INTO llm_response_cache (key, model, response, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)
+				ON CONFLICT(key) DO UPDATE SET model = excluded.model, response = excluded.response, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+			""", (key, model, response, now, now))
+			self.connection.commit()
+			self.puts += 1
+			if self.puts % self.evict_every == 0:
+				self.evict(now)
+
+	# for a cached response the caller couldn't use
+	def delete(self, key):
+		with self.lock:
+			self.counters['invalidated'] += self.connection.execute("DELETE FROM llm_response_cache WHERE key = ?", (key,)).rowcount
+			self.connection.commit()
+
+	# called with the lock held
+	def evict(self, now):
+		evicted = self.connection.execute("DELETE FROM llm_response_cache WHERE created_at <= ?", (now - self.ttl,)).rowcount
+		count = self.connection.execute("SELECT count(*) FROM llm_response_cache").fetchone()[0]
+		if count > self.max_entries:
+			evicted += self.connection.execute("""
+				DELETE FROM llm_response_cache WHERE key IN (
+					SELECT key FROM llm_response_cache ORDER BY last_used_at LIMIT ?
+				)
+			""", (count - self.max_entries,)).rowcount
+		self.connection.commit()
+		self.counters['evicted'] += evicted
+		if evicted:
+			loginfo(f'Evicted {evicted} cached completion responses')
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counters)
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+		return stats
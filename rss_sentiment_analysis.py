@@ -1,30 +1,32 @@
 import schedule
 import time
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, Float, ForeignKey, DateTime, Boolean
 from db.db import DBPool
+from db.seen_filter import SeenFilter
+from db.statements import register_statement, statement_stats
+from db.work_queue import WorkQueue, LeaseLost
 from sqlalchemy.ext.declarative import declarative_base
 from dateutil.parser import parse
 import json
-from bs4 import BeautifulSoup
+import psycopg2.errors
 import sys
 import os
 from dotenv import load_dotenv
 import threading
 import signal
-from nlp.nlp import get_cmc_closest_match, get_coinpaprika_closest_match
-from openai_functions.openai import trim_text_to_token_limit, num_tokens_from_text, do_chat_completion
+from nlp.nlp import resolve_token_matches, match_cache
+from nlp.near_duplicates import NearDuplicateIndex, link_cluster_key
+from openai_functions.openai import do_chat_completion, completion_stats, response_cache
 import ws_server.ws_server as ws_server
-from utils.helper_functions import loginfo, logerror, logdebug
+from utils.helper_functions import loginfo, logerror
 from threading import Thread
 import asyncio
 import requests
-import feedparser
 from datetime import datetime
-# monkey patch feedparser because it has no timeout by default so will sometimes hang indefinitely
-headers = {
-    'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:95.0) Gecko/20100101 Firefox/95.0'
-}
-feedparser.api._open_resource = lambda *args, **kwargs: requests.get(args[0], headers=headers, timeout=30).content
+from feeds.fetcher import FeedFetcher
+from feeds.feed_cache import FeedCache
+from feeds.parser import FeedProcessPool
+from analytics.rolling import RollingAggregates, UPSERT_SENTIMENT_ROLLUP
 
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)  # 1 means line-buffering
 
@@ -36,9 +38,72 @@ POSTGRESQL_USER=os.getenv("POSTGRESQL_USER")
 POSTGRESQL_PW=os.getenv("POSTGRESQL_PW")
 POSTGRESQL_DB=os.getenv("POSTGRESQL_DB")
 CRYPTOPANIC_AUTH_TOKEN = os.getenv("CRYPTOPANIC_AUTH_TOKEN")
-DB_POOL_SIZE=1
-
-dbpool = DBPool(POSTGRESQL_HOST, POSTGRESQL_PORT, POSTGRESQL_DB, POSTGRESQL_USER, POSTGRESQL_PW, DB_POOL_SIZE)
+# enough connections for the llm workers plus both pollers
+DB_POOL_SIZE=int(os.getenv("DB_POOL_SIZE", 6))
+DB_POOL_TIMEOUT=int(os.getenv("DB_POOL_TIMEOUT", 60))
+# feeds are downloaded up front by FeedFetcher (feedparser only parses the raw bytes, since it has no timeout of its own)
+FEED_FETCH_WORKERS=int(os.getenv("FEED_FETCH_WORKERS", 16))
+FEED_FETCH_PER_HOST=int(os.getenv("FEED_FETCH_PER_HOST", 2))
+FEED_FETCH_TIMEOUT=int(os.getenv("FEED_FETCH_TIMEOUT", 30))
+FEED_FETCH_DEADLINE=int(os.getenv("FEED_FETCH_DEADLINE", 240))
+# ETag / Last-Modified / body hash of each feed, so unchanged feeds are neither downloaded in full nor parsed
+FEED_CACHE_PATH=os.getenv("FEED_CACHE_PATH", "feed_cache.sqlite3")
+# bloom filter of stored links/titles, so new entries don't need a database round trip for the duplicate check
+SEEN_FILTER_CAPACITY=int(os.getenv("SEEN_FILTER_CAPACITY", 1000000))
+SEEN_FILTER_ERROR_RATE=float(os.getenv("SEEN_FILTER_ERROR_RATE", 0.001))
+# number of enrichment workers, each one leases an article from the pending_articles queue and sends it through the
+# llm (the request/token rate itself is limited in openai_functions)
+LLM_WORKERS=int(os.getenv("LLM_WORKERS", 4))
+# a leased article goes back to the queue if it isn't done within the visibility timeout (a worker that died), failed
+# ones are retried after QUEUE_RETRY_DELAY seconds (doubling every attempt) until QUEUE_MAX_ATTEMPTS
+QUEUE_VISIBILITY_TIMEOUT=int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", 900))
+QUEUE_MAX_ATTEMPTS=int(os.getenv("QUEUE_MAX_ATTEMPTS", 6))
+QUEUE_RETRY_DELAY=int(os.getenv("QUEUE_RETRY_DELAY", 60))
+QUEUE_POLL_INTERVAL=int(os.getenv("QUEUE_POLL_INTERVAL", 5))
+# queued articles are processed newest first, where each point of the source's average impact_importance counts as
+# QUEUE_IMPORTANCE_WEIGHT hours of recency, and each e-fold of outlets carrying the same story QUEUE_CLUSTER_WEIGHT hours
+QUEUE_IMPORTANCE_WEIGHT=float(os.getenv("QUEUE_IMPORTANCE_WEIGHT", 2.0))
+QUEUE_CLUSTER_WEIGHT=float(os.getenv("QUEUE_CLUSTER_WEIGHT", 3.0))
+# articles still queued QUEUE_LATENCY_SLA seconds after they were found, from a source in the bottom
+# QUEUE_STALE_IMPORTANCE_PERCENTILE percent by average impact_importance and carried by fewer than
+# QUEUE_STALE_MIN_CLUSTER outlets, are dropped or deferred (QUEUE_STALE_ACTION: drop / defer / none)
+QUEUE_LATENCY_SLA=int(os.getenv("QUEUE_LATENCY_SLA", 3600))
+QUEUE_STALE_ACTION=os.getenv("QUEUE_STALE_ACTION", "defer")
+QUEUE_STALE_IMPORTANCE_PERCENTILE=float(os.getenv("QUEUE_STALE_IMPORTANCE_PERCENTILE", 25))
+QUEUE_STALE_MIN_CLUSTER=int(os.getenv("QUEUE_STALE_MIN_CLUSTER", 2))
+# near duplicates (the same story from several outlets, nlp/near_duplicates.py) among the articles of the last
+# NEAR_DUPLICATE_WINDOW seconds form a cluster; the llm only sees the first of them, the others reuse its analysis
+NEAR_DUPLICATE_THRESHOLD=float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.8))
+NEAR_DUPLICATE_WINDOW=int(os.getenv("NEAR_DUPLICATE_WINDOW", 48 * 3600))
+# all: pollers and enrichment workers; poller / worker: only one side, to run more workers on other nodes.
+# The ws server (live events, replay, rolling aggregates) runs with the workers and only sees the articles its own
+# process stores, so websocket clients need a single worker node (or "all"); poller nodes don't start one.
+PIPELINE_ROLE=os.getenv("PIPELINE_ROLE", "all")
+RUNS_POLLERS = PIPELINE_ROLE in ('all', 'poller')
+RUNS_WORKERS = PIPELINE_ROLE in ('all', 'worker')
+# processes that parse the feeds and turn entry html into text, and how much text to keep per field (the prompt only
+# has room for ~16k tokens, articles are trimmed to that exactly later on; this just stops megabyte long entries early)
+FEED_PARSE_WORKERS=int(os.getenv("FEED_PARSE_WORKERS", os.cpu_count() or 2))
+ARTICLE_TEXT_MAX_CHARS=int(os.getenv("ARTICLE_TEXT_MAX_CHARS", 120000))
+# split: separate summary and sentiment prompts (2 calls per article)
+# combined: one prompt returning both, falling back to split when the answer doesn't validate
+LLM_PROMPT_MODE=os.getenv("LLM_PROMPT_MODE", "split")
+
+dbpool = DBPool(POSTGRESQL_HOST, POSTGRESQL_PORT, POSTGRESQL_DB, POSTGRESQL_USER, POSTGRESQL_PW, DB_POOL_SIZE, checkout_timeout=DB_POOL_TIMEOUT)
+seen_filter = SeenFilter(SEEN_FILTER_CAPACITY, SEEN_FILTER_ERROR_RATE)
+feed_cache = FeedCache(FEED_CACHE_PATH)
+work_queue = WorkQueue(QUEUE_VISIBILITY_TIMEOUT, QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_DELAY,
+	importance_weight=QUEUE_IMPORTANCE_WEIGHT, cluster_weight=QUEUE_CLUSTER_WEIGHT, latency_sla=QUEUE_LATENCY_SLA,
+	stale_action=QUEUE_STALE_ACTION if QUEUE_STALE_ACTION != 'none' else None,
+	stale_importance_percentile=QUEUE_STALE_IMPORTANCE_PERCENTILE, stale_min_cluster_size=QUEUE_STALE_MIN_CLUSTER)
+rolling_aggregates = RollingAggregates()
+near_duplicates = NearDuplicateIndex(threshold=NEAR_DUPLICATE_THRESHOLD, window=NEAR_DUPLICATE_WINDOW)
+# only the pollers parse feeds; forks its workers right away, before the ws server (or any other) thread is started
+feed_pool = None
+if RUNS_POLLERS:
+	feed_pool = FeedProcessPool(FEED_PARSE_WORKERS, ARTICLE_TEXT_MAX_CHARS)
+	feed_pool.start()
+feed_fetcher = FeedFetcher(max_workers=FEED_FETCH_WORKERS, per_host_limit=FEED_FETCH_PER_HOST, timeout=FEED_FETCH_TIMEOUT, deadline=FEED_FETCH_DEADLINE, cache=feed_cache)
 
 # Global flag to signal thread termination
 terminate_flag = False
@@ -47,6 +112,8 @@ server_thread=None
 
 def stop_server():
 	global server_thread
+	if server_thread is None:
+		return
 	loginfo('Shutting down ws server')
 	server_thread.join()
 	loginfo('Ws server thread joined')
@@ -63,7 +130,8 @@ def start_server():
 	server_thread = Thread(target=run_server_in_thread)
 	server_thread.start()
 
-start_server()
+if RUNS_WORKERS:
+	start_server()
 
 
 def serialize_instance(instance):
@@ -77,48 +145,155 @@ def serialize_instance(instance):
 	return result
 
 
-def insert_rss_news_item(conn, newsitem):
-	query = """
-		INSERT INTO rss_news_items
-		(title, link, published, summary, content, description, one_sentence_summary, two_sentence_summary, topic_keywords, impact_importance, is_crypto_news, source)
-		VALUES
-		(:title, :link, :published, :summary, :content, :description, :one_sentence_summary, :two_sentence_summary, :topic_keywords, :impact_importance, :is_crypto_news, :source)
-		RETURNING id;
-	"""
-	params = newsitem.__dict__
-	results = conn.execute_query(query, params)
+INSERT_RSS_NEWS_ITEM = register_statement('insert_rss_news_item', """
+	INSERT INTO rss_news_items
+	(title, link, published, summary, content, description, one_sentence_summary, two_sentence_summary, topic_keywords, impact_importance, is_crypto_news, source, cluster_key)
+	VALUES
+	(:title, :link, :published, :summary, :content, :description, :one_sentence_summary, :two_sentence_summary, :topic_keywords, :impact_importance, :is_crypto_news, :source, :cluster_key)
+	RETURNING id;
+""")
+
+INSERT_RSS_NEWS_SENTIMENT = register_statement('insert_rss_news_sentiment', """
+	INSERT INTO rss_news_sentiment
+	(crypto_type, crypto_name, symbol, org_name, sentiment_score, movement_score, indicator_certainty, sentiment_timestamp, best_match_cmc_id, best_match_cmc_name, best_match_cmc_match_score, best_match_coinpaprika_id, best_match_coinpaprika_match_score, newsitem_id)
+	VALUES
+	(:crypto_type, :crypto_name, :symbol, :org_name, :sentiment_score, :movement_score, :indicator_certainty, :sentiment_timestamp, :best_match_cmc_id, :best_match_cmc_name, :best_match_cmc_match_score, :best_match_coinpaprika_id, :best_match_coinpaprika_match_score, :newsitem_id);
+""")
+
+def insert_rss_news_item(tx, newsitem):
+	results = tx.execute_statement(INSERT_RSS_NEWS_ITEM, newsitem.__dict__)
+	return results[0][0]
+
+def insert_rss_news_sentiments(tx, sentiments):
+	# all of an article's sentiments in one round trip
+	tx.execute_statement_batch(INSERT_RSS_NEWS_SENTIMENT, [sentiment.__dict__ for sentiment in sentiments])
+
+# the coins (cmc ids) and scores passed along with each event decide which websocket subscribers receive it
+def publish_rss_news_item(newsitem, sentiments):
 	try:
 		event_data = serialize_instance(newsitem)
-		ws_server.message_queue.put(json.dumps({
-			'type': 'newsitem',
-			'data': event_data
-		}))
+		certainties = [s.indicator_certainty for s in sentiments if s.indicator_certainty is not None]
+		ws_server.publish('newsitem', event_data,
+			coins=[s.best_match_cmc_id for s in sentiments],
+			impact_importance=newsitem.impact_importance,
+			indicator_certainty=max(certainties) if certainties else None)
 	except Exception as e:
-		logerror('! insert_rss_news_item exception')
-		logerror(e)		
-	return results[0][0]
+		logerror('! publish_rss_news_item exception')
+		logerror(e)
 
-def insert_rss_news_sentiment(conn, sentiment):
-	query = """
-		INSERT INTO rss_news_sentiment
-		(crypto_type, crypto_name, symbol, org_name, sentiment_score, movement_score, indicator_certainty, sentiment_timestamp, best_match_cmc_id, best_match_cmc_name, best_match_cmc_match_score, best_match_coinpaprika_id, best_match_coinpaprika_match_score, newsitem_id)
-		VALUES
-		(:crypto_type, :crypto_name, :symbol, :org_name, :sentiment_score, :movement_score, :indicator_certainty, :sentiment_timestamp, :best_match_cmc_id, :best_match_cmc_name, :best_match_cmc_match_score, :best_match_coinpaprika_id, :best_match_coinpaprika_match_score, :newsitem_id);
-	"""
-	params = sentiment.__dict__
-	conn.execute_query(query, params)
+def publish_rss_news_sentiment(sentiment, newsitem):
 	try:
 		event_data = serialize_instance(sentiment)
 		del event_data['newsitem_id']
-		ws_server.message_queue.put(json.dumps({
-			'type': 'sentiment',
-			'data': dict(event_data)
-		}))
+		ws_server.publish('sentiment', event_data,
+			coins=[sentiment.best_match_cmc_id],
+			impact_importance=newsitem.impact_importance,
+			indicator_certainty=sentiment.indicator_certainty)
+	except Exception as e:
+		logerror('! publish_rss_news_sentiment exception')
+		logerror(e)
+
+# websocket catch-up from the database (ws_server/replay.py), for clients that were disconnected for longer than
+# the replay buffer covers; the events are shaped like the ones published live
+BACKFILL_NEWSITEM_COLUMNS = ('id', 'title', 'link', 'published', 'summary', 'content', 'description', 'source', 'one_sentence_summary', 'two_sentence_summary', 'topic_keywords', 'impact_importance', 'is_crypto_news', 'cluster_key')
+BACKFILL_SENTIMENT_COLUMNS = ('newsitem_id', 'crypto_type', 'crypto_name', 'symbol', 'org_name', 'sentiment_score', 'movement_score', 'indicator_certainty', 'sentiment_timestamp', 'best_match_cmc_id', 'best_match_cmc_name', 'best_match_cmc_match_score', 'best_match_coinpaprika_id', 'best_match_coinpaprika_match_score')
+
+SELECT_RSS_NEWS_ITEMS_FOR_BACKFILL = register_statement('select_rss_news_items_for_backfill', """
+	SELECT """ + ', '.join(BACKFILL_NEWSITEM_COLUMNS) + """
+	FROM rss_news_items
+	WHERE id > :after_id
+	ORDER BY id
+	LIMIT :limit;
+""")
+
+SELECT_RSS_NEWS_SENTIMENTS_FOR_BACKFILL = register_statement('select_rss_news_sentiments_for_backfill', """
+	SELECT """ + ', '.join(BACKFILL_SENTIMENT_COLUMNS) + """
+	FROM rss_news_sentiment
+	WHERE newsitem_id = ANY(:newsitem_ids::int[])
+	ORDER BY newsitem_id, id;
+""")
+
+def serialize_row(columns, row):
+	return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in zip(columns, row)}
+
+# the newsitems after after_newsitem_id (up to limit of them), each followed by its sentiments
+def load_backfill_events(after_newsitem_id, limit):
+	with dbpool as conn:
+		newsitems = conn.execute_statement(SELECT_RSS_NEWS_ITEMS_FOR_BACKFILL, {'after_id': after_newsitem_id, 'limit': limit})
+		if not newsitems:
+			return []
+		sentiments = conn.execute_statement(SELECT_RSS_NEWS_SENTIMENTS_FOR_BACKFILL, {'newsitem_ids': [row[0] for row in newsitems]})
+	by_newsitem = {}
+	for row in sentiments:
+		by_newsitem.setdefault(row[0], []).append(serialize_row(BACKFILL_SENTIMENT_COLUMNS, row))
+	events = []
+	for row in newsitems:
+		newsitem = serialize_row(BACKFILL_NEWSITEM_COLUMNS, row)
+		item_sentiments = by_newsitem.get(newsitem['id'], [])
+		certainties = [s['indicator_certainty'] for s in item_sentiments if s['indicator_certainty'] is not None]
+		events.append({'type': 'newsitem', 'data': newsitem, 'newsitem_id': newsitem['id'],
+			'coins': [s['best_match_cmc_id'] for s in item_sentiments],
+			'impact_importance': newsitem['impact_importance'],
+			'indicator_certainty': max(certainties) if certainties else None})
+		for sentiment in item_sentiments:
+			del sentiment['newsitem_id']
+			events.append({'type': 'sentiment', 'data': sentiment, 'newsitem_id': newsitem['id'],
+				'coins': [sentiment['best_match_cmc_id']],
+				'impact_importance': newsitem['impact_importance'],
+				'indicator_certainty': sentiment['indicator_certainty']})
+	return events
+
+ws_server.broadcaster.backfill.loader = load_backfill_events
+
+def publish_rolling_aggregates(coins):
+	try:
+		for coin, windows in rolling_aggregates.snapshot(coins).items():
+			ws_server.publish('aggregate', {'coin': coin, 'windows': windows}, coins=[coin])
 	except Exception as e:
-		logerror('! insert_rss_news_item exception')
+		logerror('! publish_rolling_aggregates exception')
 		logerror(e)
 
-def check_existing_rss_news_item(conn, link, title):
+# writes the news item, all of its sentiments and their rolling aggregate buckets in a single transaction (one commit),
+# and only once that has committed are they added to the seen filter, the in memory aggregates and published to
+# websocket clients. With a lease, its pending_articles row is deleted in the same transaction.
+def store_rss_news_item(conn, newsitem, sentiments, lease=None):
+	contributions = rolling_aggregates.contributions(sentiments)
+
+	def work(tx):
+		if lease is not None:
+			work_queue.complete(tx, lease)
+		newsitem_id = insert_rss_news_item(tx, newsitem)
+		for sentiment in sentiments:
+			sentiment.newsitem_id = newsitem_id
+		if sentiments:
+			insert_rss_news_sentiments(tx, sentiments)
+		rollup_rows = rolling_aggregates.rollup_rows(contributions)
+		if rollup_rows:
+			tx.execute_statement_batch(UPSERT_SENTIMENT_ROLLUP, rollup_rows)
+		return newsitem_id
+
+	newsitem_id = conn.execute_transaction(work)
+	newsitem.id = newsitem_id
+	seen_filter.add(newsitem.link, newsitem.title)
+	changed = rolling_aggregates.add(contributions)
+	publish_rss_news_item(newsitem, sentiments)
+	for sentiment in sentiments:
+		publish_rss_news_sentiment(sentiment, newsitem)
+	publish_rolling_aggregates(changed)
+	return newsitem_id
+
+# normalised title hash, must match the generated rss_news_items.title_hash column in schema.sql
+TITLE_HASH_SQL = "md5(lower(btrim(regexp_replace({}, '\\s+', ' ', 'g'))))"
+
+FIND_EXISTING_RSS_NEWS_ITEMS = register_statement('find_existing_rss_news_items', """
+	SELECT i.idx - 1
+	FROM unnest(:links::text[], :titles::text[]) WITH ORDINALITY AS i(link, title, idx)
+	WHERE EXISTS (SELECT 1 FROM rss_news_items r WHERE r.link = i.link)
+		OR EXISTS (SELECT 1 FROM pending_articles p WHERE p.link = i.link)
+		OR EXISTS (SELECT 1 FROM rss_news_items r WHERE r.title_hash = """ + TITLE_HASH_SQL.format('i.title') + """);
+""")
+
+def find_existing_rss_news_items(conn, items):
 	# we actually want to keep duplicate stories (e.g. same headline) if multiple news outlets are picking it up
 	# because this reflects trends we want to be capturing
 	# HOWEVER while we are using the cheap tier of cryptopanic api, we have to also check for duplicate titles
@@ -126,15 +301,33 @@ def check_existing_rss_news_item(conn, link, title):
 	# summary on the cryptopanic site (so we can't rely on the url comparison alone)
 
 	# Also check if title is in db because we might have overlap with cryptopanic since all urls from their api direct to cryptopanic website
-	query = """
-		SELECT id FROM rss_news_items WHERE link = :link OR title = :title;
-	"""
-	params = {'link': link, 'title': title}
-	results = conn.execute_query(query, params)
-	if results:
-		return True
-	else:
-		return False	
+
+	# items is a list of dicts with 'link' and 'title' (e.g. every entry of one feed, or one cryptopanic page)
+	# they are all checked in a single round trip; the link and the title hash are separate EXISTS probes so each one
+	# gets its own index (a single "link = x OR title = y" can't use one index cleanly)
+	# links that are still in pending_articles (queued, or failed for good) count as existing too
+	# returns the set of positions in items that already exist
+	if not items:
+		return set()
+	params = {
+		'links': [item['link'] for item in items],
+		'titles': [item['title'] for item in items]
+	}
+	results = conn.execute_statement(FIND_EXISTING_RSS_NEWS_ITEMS, params)
+	return {r[0] for r in results or []}
+
+# same as find_existing_rss_news_items, but items that are definitely new according to seen_filter never reach the database
+def filter_existing_rss_news_items(items):
+	if not seen_filter.ready:
+		with dbpool as conn:
+			return find_existing_rss_news_items(conn, items)
+	possible = [i for i, item in enumerate(items) if seen_filter.might_contain(item['link'], item['title'])]
+	if not possible:
+		return set()
+	with dbpool as conn:
+		found = find_existing_rss_news_items(conn, [items[i] for i in possible])
+	seen_filter.record_confirmation(len(found))
+	return {possible[i] for i in found}
 
 PROMPT_TEMPLATE = """You are chatgpt, an expert in semantic analysis. Your task is to analyse the following crypto news item for sentiment about crypto coins & tokens:
 
@@ -185,6 +378,43 @@ Try to assess the article's impact to the crypto project (if the article is abou
 6-9 means medium to strong impact
 10 means very strong impact
 """
+
+COMBINED_PROMPT_TEMPLATE = """You are chatgpt, an expert crypto article summariser and an expert in semantic analysis. Your task is to analyse the following crypto news item, give an importance rating and summary, and extract sentiment about crypto coins & tokens:
+
+<NEWS_ITEM>
+[END ARTICLE]
+
+Part 1, the summary. Your task is to:
+1. Generate a one sentence summary
+2. Generate a two sentence summary
+3. Generate a list of keywords representing the primary topic of the article, separated by comma
+4. Rate the impact & importance of the article (0-10)
+5. Specify whether the news is about crypto (true/false)
+
+Notes on impact_importance ratings:
+This represents the impact to the crypto project or industry or whatever the topic is. The higher ratings (6+) should be reserved for news with strong impact or wide reaching consequences. Use the lower ratings (0-5) for news that is "everyday" run of the mill crypto news that won't make waves.
+Many articles will be zero or low impact because of the nature of the news. You don't need to try to centre the impact ratings around 5.
+Try to assess the article's impact to the crypto project (if the article is about specific one(s), or to the crypto market as a whole.
+0 means no discernable impact (e.g. it's advertising, a how-to guide, a fluff post or otherwise has no impact)
+1-4 means low-mid impact
+5 means significant medium level impact
+6-9 means medium to strong impact
+10 means very strong impact
+
+Part 2, the sentiment. Determine which cryptocurrency tokens/projects/chains are mentioned in a way that expresses positive or negative sentiment. You should ignore any that are only tangentially mentioned and not the subject of the news piece. Focus on the cryptos that any sentiment in the article meaningfully applies to. For each of these you should extract:
+
+1. The type: defi token / coin / chain / exchange / stock / fiat / other
+2. Its name
+3. Sentiment: -10 to 10
+4. Is the content of the article likely to correlate with price movement (-10 to 10), with -10 being strong downward movement and 10 being strong upward movement
+5. How strongly does the content indicate this predicted movement? (0-10)
+
+If there were no cryptos referenced with meaningful sentiment, use an empty list []. Remember: not include stocks or other entities; we are only interested in crypto coins & tokens.
+
+Give your answer as a single valid json document as per this example, with no additional commentary:
+
+{"summary": {"one_sentence_summary": "<summary>", "two_sentence_summary": "<summary>", "topic_keywords": "<comma separated keywords>", "impact_importance": <rating 0-10>, "is_crypto_news": <true/false>}, "sentiments": [{"type": "<type>", "name": "<name>", "symbol": "<symbol if known>", "org_name": "<organisation name if known>", "sentiment": [-10-10], "movement": [-10-10], "indicator_certainty": 0-10}, ...]}
+"""
 Base = declarative_base()
 class RssNewsItem(Base):
 	__tablename__ = 'rss_news_items'
@@ -202,6 +432,7 @@ class RssNewsItem(Base):
 	topic_keywords = Column(Text)
 	impact_importance = Column(Integer)
 	is_crypto_news = Column(Boolean)
+	cluster_key = Column(Text)
 
 class RssNewsSentiment(Base):
 	__tablename__ = 'rss_news_sentiment'
@@ -297,35 +528,148 @@ rss_feeds = [
 #soup = BeautifulSoup(result.content, features="html.parser")
 
 
-def process_article(article, data):
-	global terminate_flag
+SUMMARY_KEYS = ("one_sentence_summary", "two_sentence_summary", "topic_keywords", "impact_importance", "is_crypto_news")
+SENTIMENT_KEYS = ("type", "name", "sentiment", "movement", "indicator_certainty")
+
+def is_number(value):
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# schema check for the combined prompt's answer, anything that doesn't match is rejected (and we fall back to split mode)
+def validate_combined_response(response):
+	if not isinstance(response, dict) or not isinstance(response.get('summary'), dict) or not isinstance(response.get('sentiments'), list):
+		return False
+	summary_data = response['summary']
+	if not all(k in summary_data for k in SUMMARY_KEYS):
+		return False
+	if not all(isinstance(summary_data[k], str) for k in ("one_sentence_summary", "two_sentence_summary", "topic_keywords")):
+		return False
+	if not is_number(summary_data['impact_importance']) or not 0 <= summary_data['impact_importance'] <= 10 or not isinstance(summary_data['is_crypto_news'], bool):
+		return False
+	for r in response['sentiments']:
+		if not isinstance(r, dict) or not all(k in r for k in SENTIMENT_KEYS):
+			return False
+		if not all(is_number(r[k]) for k in ("sentiment", "movement", "indicator_certainty")):
+			return False
+	return True
+
+def parse_json(response_content):
+	try:
+		return json.loads(response_content)
+	except ValueError:
+		return None
+
+# what do_chat_completion may cache for each prompt
+def is_valid_combined_response(response_content):
+	return validate_combined_response(parse_json(response_content))
+
+def is_valid_summary_response(response_content):
+	summary_data = parse_json(response_content)
+	return isinstance(summary_data, dict) and all(k in summary_data for k in SUMMARY_KEYS)
+
+def is_valid_sentiment_response(response_content):
+	responses = parse_json(response_content)
+	return isinstance(responses, list) and all(isinstance(r, dict) for r in responses)
+
+# one call for summary + sentiment, returns (summary_data, responses) or None if the call failed or didn't validate
+def analyse_article_combined(article):
+	start = time.time()
+	usage = {}
+	response_content = do_chat_completion(COMBINED_PROMPT_TEMPLATE, article, '<NEWS_ITEM>', 800, 5, should_stop=lambda: terminate_flag, usage=usage, validate=is_valid_combined_response)
+	if terminate_flag or not response_content:
+		completion_stats.record('combined', time.time() - start, usage, fallback=True)
+		return None
+	response = parse_json(response_content)
+	if not validate_combined_response(response):
+		loginfo('Invalid combined summary/sentiment response, falling back to separate prompts')
+		loginfo(response_content)
+		completion_stats.record('combined', time.time() - start, usage, fallback=True)
+		return None
+	completion_stats.record('combined', time.time() - start, usage)
+	return response['summary'], response['sentiments']
+
+# separate summary and sentiment calls
+# returns (summary_data, responses), None if it should be retried later, or False if the article should be skipped
+def analyse_article_split(article):
+	start = time.time()
+	usage = {}
 	# generate summary & impact rating
-	response_content = do_chat_completion(SUMMARY_PROMPT_TEMPLATE, article, '<NEWS_ITEM>', 800, 5)
+	response_content = do_chat_completion(SUMMARY_PROMPT_TEMPLATE, article, '<NEWS_ITEM>', 800, 5, should_stop=lambda: terminate_flag, usage=usage, validate=is_valid_summary_response)
 	if terminate_flag:
-		return
+		return None
 	
 	if not response_content:
-		return
+		return None
 
 	# Parse the JSON response content
 	summary_data = json.loads(response_content)
 	# {"one_sentence_summary": "<summary>", "two_sentence_summary": "<summary>", "topic_keywords": "<comma separated keywords>", "impact_importance": <rating 0-10>, "is_crypto_news": <true/false>}
-	if not all(k in summary_data for k in ("one_sentence_summary", "two_sentence_summary", "topic_keywords", "impact_importance", "is_crypto_news")):
+	if not all(k in summary_data for k in SUMMARY_KEYS):
 		loginfo(f"Skipping news item because of invalid summary data.")
 		loginfo(summary_data)
-		return
+		return False
 
 
 	# generate sentiment data
-	response_content = do_chat_completion(PROMPT_TEMPLATE, article, '<NEWS_ITEM>', 800, 5)
+	response_content = do_chat_completion(PROMPT_TEMPLATE, article, '<NEWS_ITEM>', 800, 5, should_stop=lambda: terminate_flag, usage=usage, validate=is_valid_sentiment_response)
 	if terminate_flag:
-		return
+		return None
 	
 	if not response_content:
-		return
+		return None
 
 	# Parse the JSON response content
 	responses = json.loads(response_content)
+	completion_stats.record('split', time.time() - start, usage)
+	return summary_data, responses
+
+CLUSTER_SENTIMENT_COLUMNS = ('crypto_type', 'crypto_name', 'symbol', 'org_name', 'sentiment_score', 'movement_score', 'indicator_certainty', 'best_match_cmc_id', 'best_match_cmc_name', 'best_match_cmc_match_score', 'best_match_coinpaprika_id', 'best_match_coinpaprika_match_score')
+
+SELECT_CLUSTER_NEWS_ITEM = register_statement('select_cluster_news_item', """
+	SELECT id, """ + ', '.join(SUMMARY_KEYS) + """
+	FROM rss_news_items
+	WHERE cluster_key = :cluster_key
+	ORDER BY id
+	LIMIT 1;
+""")
+
+SELECT_CLUSTER_SENTIMENTS = register_statement('select_cluster_sentiments', """
+	SELECT """ + ', '.join(CLUSTER_SENTIMENT_COLUMNS) + """
+	FROM rss_news_sentiment
+	WHERE newsitem_id = :newsitem_id
+	ORDER BY id;
+""")
+
+# the analysis an earlier article of the cluster was stored with: (newsitem id, summary data, sentiment columns),
+# None if none of them has been stored yet
+def load_cluster_analysis(cluster_key):
+	with dbpool as conn:
+		rows = conn.execute_statement(SELECT_CLUSTER_NEWS_ITEM, {'cluster_key': cluster_key})
+		if not rows:
+			return None
+		sentiments = conn.execute_statement(SELECT_CLUSTER_SENTIMENTS, {'newsitem_id': rows[0][0]})
+	return rows[0][0], dict(zip(SUMMARY_KEYS, rows[0][1:])), [dict(zip(CLUSTER_SENTIMENT_COLUMNS, row)) for row in sentiments]
+
+# returns True once the article has been handled (stored or deliberately skipped), None if it should be retried later
+# a near duplicate of an article that has already been stored gets that article's summary and sentiments (and coin
+# matches) without going through the llm, it is still stored as a news item of its own
+def process_article(article, data, lease=None):
+	global terminate_flag
+	cluster_key = lease.cluster_key if lease is not None else None
+	cluster_analysis = load_cluster_analysis(cluster_key) if cluster_key else None
+	if cluster_analysis is not None:
+		representative_id, summary_data, cluster_sentiments = cluster_analysis
+		loginfo(f"Reusing the analysis of news item {representative_id} for near duplicate {data['link']}")
+	else:
+		analysis = None
+		if LLM_PROMPT_MODE == 'combined':
+			analysis = analyse_article_combined(article)
+		if analysis is None and not terminate_flag:
+			analysis = analyse_article_split(article)
+		if terminate_flag or analysis is None:
+			return
+		if analysis is False:
+			return True
+		summary_data, responses = analysis
 
 	# Store the news item and sentiment in the database
 
@@ -341,22 +685,30 @@ def process_article(article, data):
 		topic_keywords = summary_data['topic_keywords'],
 		impact_importance = summary_data['impact_importance'],
 		is_crypto_news = summary_data['is_crypto_news'],
-		source = data['source']
+		source = data['source'],
+		cluster_key = cluster_key
 	)
-	with dbpool as conn:
-		newsitem_id = insert_rss_news_item(conn, newsitem)
+	if cluster_analysis is not None:
+		sentiments = [RssNewsSentiment(**columns, sentiment_timestamp=data['published']) for columns in cluster_sentiments]
+		with dbpool as conn:
+			store_rss_news_item(conn, newsitem, sentiments, lease)
+		return True
 
+	# resolve the token matches before taking a db connection, so other workers aren't kept waiting on the http lookups
+	valid_responses = []
 	for r in responses:
 			# Check validity of required fields
-			if not all(k in r for k in ("type", "name", "sentiment", "movement", "indicator_certainty")):
-					loginfo(f"Skipping invalid sentiment data for news item {newsitem.id}")
+			if not all(k in r for k in SENTIMENT_KEYS):
+					loginfo(f"Skipping invalid sentiment data for news item {newsitem.title}")
 					continue
-			
 			loginfo(r)
-			cmc_match = get_cmc_closest_match(r.get('name'))
-			coinpaprika_match = get_coinpaprika_closest_match(r.get('name'))
+			valid_responses.append(r)
 
-			sentiment = RssNewsSentiment(
+	# all of the article's lookups are dispatched together
+	matches = resolve_token_matches([(str(r.get('name') or ''), str(r.get('symbol') or '')) for r in valid_responses])
+	sentiments = []
+	for r, (cmc_match, coinpaprika_match) in zip(valid_responses, matches):
+			sentiments.append(RssNewsSentiment(
 					crypto_type=r.get('type'), 
 					crypto_name=r.get('name'), 
 					symbol=r.get('symbol'), 
@@ -369,10 +721,67 @@ def process_article(article, data):
 					best_match_cmc_name = cmc_match['name'],
 					best_match_cmc_match_score = cmc_match['score'],
 					best_match_coinpaprika_id = coinpaprika_match['id'],																		
-					best_match_coinpaprika_match_score = coinpaprika_match['score'],
-					newsitem_id=newsitem_id
-			)
-			insert_rss_news_sentiment(conn, sentiment)
+					best_match_coinpaprika_match_score = coinpaprika_match['score']
+			))
+
+	with dbpool as conn:
+		store_rss_news_item(conn, newsitem, sentiments, lease)
+	return True
+
+# a leased pending article: acked once handled, released back to the queue when we are shutting down, otherwise
+# retried later (the lease is what keeps it from being lost if this process dies first)
+def process_pending_article(lease):
+	data = dict(lease.data)
+	data['published'] = parse(data['published']) if data.get('published') else None
+	error = None
+	try:
+		done = process_article(lease.article, data, lease)
+	except LeaseLost as e:
+		loginfo(f"! {e}, {data['link']} was left to the worker that leased it again")
+		return
+	except psycopg2.errors.UniqueViolation:
+		# stored already (e.g. by another worker whose lease had expired), nothing left to do
+		loginfo(f"! {data['link']} is already stored")
+		done = True
+	except Exception as e:
+		logerror(f"! process_article exception for {data['link']}")
+		logerror(e)
+		done, error = None, e
+	with dbpool as conn:
+		if done:
+			work_queue.ack(conn, lease)
+		elif terminate_flag:
+			work_queue.release(conn, lease)
+		else:
+			work_queue.retry(conn, lease, error)
+
+def enrichment_worker():
+	while not terminate_flag:
+		try:
+			with dbpool as conn:
+				leases = work_queue.lease(conn)
+			for lease in leases:
+				process_pending_article(lease)
+		except Exception as e:
+			logerror('! enrichment_worker exception')
+			logerror(e)
+			leases = []
+		if not leases:
+			sleptfor = 0
+			while (not terminate_flag) and sleptfor < QUEUE_POLL_INTERVAL:
+				time.sleep(1)
+				sleptfor += 1
+
+# items are (article, data); each one is put in its near duplicate cluster (over the text it will be stored with)
+# Queued links go in this process's seen filter straight away: the worker that stores them may well be another
+# process, and the database check behind the filter also looks at pending_articles.
+def enqueue_articles(items):
+	cluster_keys = [near_duplicates.assign(' '.join((data['title'], data['description'], data['content'])), link_cluster_key(data['link']), data['title'], link=data['link']) for article, data in items]
+	with dbpool as conn:
+		added = work_queue.enqueue(conn, items, cluster_keys)
+	for article, data in items:
+		seen_filter.add(data['link'], data['title'])
+	return added
 	
 
 def check_cryptopanic():
@@ -380,40 +789,37 @@ def check_cryptopanic():
 	url = 'https://cryptopanic.com/api/v1/posts/?auth_token='+CRYPTOPANIC_AUTH_TOKEN+'&metadata=true'
 	while not terminate_flag:
 		loginfo('Starting cryptopanic update')
+		items = []
 		try:
 			result = requests.get(url).json()
-			for r in result['results']:
+			posts = [r for r in result['results'] if 'metadata' in r and 'description' in r['metadata']]
+
+			# Check which of this page's posts already exist in the database, in one query
+			existing = filter_existing_rss_news_items([{'title': r['title'], 'link': r['url']} for r in posts])
+
+			for i, r in enumerate(posts):
 				if terminate_flag:
 					return
+				if i in existing:
+					continue
 				try:
-					if 'metadata' not in r or 'description' not in r['metadata']:
-						continue
-					
-					# Prepare data for checking
 					data = {
 						'title': r['title'],
-						'link': r['url']
-					}
-
-					# Check if this url already exists in the database
-					with dbpool as conn:
-						if check_existing_rss_news_item(conn, data['link'], data['title']):
-							continue
-
-					# Populate the remaining data fields
-					data.update({
+						'link': r['url'],
 						'published': r['published_at'],
 						'summary': '',
 						'content': '',
 						'description': r['metadata']['description'],
 						'source': r['source']['domain']
-					})
+					}
 
 					article = data['source'] + '\n' + data['title'] + '\n' + data['description']
-					process_article(article, data)
+					items.append((article, data))
 				except Exception as e:
 					loginfo('! inner check_cryptopanic exception')
 					loginfo(e)
+			# the enrichment workers take it from here; posts that are still queued from the last poll are left as they are
+			loginfo('Queued', enqueue_articles(items), 'new cryptopanic articles')
 		except Exception as e:
 			loginfo('! check_cryptopanic exception')
 			loginfo(e)
@@ -432,60 +838,105 @@ def check_feeds():
 
 	loginfo('## Starting rss update')
 
-	for feed_url in rss_feeds:
+	# download every feed in parallel first, then parse all of them in the feed processes
+	fetched = feed_fetcher.fetch_all(rss_feeds, should_stop=lambda: terminate_flag)
+	queued = 0
+
+	to_parse = {}
+	for feed_url, fetch_result in fetched.items():
+		if fetch_result['error']:
+			loginfo(f"Failed to fetch the RSS feed at {feed_url}. Error: {fetch_result['error']}")
+			continue
+		if fetch_result['not_modified']:
+			loginfo(f'Feed {feed_url} unchanged since last sweep, skipping')
+			continue
+		to_parse[feed_url] = fetch_result['content']
+
+	for feed_url, entries in feed_pool.parse_all(to_parse):
 		if terminate_flag:
 			return
 		loginfo('>> FEED: ' + feed_url)
+		fetch_result = fetched[feed_url]
+		if isinstance(entries, Exception):
+			loginfo(f"Failed to parse the RSS feed at {feed_url}. Error: {entries}")
+			continue
+
+		# Check which of this feed's entries already exist in the database, in one query
 		try:
-			feed = feedparser.parse(feed_url)
+			existing = filter_existing_rss_news_items([{'title': entry['title'], 'link': entry['link']} for entry in entries])
 		except Exception as e:
-			loginfo(f"Failed to fetch or parse the RSS feed at {feed_url}. Error: {e}")
+			loginfo(f"Failed to check for existing news items from {feed_url}. Error: {e}")
+			continue
+
+		entries = [entry for i, entry in enumerate(entries) if i not in existing]
+		if not entries:
+			feed_fetcher.mark_processed(fetch_result)
 			continue
 
-		for entry in feed.entries:
+		# the description and content html of the feed's new entries, as text (in the feed processes too)
+		try:
+			texts = feed_pool.extract_texts(entries)
+		except Exception as e:
+			loginfo(f"Failed to extract the text of the RSS feed at {feed_url}. Error: {e}")
+			continue
+
+		items = []
+		for entry, (description_text, content_text) in zip(entries, texts):
 			if terminate_flag:
 				return
 			try:
-					# Prepare data for checking
 					data = {
-						'title': entry.title,
-						'link': entry.link
+						'title': entry['title'],
+						'link': entry['link']
 					}
 
-					# Check if this entry already exists in the database
-					with dbpool as conn:
-						if check_existing_rss_news_item(conn, data['link'], data['title']):
-							continue
-
 					# Parse the published date
-					published_date = parse(entry.published)
-
-					# Clean the description field
-					soup = BeautifulSoup(entry.description, features="html.parser")
-					description_text = soup.get_text()
-
-					# Clean the content field
-					try:
-						content_json = json.dumps(entry.content)
-					except Exception as e:
-						#loginfo(f"Failed to convert entry.content to JSON for news item {entry.title}. Error: {e}")
-						content_json = ""
-					soup = BeautifulSoup(content_json, features="html.parser")
-					content_text = soup.get_text()
-
-					article = 'Published: ' + entry.published + '\n' + entry.title + '\n' + entry.summary + '\n' + description_text + '\n' + content_text
+					published_date = parse(entry['published'])
+
+					article = 'Published: ' + entry['published'] + '\n' + entry['title'] + '\n' + entry['summary'] + '\n' + description_text + '\n' + content_text
 					data.update({
 						'published': published_date,
-						'summary': entry.summary,
+						'summary': entry['summary'],
 						'content': content_text,
 						'description': description_text,
 						'source': feed_url
 					})
-					process_article(article, data)
+					items.append((article, data))
 			except Exception as e:
-					loginfo(f"An error occurred while processing news item {entry.link}. Error: {e}")
+					loginfo(f"An error occurred while processing news item {entry['link']}. Error: {e}")
 
-	loginfo('!! Done RSS update !!')
+		# the enrichment workers take it from here; the feed's validators are only remembered once its entries are
+		# safely in the queue, so they get picked up again next sweep if queueing fails
+		try:
+			queued += enqueue_articles(items)
+		except Exception as e:
+			loginfo(f"Failed to queue the news items of {feed_url}. Error: {e}")
+			continue
+		feed_fetcher.mark_processed(fetch_result)
+
+	loginfo('!! Done RSS update !!', queued, 'news items queued')
+	loginfo('Seen filter:', seen_filter.stats())
+	loginfo('DB pool:', dbpool.stats(reset=True))
+	loginfo('DB statements:', statement_stats(reset=True))
+	loginfo('Completions:', completion_stats.stats())
+	loginfo('Token match cache:', match_cache.stats(reset=True))
+	loginfo('Websocket:', ws_server.broadcaster.stats())
+	loginfo('Rolling aggregates:', rolling_aggregates.stats())
+	loginfo('Near duplicates:', near_duplicates.stats(reset=True))
+	try:
+		with dbpool as conn:
+			loginfo('Work queue:', work_queue.stats(conn))
+	except Exception as e:
+		logerror('! work queue stats failed')
+		logerror(e)
+	try:
+		with dbpool as conn:
+			rolling_aggregates.prune(conn)
+	except Exception as e:
+		logerror('! rollup prune failed')
+		logerror(e)
+	if response_cache:
+		loginfo('Completion cache:', response_cache.stats())
 	loginfo('Completed in', round(time.time() - start, 1), 's')
 
 
@@ -504,12 +955,43 @@ def main():
 	# Register signal handler for SIGINT (Ctrl+C)
 	signal.signal(signal.SIGINT, signal_handler)
 
-	#check_feeds()
-	schedule.every(10).minutes.do(check_feeds)
+	# load the links/titles we already have into the seen filter (if this fails we just keep asking the database)
+	try:
+		with dbpool as conn:
+			seen_filter.warm(conn)
+	except Exception as e:
+		logerror('! seen filter warm up failed')
+		logerror(e)
+
+	# rolling per coin sentiment, from rss_news_sentiment_rollup (kept up to date by the workers as they store)
+	if RUNS_WORKERS:
+		try:
+			with dbpool as conn:
+				rolling_aggregates.load(conn)
+			ws_server.broadcaster.aggregates = rolling_aggregates
+		except Exception as e:
+			logerror('! rolling aggregates load failed')
+			logerror(e)
+
+	threads = []
+	if RUNS_POLLERS:
+		# the recent articles, so the first sweeps after a restart still find their near duplicates
+		try:
+			with dbpool as conn:
+				loginfo('Near duplicate index warmed with', near_duplicates.warm(conn), 'articles')
+		except Exception as e:
+			logerror('! near duplicate index warm up failed')
+			logerror(e)
+
+		#check_feeds()
+		schedule.every(10).minutes.do(check_feeds)
 
-	# Start the thread
-	my_thread = threading.Thread(target=check_cryptopanic)
-	my_thread.start()
+		# Start the thread
+		threads.append(threading.Thread(target=check_cryptopanic))
+	if RUNS_WORKERS:
+		threads.extend(threading.Thread(target=enrichment_worker, name=f'enrichment-{i}') for i in range(LLM_WORKERS))
+	for thread in threads:
+		thread.start()
 
 	try:
 		# Your main program logic here
@@ -521,11 +1003,16 @@ def main():
 		logerror(e)
 		pass
 	finally:
-		# Wait for the thread to finish before exiting the program
-		loginfo('Attempting to join thread')
-		my_thread.join(timeout=15)  # Wait for 5 seconds at most
-		if my_thread.is_alive():
-			loginfo("Thread did not terminate in time. Force quitting.")
+		if feed_pool is not None:
+			feed_pool.shutdown()
+		# Wait for the threads to finish before exiting the program; an article still leased by a worker that doesn't
+		# make it goes back to the queue once its visibility timeout is over
+		loginfo('Attempting to join threads')
+		deadline = time.time() + 15
+		for thread in threads:
+			thread.join(timeout=max(0, deadline - time.time()))
+		if any(thread.is_alive() for thread in threads):
+			loginfo("Threads did not terminate in time. Force quitting.")
 		else:
 			loginfo("Program exit.")
 		#loginfo("Program exit.")
@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS pending_articles;
+DROP TABLE IF EXISTS rss_news_sentiment_rollup;
 DROP TABLE IF EXISTS rss_news_sentiment;
 DROP TABLE IF EXISTS rss_news_items;
 
@@ -8,9 +10,34 @@ CREATE TABLE rss_news_items (
     published TIMESTAMP,
     summary TEXT,
     content TEXT,
-	 description TEXT
+	 description TEXT,
+	 source TEXT,
+	 one_sentence_summary TEXT,
+	 two_sentence_summary TEXT,
+	 topic_keywords TEXT,
+	 impact_importance INTEGER,
+	 is_crypto_news BOOLEAN,
+	 -- near duplicate cluster (nlp/near_duplicates.py), the items of a cluster share the analysis of the first one
+	 cluster_key TEXT,
+	 -- normalised title hash used for duplicate checks (see find_existing_rss_news_items)
+	 title_hash TEXT GENERATED ALWAYS AS (md5(lower(btrim(regexp_replace(title, '\s+', ' ', 'g'))))) STORED
 );
 
+-- link is already indexed by its UNIQUE constraint
+CREATE INDEX rss_news_items_title_hash_idx ON rss_news_items (title_hash);
+
+CREATE INDEX rss_news_items_cluster_key_idx ON rss_news_items (cluster_key);
+
+-- to add the duplicate check index to an existing database:
+-- ALTER TABLE rss_news_items ADD COLUMN title_hash TEXT GENERATED ALWAYS AS (md5(lower(btrim(regexp_replace(title, '\s+', ' ', 'g'))))) STORED;
+-- CREATE INDEX CONCURRENTLY rss_news_items_title_hash_idx ON rss_news_items (title_hash);
+
+-- and the near duplicate clusters, where the articles stored so far each start their own (md5 of the link, like
+-- link_cluster_key in nlp/near_duplicates.py), so later near duplicates can reuse their analysis:
+-- ALTER TABLE rss_news_items ADD COLUMN cluster_key TEXT;
+-- UPDATE rss_news_items SET cluster_key = md5(link) WHERE cluster_key IS NULL;
+-- CREATE INDEX CONCURRENTLY rss_news_items_cluster_key_idx ON rss_news_items (cluster_key);
+
 CREATE TABLE rss_news_sentiment (
     id SERIAL PRIMARY KEY,
     crypto_type VARCHAR(255) NOT NULL,
@@ -27,4 +54,66 @@ CREATE TABLE rss_news_sentiment (
 	 best_match_coinpaprika_id VARCHAR(255),
 	 best_match_coinpaprika_match_score FLOAT,
     newsitem_id INTEGER REFERENCES rss_news_items(id)
-);
\ No newline at end of file
+);
+
+-- used by the bulk re-matching in update_cmc_coinpaprika_matches.py
+CREATE INDEX rss_news_sentiment_crypto_name_idx ON rss_news_sentiment (crypto_name);
+
+-- on an existing database:
+-- CREATE INDEX CONCURRENTLY rss_news_sentiment_crypto_name_idx ON rss_news_sentiment (crypto_name);
+
+-- rolling per coin sentiment (analytics/rolling.py): sums per time bucket, upserted with every stored sentiment.
+-- bucket_seconds is 60 / 900 / 3600 for the 1h / 24h / 7d windows; the minute and quarter hour buckets are pruned
+-- once they are out of their window, the hourly ones are kept. Filled from rss_news_sentiment on first start.
+CREATE TABLE rss_news_sentiment_rollup (
+    cmc_id VARCHAR(10) NOT NULL,
+    bucket_seconds INTEGER NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    count INTEGER NOT NULL,
+    sum_sentiment FLOAT NOT NULL,
+    sum_movement FLOAT NOT NULL,
+    sum_certainty FLOAT NOT NULL,
+    sum_weighted_sentiment FLOAT NOT NULL,
+    sum_weighted_movement FLOAT NOT NULL,
+    PRIMARY KEY (bucket_seconds, bucket_start, cmc_id)
+);
+
+-- durable queue between the feed pollers and the llm workers (db/work_queue.py): pollers insert, workers lease rows
+-- with FOR UPDATE SKIP LOCKED, highest priority first, and delete them in the transaction that stores the article.
+-- available_at is the retry time, and the lease expiry while lease_token is set. Rows that ran out of attempts, or
+-- were dropped by load shedding (last_error 'dropped: stale'), get failed_at and stay here; to queue them again:
+-- UPDATE pending_articles SET failed_at = NULL, attempts = 0, available_at = now() WHERE failed_at IS NOT NULL;
+CREATE TABLE pending_articles (
+    id BIGSERIAL PRIMARY KEY,
+    link VARCHAR(500) NOT NULL UNIQUE,
+    source TEXT,
+    article TEXT NOT NULL,
+    data JSONB NOT NULL,
+    published TIMESTAMPTZ,
+    -- the source's average impact_importance when queued, the number of queued rows about the same story, and the
+    -- priorities computed from them (see WorkQueue); deferred rows are stale, low value ones that wait for idle time
+    source_importance REAL NOT NULL DEFAULT 0,
+    cluster_key TEXT,
+    cluster_size INTEGER NOT NULL DEFAULT 1,
+    base_priority FLOAT NOT NULL DEFAULT 0,
+    priority FLOAT NOT NULL DEFAULT 0,
+    deferred BOOLEAN NOT NULL DEFAULT false,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_token TEXT,
+    leased_at TIMESTAMPTZ,
+    last_error TEXT,
+    failed_at TIMESTAMPTZ
+);
+
+CREATE INDEX pending_articles_priority_idx ON pending_articles (deferred, priority DESC) WHERE failed_at IS NULL;
+CREATE INDEX pending_articles_cluster_key_idx ON pending_articles (cluster_key);
+
+-- to add the priorities to an existing pending_articles:
+-- ALTER TABLE pending_articles ADD COLUMN published TIMESTAMPTZ, ADD COLUMN source_importance REAL NOT NULL DEFAULT 0,
+--     ADD COLUMN cluster_key TEXT, ADD COLUMN cluster_size INTEGER NOT NULL DEFAULT 1, ADD COLUMN base_priority FLOAT NOT NULL DEFAULT 0,
+--     ADD COLUMN priority FLOAT NOT NULL DEFAULT 0, ADD COLUMN deferred BOOLEAN NOT NULL DEFAULT false;
+-- DROP INDEX pending_articles_available_idx;
+-- CREATE INDEX pending_articles_priority_idx ON pending_articles (deferred, priority DESC) WHERE failed_at IS NULL;
+-- CREATE INDEX pending_articles_cluster_key_idx ON pending_articles (cluster_key);
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import time
+import websockets
+from collections import deque
+from utils.helper_functions import loginfo, logerror
+from ws_server.encoding import Event, ENCODINGS, VARIANTS, available_encodings
+from ws_server.subscriptions import Subscription, SubscriptionIndex
+from ws_server.replay import ReplayBuffer, Backfill
+
+
+# One authenticated websocket client: a bounded queue of outgoing events drained by its own writer task, so a slow
+# client only ever delays itself. Each client picks the variant and encoding of the frames it receives.
+class ClientConnection:
+	def __init__(self, websocket, max_queue, totals):
+		self.websocket = websocket
+		self.totals = totals
+		self.queue = asyncio.Queue(max_queue)
+		self.address = getattr(websocket, 'remote_address', None)
+		self.connected_at = time.monotonic()
+		self.variant = 'full'
+		self.encoding = 'json'
+		self.subscription = Subscription()
+		# catch-up events (replayed or from the database) are sent before anything in the live queue
+		self.backlog = deque()
+		self.backlog_ready = asyncio.Event()
+		self.backlog_empty = asyncio.Event()
+		self.catching_up = False
+		self.catch_up = None
+		self.sent = 0
+		self.bytes_sent = 0
+		self.dropped = 0
+		self.last_lag = 0.0
+		self.max_lag = 0.0
+		self.writer = None
+
+	# returns False if the queue is full and the event couldn't be queued
+	def enqueue(self, event, published_at, drop_oldest):
+		if self.queue.full():
+			if not drop_oldest:
+				return False
+			self.queue.get_nowait()
+			self.dropped += 1
+		self.queue.put_nowait((published_at, event))
+		return True
+
+	# replies to the client's own messages, never a reason to disconnect it
+	def reply(self, event_type, data):
+		self.enqueue(Event(event_type, data), time.monotonic(), True)
+
+	def wake_writer(self):
+		self.backlog_ready.set()
+		if self.queue.empty():
+			# a writer blocked on the live queue only notices the backlog once something arrives
+			self.queue.put_nowait((0, None))
+
+	async def next_event(self):
+		while True:
+			if self.backlog:
+				item = self.backlog.popleft()
+				if not self.backlog:
+					self.backlog_empty.set()
+				return item
+			if self.catching_up:
+				self.backlog_ready.clear()
+				await self.backlog_ready.wait()
+				continue
+			item = await self.queue.get()
+			if item[1] is not None:
+				return item
+
+	async def run_writer(self):
+		while True:
+			published_at, event = await self.next_event()
+			frame = event.frame(self.variant, self.encoding)
+			await self.websocket.send(frame)
+			# lag = time from publish() to the frame being handed to the socket
+			self.last_lag = time.monotonic() - published_at
+			self.max_lag = max(self.max_lag, self.last_lag)
+			self.sent += 1
+			self.bytes_sent += len(frame)
+			self.totals['sent'] += 1
+			self.totals['bytes_sent'] += len(frame)
+
+	def stats(self):
+		return {
+			'address': str(self.address),
+			'variant': self.variant,
+			'encoding': self.encoding,
+			'queued': self.queue.qsize(),
+			'sent': self.sent,
+			'bytes_sent': self.bytes_sent,
+			'dropped': self.dropped,
+			'lag_ms': round(self.last_lag * 1000, 1),
+			'max_lag_ms': round(self.max_lag * 1000, 1)
+		}
+
+
+# Fans each published event out to every client's queue.
+# publish() is safe to call from any thread (the pipeline workers), it hands the event to the event loop with
+# call_soon_threadsafe, there is no polling. When a client's queue is full the slow consumer policy applies:
+# 'drop_oldest' discards its oldest queued event, 'disconnect' closes the connection.
+#
+# Events only go to the clients whose subscription matches them, looked up through a coin -> clients index.
+#
+# After authenticating, clients can send json control messages:
+#   {"type": "options", "variant": "full" | "slim", "encoding": "json" | "msgpack" | "orjson"}
+#   {"type": "subscribe", "coins": [...], "min_impact_importance": n, "min_indicator_certainty": n, "events": [...]}
+#   {"type": "resume", "epoch": "...", "last_seq": n, "last_newsitem_id": n}
+#   {"type": "aggregates", "coins": [...]}
+# (see Subscription), answered with an "options" / "subscribed" / "resumed" / "aggregates" event or an "error" event.
+# "aggregates" returns the current rolling sentiment of the coins (default: the subscribed ones, or all of them),
+# changes are also published as "aggregate" events.
+#
+# Every published event carries the server's epoch and a sequence number. On resume, the events the client missed
+# are replayed from the in memory buffer when the epoch matches and the gap is still buffered, otherwise they come from
+# the database (keyset paginated after last_newsitem_id, through backfill.loader). Either way they are sent, filtered by
+# the client's subscription, before any live event; database catch-up events have no seq and may overlap with live
+# ones published while it runs, so clients should dedupe newsitems by id.
+class Broadcaster:
+	def __init__(self, max_queue=1000, slow_consumer_policy='drop_oldest', replay_size=10000, backfill=None):
+		if slow_consumer_policy not in ('drop_oldest', 'disconnect'):
+			raise ValueError(f'unknown slow consumer policy {slow_consumer_policy!r}')
+		self.max_queue = max_queue
+		self.drop_oldest = slow_consumer_policy == 'drop_oldest'
+		self.clients = set()
+		self.index = SubscriptionIndex()
+		self.replay = ReplayBuffer(replay_size)
+		self.backfill = backfill or Backfill()
+		# the pipeline's analytics.rolling.RollingAggregates, for "aggregates" requests
+		self.aggregates = None
+		self.loop = None
+		# bytes are frame sizes before any permessage-deflate
+		self.counters = {'published': 0, 'sent': 0, 'bytes_sent': 0, 'slow_disconnects': 0}
+
+	# must be called from the event loop that runs the server
+	def attach(self, loop):
+		self.loop = loop
+
+	def publish(self, event_type, data, coins=None, impact_importance=None, indicator_certainty=None):
+		loop = self.loop
+		if loop is None or loop.is_closed():
+			return
+		event = Event(event_type, data, coins, impact_importance, indicator_certainty)
+		try:
+			loop.call_soon_threadsafe(self.broadcast, event, time.monotonic())
+		except RuntimeError:
+			# loop closed between the check and the call (shutting down)
+			pass
+
+	def broadcast(self, event, published_at):
+		self.counters['published'] += 1
+		self.replay.append(event)
+		for client in self.index.matching(event):
+			if not client.enqueue(event, published_at, self.drop_oldest):
+				self.disconnect_slow(client)
+
+	def disconnect_slow(self, client):
+		logerror(f'Disconnecting slow websocket client {client.address} ({client.queue.qsize()} messages queued)')
+		self.counters['slow_disconnects'] += 1
+		self.remove_client(client)
+		client.writer.cancel()
+		asyncio.ensure_future(client.websocket.close(code=1008, reason='slow consumer'))
+
+	def handle_options(self, client, message):
+		variant = message.get('variant', client.variant)
+		encoding = message.get('encoding', client.encoding)
+		if variant not in VARIANTS:
+			return client.reply('error', {'message': f'unknown variant {variant!r}', 'variants': list(VARIANTS)})
+		if not ENCODINGS.get(encoding):
+			return client.reply('error', {'message': f'unsupported encoding {encoding!r}', 'encodings': available_encodings()})
+		client.variant = variant
+		client.encoding = encoding
+		client.reply('options', {'variant': variant, 'encoding': encoding})
+
+	def handle_subscribe(self, client, message):
+		try:
+			subscription = Subscription.from_message(message)
+		except ValueError as e:
+			return client.reply('error', {'message': f'invalid subscription: {e}'})
+		self.index.remove(client)
+		client.subscription = subscription
+		self.index.add(client)
+		client.reply('subscribed', subscription.describe())
+
+	def handle_resume(self, client, message):
+		epoch = message.get('epoch')
+		last_seq = message.get('last_seq')
+		last_newsitem_id = message.get('last_newsitem_id')
+		for key, value in (('last_seq', last_seq), ('last_newsitem_id', last_newsitem_id)):
+			if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+				return client.reply('error', {'message': f'{key} must be an integer'})
+
+		events = self.replay.since(epoch, last_seq) if last_seq is not None else None
+		if events is None and (last_newsitem_id is None or self.backfill.loader is None):
+			return client.reply('error', {'message': 'missed events are no longer buffered, resume with last_newsitem_id', 'epoch': self.replay.epoch})
+
+		# anything still queued is either replayed below or (being committed already) in the database, in order
+		if client.catch_up:
+			client.catch_up.cancel()
+		while not client.queue.empty():
+			client.queue.get_nowait()
+		client.backlog.clear()
+		now = time.monotonic()
+		if events is not None:
+			events = [event for event in events if client.subscription.wants(event)]
+			client.backlog.extend((now, event) for event in events)
+			client.backlog.append((now, Event('resumed', {'source': 'buffer', 'events': len(events), 'epoch': self.replay.epoch, 'seq': self.replay.last_seq})))
+			client.wake_writer()
+			return
+		client.catching_up = True
+		client.catch_up = asyncio.ensure_future(self.catch_up_from_database(client, last_newsitem_id, now))
+		client.wake_writer()
+
+	async def catch_up_from_database(self, client, last_newsitem_id, requested_at):
+		sent = 0
+		try:
+			async for page in self.backfill.pages_after(last_newsitem_id, requested_at):
+				events = [event for event in page if client.subscription.wants(event)]
+				if not events:
+					continue
+				client.backlog_empty.clear()
+				client.backlog.extend((time.monotonic(), event) for event in events)
+				client.backlog_ready.set()
+				sent += len(events)
+				# one page in flight per client, don't load the next one until the writer has sent this one
+				await client.backlog_empty.wait()
+			client.backlog.append((time.monotonic(), Event('resumed', {'source': 'database', 'events': sent, 'epoch': self.replay.epoch, 'seq': self.replay.last_seq})))
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logerror('! websocket catch-up failed')
+			logerror(e)
+			client.backlog.append((time.monotonic(), Event('error', {'message': 'catch-up failed', 'events': sent})))
+		finally:
+			client.catching_up = False
+			client.backlog_ready.set()
+
+	def handle_aggregates(self, client, message):
+		if self.aggregates is None:
+			return client.reply('error', {'message': 'aggregates are not available'})
+		coins = message.get('coins')
+		if coins is not None and (not isinstance(coins, list) or not all(isinstance(c, (str, int)) and not isinstance(c, bool) for c in coins)):
+			return client.reply('error', {'message': 'coins must be a list of cmc ids'})
+		if coins is None and client.subscription.coins is not None:
+			coins = list(client.subscription.coins)
+		client.reply('aggregates', self.aggregates.snapshot(coins))
+
+	def handle_message(self, client, raw):
+		try:
+			message = json.loads(raw)
+			if not isinstance(message, dict):
+				raise ValueError('expected a json object')
+		except ValueError as e:
+			return client.reply('error', {'message': f'invalid message: {e}'})
+		if message.get('type') == 'options':
+			return self.handle_options(client, message)
+		if message.get('type') == 'subscribe':
+			return self.handle_subscribe(client, message)
+		if message.get('type') == 'resume':
+			return self.handle_resume(client, message)
+		if message.get('type') == 'aggregates':
+			return self.handle_aggregates(client, message)
+		client.reply('error', {'message': f'unknown message type {message.get("type")!r}'})
+
+	async def run_reader(self, client):
+		async for raw in client.websocket:
+			self.handle_message(client, raw)
+
+	def add_client(self, client):
+		self.clients.add(client)
+		self.index.add(client)
+
+	def remove_client(self, client):
+		if client in self.clients:
+			self.clients.discard(client)
+			self.index.remove(client)
+
+	# runs for the lifetime of an (already authenticated) connection
+	async def serve(self, websocket):
+		client = ClientConnection(websocket, self.max_queue, self.counters)
+		client.writer = asyncio.ensure_future(client.run_writer())
+		reader = asyncio.ensure_future(self.run_reader(client))
+		self.add_client(client)
+		loginfo(len(self.clients), 'clients connected')
+		try:
+			# the reader returns when the connection closes, the writer only stops on a send error or a slow consumer disconnect
+			await asyncio.wait([client.writer, reader], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			self.remove_client(client)
+			client.writer.cancel()
+			reader.cancel()
+			if client.catch_up:
+				client.catch_up.cancel()
+			for task in (client.writer, reader):
+				if not task.cancelled() and task.done() and task.exception():
+					if not isinstance(task.exception(), websockets.exceptions.ConnectionClosed):
+						logerror('! websocket client exception')
+						logerror(task.exception())
+			loginfo('Client connection closed,', len(self.clients), 'clients connected')
+
+	def stats(self, per_client=False):
+		clients = [client.stats() for client in list(self.clients)]
+		stats = {
+			'clients': len(clients),
+			'subscribed_coins': len(self.index.by_coin),
+			**self.counters,
+			'queued': sum(c['queued'] for c in clients),
+			'dropped': sum(c['dropped'] for c in clients),
+			'max_queued': max((c['queued'] for c in clients), default=0),
+			'max_lag_ms': max((c['max_lag_ms'] for c in clients), default=0)
+		}
+		stats['replay'] = {'epoch': self.replay.epoch, 'last_seq': self.replay.last_seq, 'buffered': len(self.replay.events), **self.backfill.counters}
+		if per_client:
+			stats['per_client'] = clients
+		return stats
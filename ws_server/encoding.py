@@ -0,0 +1,64 @@
+import json
+
+# optional compact encodings, clients can only pick the ones that are installed
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+# 'json' frames are text, the others binary
+ENCODINGS = {'json': True, 'msgpack': msgpack is not None, 'orjson': orjson is not None}
+VARIANTS = ('full', 'slim')
+
+# the slim variant leaves out the article bodies, most subscribers only want the scores and summaries
+SLIM_EXCLUDED_FIELDS = {
+	'newsitem': ('content', 'summary', 'description')
+}
+
+
+def available_encodings():
+	return [name for name, available in ENCODINGS.items() if available]
+
+# published events carry the server epoch and their sequence number (see ws_server/replay.py), replies and
+# database catch-up events don't
+def encode_event(event_type, data, variant='full', encoding='json', seq=None, epoch=None):
+	excluded = SLIM_EXCLUDED_FIELDS.get(event_type, ()) if variant == 'slim' else ()
+	if excluded:
+		data = {key: value for key, value in data.items() if key not in excluded}
+	message = {'type': event_type, 'data': data}
+	if seq is not None:
+		message['epoch'] = epoch
+		message['seq'] = seq
+	if encoding == 'msgpack':
+		return msgpack.packb(message, default=str)
+	if encoding == 'orjson':
+		return orjson.dumps(message, default=str)
+	return json.dumps(message, default=str)
+
+
+# A published event. Each (variant, encoding) frame is encoded the first time a client needs it and then shared by every
+# other client that asked for the same one, instead of serialising per client.
+# coins / impact_importance / indicator_certainty are only used to route the event to subscribers, they aren't sent.
+class Event:
+	__slots__ = ('type', 'data', 'frames', 'coins', 'impact_importance', 'indicator_certainty', 'seq', 'epoch')
+
+	def __init__(self, event_type, data, coins=None, impact_importance=None, indicator_certainty=None):
+		self.type = event_type
+		self.data = data
+		self.frames = {}
+		self.coins = frozenset(str(coin) for coin in coins if coin is not None) if coins else frozenset()
+		self.impact_importance = impact_importance
+		self.indicator_certainty = indicator_certainty
+		self.seq = None
+		self.epoch = None
+
+	def frame(self, variant='full', encoding='json'):
+		key = (variant, encoding)
+		frame = self.frames.get(key)
+		if frame is None:
+			frame = self.frames[key] = encode_event(self.type, self.data, variant, encoding, self.seq, self.epoch)
+		return frame
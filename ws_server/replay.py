@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import deque
+from ws_server.encoding import Event
+
+
+# The last `size` published events, each numbered with a sequence id that only ever goes up.
+# The epoch changes every time the server starts, so a client can tell whether its last seq is from this run.
+class ReplayBuffer:
+	def __init__(self, size=10000):
+		self.events = deque(maxlen=size)
+		self.epoch = uuid.uuid4().hex[:12]
+		self.last_seq = 0
+
+	# called on the event loop only
+	def append(self, event):
+		self.last_seq += 1
+		event.seq = self.last_seq
+		event.epoch = self.epoch
+		self.events.append(event)
+
+	# the events after last_seq, or None if some of them have already left the buffer (or are from another epoch)
+	def since(self, epoch, last_seq):
+		if epoch != self.epoch or last_seq > self.last_seq:
+			return None
+		oldest = self.events[0].seq if self.events else self.last_seq + 1
+		if last_seq < oldest - 1:
+			return None
+		return list(itertools.islice(self.events, max(0, last_seq - oldest + 1), None))
+
+
+# Keyset paginated catch-up from the database, for gaps older than the replay buffer.
+# loader(after_newsitem_id, limit) is set by the pipeline (it owns the database) and returns a list of
+# {'type', 'data', 'coins', 'impact_importance', 'indicator_certainty', 'newsitem_id'} in newsitem id order.
+# It runs in the loop's default executor. Concurrent requests for the same page (every client reconnecting after a
+# restart) share one query, and at most max_concurrent different pages are loaded at a time.
+# A client only shares a page that was requested after it asked to catch up, anything older could be missing events
+# that were published (and dropped from its queue) in between.
+class Backfill:
+	def __init__(self, page_size=200, max_items=5000, max_concurrent=2, page_ttl=10):
+		self.loader = None
+		self.page_size = page_size
+		self.max_items = max_items
+		self.page_ttl = page_ttl
+		self.semaphore = None
+		self.max_concurrent = max_concurrent
+		self.pages = {}
+		self.counters = {'pages_loaded': 0, 'pages_shared': 0}
+
+	async def load_page(self, after_newsitem_id, not_before):
+		loop = asyncio.get_running_loop()
+		if self.semaphore is None:
+			self.semaphore = asyncio.Semaphore(self.max_concurrent)
+		now = time.monotonic()
+		for key in [key for key, (requested_at, future) in self.pages.items() if now - requested_at > self.page_ttl]:
+			del self.pages[key]
+		cached = self.pages.get(after_newsitem_id)
+		if cached and cached[0] >= not_before:
+			self.counters['pages_shared'] += 1
+			return await asyncio.shield(cached[1])
+
+		async def load():
+			async with self.semaphore:
+				return await loop.run_in_executor(None, self.loader, after_newsitem_id, self.page_size)
+
+		future = asyncio.ensure_future(load())
+		self.pages[after_newsitem_id] = (now, future)
+		self.counters['pages_loaded'] += 1
+		try:
+			return await asyncio.shield(future)
+		except Exception:
+			self.pages.pop(after_newsitem_id, None)
+			raise
+
+	# yields pages of Events after the given newsitem id, up to max_items newsitems
+	async def pages_after(self, after_newsitem_id, not_before):
+		items = 0
+		while items < self.max_items:
+			rows = await self.load_page(after_newsitem_id, not_before)
+			if not rows:
+				return
+			yield [Event(row['type'], row['data'], row.get('coins'), row.get('impact_importance'), row.get('indicator_certainty')) for row in rows]
+			newsitem_ids = [row['newsitem_id'] for row in rows]
+			items += len(set(newsitem_ids))
+			after_newsitem_id = max(newsitem_ids)
@@ -0,0 +1,97 @@
+EVENT_TYPES = ('newsitem', 'sentiment', 'aggregate')
+# the importance / certainty thresholds only apply to these, aggregates only go by coin
+SCORED_EVENT_TYPES = ('newsitem', 'sentiment')
+
+
+# What a client wants to receive, from its {"type": "subscribe", ...} message:
+#   coins                    cmc ids (best_match_cmc_id), omitted = every coin
+#   min_impact_importance    the article's impact_importance
+#   min_indicator_certainty  the sentiment's indicator_certainty (for a newsitem, its most certain sentiment)
+#   events                   any of EVENT_TYPES, omitted = all of them
+# A client that never subscribes gets everything.
+class Subscription:
+	def __init__(self, coins=None, min_impact_importance=None, min_indicator_certainty=None, events=None):
+		self.coins = frozenset(coins) if coins else None
+		self.min_impact_importance = min_impact_importance
+		self.min_indicator_certainty = min_indicator_certainty
+		self.events = frozenset(events) if events else None
+
+	@classmethod
+	def from_message(cls, message):
+		coins = message.get('coins')
+		if coins is not None:
+			if not isinstance(coins, list) or not all(isinstance(c, (str, int)) and not isinstance(c, bool) for c in coins):
+				raise ValueError('coins must be a list of cmc ids')
+			coins = [str(c) for c in coins]
+		events = message.get('events')
+		if events is not None:
+			if not isinstance(events, list) or not set(events) <= set(EVENT_TYPES):
+				raise ValueError(f'events must be a list of {", ".join(EVENT_TYPES)}')
+		thresholds = {}
+		for key in ('min_impact_importance', 'min_indicator_certainty'):
+			value = message.get(key)
+			if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+				raise ValueError(f'{key} must be a number')
+			thresholds[key] = value
+		return cls(coins, events=events, **thresholds)
+
+	def matches(self, event):
+		if self.events is not None and event.type not in self.events:
+			return False
+		if event.type not in SCORED_EVENT_TYPES:
+			return True
+		if self.min_impact_importance is not None and (event.impact_importance is None or event.impact_importance < self.min_impact_importance):
+			return False
+		if self.min_indicator_certainty is not None and (event.indicator_certainty is None or event.indicator_certainty < self.min_indicator_certainty):
+			return False
+		return True
+
+	# same as routing through SubscriptionIndex, for events that aren't (replays)
+	def wants(self, event):
+		if self.coins is not None and not self.coins & event.coins:
+			return False
+		return self.matches(event)
+
+	def describe(self):
+		return {
+			'coins': sorted(self.coins) if self.coins is not None else None,
+			'min_impact_importance': self.min_impact_importance,
+			'min_indicator_certainty': self.min_indicator_certainty,
+			'events': sorted(self.events) if self.events is not None else None
+		}
+
+
+# coin -> subscribed clients, so routing an event only touches the clients interested in one of its coins
+# (plus the ones that take every coin) rather than every connected client
+class SubscriptionIndex:
+	def __init__(self):
+		self.by_coin = {}
+		self.any_coin = set()
+
+	def add(self, client):
+		coins = client.subscription.coins
+		if coins is None:
+			self.any_coin.add(client)
+			return
+		for coin in coins:
+			self.by_coin.setdefault(coin, set()).add(client)
+
+	def remove(self, client):
+		self.any_coin.discard(client)
+		for coin in client.subscription.coins or ():
+			subscribers = self.by_coin.get(coin)
+			if subscribers is not None:
+				subscribers.discard(client)
+				if not subscribers:
+					del self.by_coin[coin]
+
+	def candidates(self, event):
+		if not event.coins:
+			return self.any_coin
+		clients = set(self.any_coin)
+		for coin in event.coins:
+			clients.update(self.by_coin.get(coin, ()))
+		return clients
+
+	def matching(self, event):
+		return [client for client in self.candidates(event) if client.subscription.matches(event)]
@@ -1,24 +1,38 @@
 import asyncio
 import websockets
-import json
 from dotenv import load_dotenv
 import os
-from utils.helper_functions import loginfo, logerror, logdebug
-import threading
-from queue import Queue
-import signal
+from utils.helper_functions import loginfo, logerror
+from ws_server.broadcaster import Broadcaster
+from ws_server.replay import Backfill
 
 server=None
 terminate_flag=None
 
 load_dotenv()
 WS_SHARED_SECRET=os.getenv("WS_SHARED_SECRET")
-
-# Create a thread-safe queue to store outgoing messages
-message_queue = Queue()
-
-# Define a set to store connected clients
-connected_clients = set()
+WS_HOST=os.getenv("WS_HOST", "0.0.0.0")
+WS_PORT=int(os.getenv("WS_PORT", 8765))
+# outgoing messages buffered per client, and what to do with a client that falls that far behind (drop_oldest or disconnect)
+WS_CLIENT_QUEUE_SIZE=int(os.getenv("WS_CLIENT_QUEUE_SIZE", 1000))
+WS_SLOW_CONSUMER_POLICY=os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# permessage-deflate for clients that offer it ("deflate") or off ("none"); it costs cpu per client since every
+# connection has its own compression context
+WS_COMPRESSION=os.getenv("WS_COMPRESSION", "deflate")
+# published events kept in memory for clients that reconnect ({"type": "resume", ...}), older gaps are caught up
+# from the database in pages of WS_BACKFILL_PAGE_SIZE newsitems, at most WS_BACKFILL_MAX_ITEMS per resume
+WS_REPLAY_BUFFER=int(os.getenv("WS_REPLAY_BUFFER", 10000))
+WS_BACKFILL_PAGE_SIZE=int(os.getenv("WS_BACKFILL_PAGE_SIZE", 200))
+WS_BACKFILL_MAX_ITEMS=int(os.getenv("WS_BACKFILL_MAX_ITEMS", 5000))
+
+# the pipeline sets broadcaster.backfill.loader, without one only the replay buffer is available
+broadcaster = Broadcaster(WS_CLIENT_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY, WS_REPLAY_BUFFER,
+	Backfill(WS_BACKFILL_PAGE_SIZE, WS_BACKFILL_MAX_ITEMS))
+
+# thread safe, called by the pipeline threads; data is encoded once per variant/encoding the clients ask for,
+# coins / impact_importance / indicator_certainty decide which subscribers get it
+def publish(event_type, data, coins=None, impact_importance=None, indicator_certainty=None):
+	broadcaster.publish(event_type, data, coins, impact_importance, indicator_certainty)
 
 async def handle_client(websocket, path):
 	# Wait for the client to provide the authentication secret during the handshake
@@ -32,16 +46,8 @@ async def handle_client(websocket, path):
 		return
 	loginfo('Client auth successful')	
 
-	# Add the client to the set of connected clients
-	connected_clients.add(websocket)
-	loginfo(len(connected_clients),'clients connected')
 	try:
-		# Wait for the client connection to close
-		await websocket.wait_closed()
-	except websockets.exceptions.ConnectionClosedError:
-		loginfo('Client connection closed')
-		# Remove the client from the set if the connection is closed
-		connected_clients.remove(websocket)
+		await broadcaster.serve(websocket)
 	except Exception as e:
 		logerror('! handle_client exception')
 		logerror(e)
@@ -50,11 +56,11 @@ async def handle_client(websocket, path):
 
 async def start_server():
 	# The IP address and port you want to run your WebSocket server on
-	server_ip = "0.0.0.0"
-	server_port = 8765
+	server_ip = WS_HOST
+	server_port = WS_PORT
 
 	# Start the WebSocket server
-	server = await websockets.serve(handle_client, server_ip, server_port)
+	server = await websockets.serve(handle_client, server_ip, server_port, compression=None if WS_COMPRESSION == 'none' else 'deflate')
 	loginfo(f"WebSocket server started at ws://{server_ip}:{server_port}")
 
 	# Keep the server running indefinitely
@@ -89,29 +95,16 @@ async def stop_server():
 	# Wait for tasks to be cancelled. 
 	await asyncio.gather(*tasks, return_exceptions=True)
 
-async def send_message(client, message):
-	await client.send(message)
-
-async def handle_message_queue():
-	while True:
-		# Check the message queue for outgoing messages
-		while not message_queue.empty():
-			message = message_queue.get()
-			# Send the message to all connected clients
-			for client in connected_clients:
-					await client.send(message)
-		await asyncio.sleep(0.1)
-
 async def main():
-	# Start the server and the message handling loop as concurrent tasks
+	# messages published from other threads are handed to this loop
+	broadcaster.attach(asyncio.get_running_loop())
 	server_task = asyncio.create_task(start_server())
-	message_handler_task = asyncio.create_task(handle_message_queue())
 
 	# Poll the termination flag
 	while not terminate_flag:
 		await asyncio.sleep(1)  # Sleep for a short while to avoid busy-waiting
 
 	# If termination flag is set, cancel the tasks
+	broadcaster.attach(None)
 	server_task.cancel()
-	message_handler_task.cancel()
-	await asyncio.gather(server_task, message_handler_task, return_exceptions=True)
+	await asyncio.gather(server_task, return_exceptions=True)